@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compares ways of decoding a large container listing, no daemon needed:
+# the standard library, the decoder whalesnake picked (orjson if installed)
+# and the incremental decoder used for containers(raw=True, fields=[...]).
+#
+# usage: python bench_decode.py [number_of_rows]
+
+import sys
+import json
+import time
+
+import whalesnake as ws
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+CHUNK = 65536
+
+rows = [{'Id': '{0:064x}'.format(i),
+         'Names': ['/ws_bench_{0}'.format(i)],
+         'Image': 'busybox:latest',
+         'Command': 'sleep 999',
+         'Created': 1400000000 + i,
+         'Status': 'Up 5 minutes',
+         'Ports': [{'PrivatePort': 80, 'Type': 'tcp'}],
+         'SizeRw': 0, 'SizeRootFs': 0}
+        for i in range(N)]
+data = json.dumps(rows).encode('utf-8')
+chunks = [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+def bench(label, decode):
+    start = time.time()
+    first = None
+    count = 0
+    for row in decode():
+        if first is None:
+            first = time.time() - start
+        count += 1
+    took = time.time() - start
+    assert count == N
+    print('{0:>12}: {1:8.3f}s total, first row after {2:8.3f}ms'.format(
+        label, took, first * 1000))
+
+print('{0} rows, {1:.1f} MiB'.format(N, len(data) / 1024. / 1024))
+bench('json', lambda: json.loads(b''.join(chunks).decode('utf-8')))
+bench('_loads', lambda: ws._loads(b''.join(chunks)))
+bench('incremental',
+      lambda: (ws._project(row, ['Id', 'Names'])
+               for row in ws._iter_json_array(chunks)))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Places batch jobs on a synthetic fleet of fake daemons (see
+# tests/fake_daemon.py), no docker needed. Compares picking hosts at random
+# with Placer()'s strategies: overloaded hosts, spread and hosts in use, as
+# well as the time per decision with incremental bookkeeping versus a
+# refresh() from the daemons before every placement.
+#
+# usage: python bench_placement.py [number_of_hosts] [number_of_jobs]
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tests'))
+
+import whalesnake as ws
+from fake_daemon import FakeDaemon
+
+HOSTS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+JOBS = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+GiB = 1 << 30
+MiB = 1 << 20
+
+rnd = random.Random(42)
+daemons = []
+for i in range(HOSTS):
+    ncpu = rnd.choice([4, 8, 16, 32])
+    # some hosts are busy already
+    d = FakeDaemon(containers=rnd.randint(0, ncpu), images=1, ncpu=ncpu,
+                   mem_total=ncpu * 4 * GiB)
+    for ctn in d.containers:
+        ctn['Memory'] = rnd.choice([512, 1024, 2048]) * MiB
+        ctn['CpuShares'] = rnd.choice([256, 512, 1024])
+    daemons.append(d.start())
+fleet = ws.Fleet([d.url for d in daemons], version='1.16')
+jobs = [(rnd.choice([128, 256, 512, 1024]) * MiB,
+         rnd.choice([128, 256, 512])) for _ in range(JOBS)]
+
+print('{0} hosts, {1} containers already running, {2} jobs'.format(
+    HOSTS, sum(len(d.containers) for d in daemons), JOBS))
+
+def report(label, placer, took, overloaded=0):
+    used = [host['used_mem'] / host['mem'] for host in placer.hosts.values()]
+    busy = sum(1 for host in placer.hosts.values()
+               if any(k.startswith('job') for k in host['containers']))
+    print('{0:>14}: {1:8.1f}us per job, {2:4d} overloaded, memory used '
+          '{3:5.1f}% .. {4:5.1f}%, jobs on {5} hosts'.format(
+              label, took / JOBS * 1e6, overloaded, min(used) * 100,
+              max(used) * 100, busy))
+
+start = time.time()
+base = ws.Placer(fleet)
+base.refresh()
+print('refresh(): {0:.3f}s'.format(time.time() - start))
+
+# what we did before: pick any host, whether the job fits or not
+placer = ws.Placer(fleet)
+placer.refresh()
+overloaded = 0
+start = time.time()
+for i, (mem, shares) in enumerate(jobs):
+    url = rnd.choice(list(placer.hosts))
+    if placer.free(url, mem, shares / 1024.) < 0:
+        overloaded += 1
+    placer.started(url, 'job{0}'.format(i), mem, shares)
+report('random', placer, time.time() - start, overloaded)
+
+for strategy in ws.Placer.STRATEGIES:
+    placer = ws.Placer(fleet, strategy=strategy)
+    placer.refresh()
+    failed = 0
+    start = time.time()
+    for i, (mem, shares) in enumerate(jobs):
+        try:
+            url = placer.place(mem, shares)
+        except ws.WhalesnakeError:
+            failed += 1
+            continue
+        placer.started(url, 'job{0}'.format(i), mem, shares)
+    report(strategy, placer, time.time() - start)
+    if failed:
+        print('{0:>14}  {1} jobs did not fit anywhere'.format('', failed))
+
+# asking the daemons for every decision instead, on a sample of the jobs
+sample = jobs[:max(1, JOBS // 100)]
+placer = ws.Placer(fleet)
+start = time.time()
+for mem, shares in sample:
+    placer.refresh()
+    placer.place(mem, shares)
+took = time.time() - start
+print('{0:>14}: {1:8.1f}us per job'.format(
+    'refresh+place', took / len(sample) * 1e6))
+
+for d in daemons:
+    d.stop()
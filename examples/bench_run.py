@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compares Container.run() with Container.run(fast=True): wall time and
+# number of requests sent to the daemon per launched container.
+#
+# usage: python bench_run.py [number_of_containers] [image]
+
+import sys
+import time
+
+import whalesnake as ws
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+IMAGE = sys.argv[2] if len(sys.argv) > 2 else 'busybox:latest'
+CMD = 'sleep 999'
+
+ws.connect()
+
+# docker.Client is a requests.Session, count everything it sends
+requests_sent = [0]
+send = ws.dc.send
+def counting_send(*args, **kwargs):
+    requests_sent[0] += 1
+    return send(*args, **kwargs)
+ws.dc.send = counting_send
+
+def bench(label, fast):
+    ctns = [ws.Container('ws_bench_{0}_{1}'.format(label, i))
+            for i in range(N)]
+    requests_sent[0] = 0
+    start = time.time()
+    for ctn in ctns:
+        ctn.run(IMAGE, CMD, fast=fast)
+    took = time.time() - start
+    print('{0:>6}: {1:7.3f}s total, {2:6.1f}ms and {3:4.1f} requests '
+          'per container'.format(label, took, took / N * 1000,
+                                 float(requests_sent[0]) / N))
+    for ctn in ctns:
+        ws.dc.remove_container(ctn.long_id, force=True)
+
+bench('normal', False)
+bench('fast', True)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+# A tiny stand-in for the docker daemon's remote API, good enough for the
+# listing, info and lifecycle calls. Lets Fleet be tested (and benchmarked)
+# against many daemons on one machine.
+
+import re
+import json
+import time
+import struct
+import hashlib
+import threading
+import contextlib
+
+import docker
+
+import whalesnake as ws
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+def fake_id(seed):
+    return hashlib.sha256(seed.encode('utf-8')).hexdigest()
+
+
+def _version(version):
+    return tuple(int(part) for part in version.split('.'))
+
+
+def _timestamp(when):
+    # like the daemon, 0 is its zero time
+    ts = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(when or -62135596800))
+    return ts + '.{0:09d}Z'.format(int(round(when % 1 * 1e9)))
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients that gave up waiting, e.g. after a timeout
+        pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        fake = self.server.fake
+        if fake.delay:
+            time.sleep(fake.delay)
+        if fake.fail:
+            return self._send(500, {'message': 'fake failure'})
+        # the api version the client asked for
+        path, _, query = self.path.partition('?')
+        m = re.match(r'^/v([0-9.]+)', path)
+        version = m.group(1) if m else None
+        path = path[m.end():] if m else path
+        query = dict(pair.partition('=')[::2] for pair in query.split('&'))
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        try:
+            data = json.loads(data.decode('utf-8')) if data else None
+        except ValueError:
+            pass
+        code, body = fake.handle(method, path, query, data, version)
+        if isinstance(body, bytes):
+            self.send_response(code)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send(code, body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+# kept per container, but not part of the listing
+_HIDDEN = ('Running', 'Logs', 'Memory', 'CpuShares', 'Archive', 'StartedAt',
+           'FinishedAt', 'Changes')
+
+
+class FakeDaemon(object):
+
+    def __init__(self, containers=10, images=5, delay=0, fail=False,
+                 ncpu=4, mem_total=8 << 30):
+        '''
+        containers, images: Number of them to make up
+        delay: Seconds to wait before answering any request
+        fail: Answer every request with a 500
+        ncpu, mem_total: What info() reports, to clients asking for api
+            version 1.16 or later, like a real daemon
+
+        Call start() to listen on a free port of 127.0.0.1, see url.
+
+        '''
+        self.delay = delay
+        self.fail = fail
+        self.ncpu = ncpu
+        self.mem_total = mem_total
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self.images = [
+            {'Id': fake_id('img{0}'.format(i)),
+             'RepoTags': ['fake/app{0}:latest'.format(i)],
+             'ParentId': '', 'Created': 1400000000 + i,
+             'Size': 1000, 'VirtualSize': 100000}
+            for i in range(images)
+        ]
+        self.containers = [
+            {'Id': fake_id('ctn{0}{1}'.format(id(self), i)),
+             'Names': ['/fake_{0}'.format(i)],
+             'Image': self.images[i % images]['RepoTags'][0] if images else '',
+             'Command': 'sleep 999', 'Created': 1400000000 + i,
+             'Status': 'Up 5 minutes', 'Ports': [], 'Running': True,
+             'Logs': [], 'Memory': 0, 'CpuShares': 0, 'Archive': b'',
+             'StartedAt': time.time() - 300, 'FinishedAt': 0, 'Changes': []}
+            for i in range(containers)
+        ]
+
+    def log(self, ref, text, stream=1, when=None):
+        '''
+        Lets a container write a line to stdout (stream=1) or stderr (2).
+        when: unix time, defaults to now
+
+        '''
+        when = time.time() if when is None else when
+        self._find(ref)['Logs'].append((when, stream, text))
+
+    @property
+    def url(self):
+        return 'tcp://127.0.0.1:{0}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.fake = self
+        t = threading.Thread(target=self._server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _find(self, ref):
+        for ctn in self.containers:
+            if ctn['Id'].startswith(ref) or ctn['Names'][0] == '/' + ref:
+                return ctn
+        return None
+
+    def _logs(self, ctn, query):
+        since = int(query.get('since') or 0)
+        out = []
+        for when, stream, text in ctn['Logs']:
+            if when < since:
+                continue
+            line = '{0} {1}\n'.format(_timestamp(when), text).encode('utf-8')
+            out.append(struct.pack('>BxxxL', stream, len(line)) + line)
+        return b''.join(out)
+
+    def _create(self, query, config):
+        config = config or {}
+        with self._lock:
+            name = query.get('name') or 'created_{0}'.format(
+                len(self.containers))
+            ctn = {'Id': fake_id('ctn{0}{1}'.format(id(self), name)),
+                   'Names': ['/' + name], 'Image': config.get('Image', ''),
+                   'Command': ' '.join(config.get('Cmd') or []),
+                   'Created': int(time.time()), 'Status': '', 'Ports': [],
+                   'Running': False, 'Logs': [], 'Archive': b'',
+                   'StartedAt': 0, 'FinishedAt': 0, 'Changes': [],
+                   'Memory': config.get('Memory') or 0,
+                   'CpuShares': config.get('CpuShares') or 0}
+            self.containers.append(ctn)
+        return 201, {'Id': ctn['Id'], 'Warnings': None}
+
+    def handle(self, method, path, query={}, body=None, version=None):
+        with self._lock:
+            self.requests += 1
+        if path == '/_ping':
+            return 200, 'OK'
+        if path == '/version':
+            return 200, {'ApiVersion': '1.16', 'Version': '1.4.0-fake'}
+        if path == '/info':
+            info = {'Containers': len(self.containers),
+                    'Images': len(self.images)}
+            if version is None or _version(version) >= (1, 16):
+                info.update({'NCPU': self.ncpu, 'MemTotal': self.mem_total})
+            return 200, info
+        if path == '/containers/json':
+            # like the daemon, a limit lists the last created ones, running
+            # or not
+            ctns = self.containers
+            limit = int(query.get('limit') or -1)
+            if limit > 0:
+                ctns = sorted(ctns, key=lambda ctn: -ctn['Created'])[:limit]
+            elif query.get('all') in (None, '', '0'):
+                ctns = [ctn for ctn in ctns if ctn['Running']]
+            return 200, [dict((k, v) for k, v in ctn.items()
+                              if k not in _HIDDEN)
+                         for ctn in ctns]
+        if path == '/images/json':
+            return 200, self.images
+        m = re.match(r'^/images/([^/]+)/history$', path)
+        if m is not None:
+            for img in self.images:
+                if img['Id'].startswith(m.group(1)):
+                    return 200, [{'Id': img['Id'], 'Created': img['Created'],
+                                  'CreatedBy': '/bin/sh -c #(nop) CMD []',
+                                  'Size': img['Size'],
+                                  'Tags': list(img['RepoTags'])}]
+            return 404, {'message': 'No such image'}
+        if method == 'POST' and path == '/containers/create':
+            return self._create(query, body)
+        m = re.match(r'^/containers/([^/]+)(/[a-z]+)?$', path)
+        if m is None:
+            return 404, None
+        ctn = self._find(m.group(1))
+        if ctn is None:
+            return 404, {'message': 'No such container'}
+        action = m.group(2)
+        if method == 'DELETE' and action is None:
+            with self._lock:
+                self.containers.remove(ctn)
+            return 204, None
+        if method == 'GET' and action == '/json':
+            return 200, {'Id': ctn['Id'], 'Name': ctn['Names'][0],
+                         'Image': fake_id('img0'), 'Created': ctn['Created'],
+                         'Config': {'Image': ctn['Image'], 'Tty': False,
+                                    'Memory': ctn['Memory'],
+                                    'CpuShares': ctn['CpuShares']},
+                         'State': {'Running': ctn['Running'],
+                                   'StartedAt': _timestamp(ctn['StartedAt']),
+                                   'FinishedAt':
+                                       _timestamp(ctn['FinishedAt']),
+                                   'Paused': False},
+                         'NetworkSettings': {'Ports': {}}}
+        if method == 'GET' and action == '/top':
+            # like ps aux
+            return 200, {
+                'Titles': ['USER', 'PID', '%CPU', '%MEM', 'VSZ', 'RSS', 'TTY',
+                           'STAT', 'START', 'TIME', 'COMMAND'],
+                'Processes': [['root', '1', '0.0', '0.1', '1200', '300', '?',
+                               'Ss', '10:00', '0:00', ctn['Command']]]
+            }
+        if method == 'GET' and action == '/changes':
+            # whatever was put into 'Changes'
+            return 200, ctn['Changes']
+        if method == 'GET' and action == '/logs':
+            return 200, self._logs(ctn, query)
+        if method == 'POST' and action == '/copy':
+            # whatever tar was put into 'Archive'
+            return 200, ctn['Archive']
+        if method == 'POST' and action in ('/start', '/restart'):
+            ctn['Running'] = True
+            ctn['Status'] = 'Up 1 seconds'
+            ctn['StartedAt'] = time.time()
+            return 204, None
+        if method == 'POST' and action in ('/stop', '/kill'):
+            ctn['Running'] = False
+            ctn['Status'] = 'Exited (0) 1 seconds ago'
+            ctn['FinishedAt'] = time.time()
+            return 204, None
+        return 404, None
+
+
+def connect(daemon):
+    '''
+    Starts daemon, unless it already runs, and points whalesnake's module
+    level client at it.
+    
+    Returns: a function, that undoes both
+    
+    '''
+    if daemon._server is None:
+        daemon.start()
+    dc, ws.dc = ws.dc, docker.Client(base_url=daemon.url)
+    
+    def disconnect():
+        ws.dc = dc
+        daemon.stop()
+    return disconnect
+
+
+@contextlib.contextmanager
+def connected(daemon):
+    '''
+    connect() for the duration of a with block, yields the daemon
+    
+    '''
+    disconnect = connect(daemon)
+    try:
+        yield daemon
+    finally:
+        disconnect()
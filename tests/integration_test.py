@@ -2,16 +2,25 @@
 # -*- coding: utf-8 -*-
 
 import io
+import json
 import os
+import re
 import time
+import struct
+import shutil
+import socket
+import zlib
 import tarfile
+import threading
 import datetime
 import tempfile
 
 import docker
-from pytest import raises
+import requests
+from pytest import raises, skip
 
 import whalesnake as ws
+from fake_daemon import FakeDaemon, connect, connected
 
 # try to avoid using six for now
 try:
@@ -275,6 +284,12 @@ class Test_general_docker_commands:
         assert len(res) is 1
         assert not isinstance(res[0], ws.Image)
         assert res[0]['Id'] == TEST_IMAGE_ID
+        
+        # only some fields, decoded while streaming
+        res = ws.images(TEST_IMAGE_ID, raw=True, fields=['Id', 'RepoTags'])
+        assert len(res) is 1
+        assert sorted(res[0].keys()) == ['Id', 'RepoTags']
+        assert res[0]['Id'] == TEST_IMAGE_ID
 
     def test_containers(self):
         res = ws.containers()
@@ -301,11 +316,88 @@ class Test_general_docker_commands:
         assert len(res) is 1
         assert not isinstance(res[0], ws.Container)
         assert res[0]['Id'] == TEST_CONTAINER_ID
+        
+        res = ws.containers(TEST_CONTAINER_NAME, raw=True, all=True,
+                            fields=['Id', 'Names'])
+        assert len(res) is 1
+        assert res[0] == {'Id': TEST_CONTAINER_ID,
+                          'Names': ['/' + TEST_CONTAINER_NAME]}
+        
+        # quiet rows only have the ids
+        with raises(ValueError):
+            ws.containers(TEST_CONTAINER_NAME, quiet=True)
+        with raises(ValueError):
+            ws.containers(raw=True, quiet=True, fields=['Id'])
+        with raises(ValueError):
+            ws.iter_images(TEST_IMAGE_ID, quiet=True)
+
+    def test_iter_containers(self):
+        it = ws.iter_containers(TEST_CONTAINER_NAME, all=True)
+        ctn = ws.first(it)
+        assert isinstance(ctn, ws.Container)
+        assert ctn.long_id == TEST_CONTAINER_ID
+        assert ws.first(ws.iter_containers('***', all=True)) is None
+        
+        res = list(ws.iter_containers(all=True, raw=True, limit=1))
+        assert len(res) is 1
+        assert list(ws.iter_containers(all=True, limit=0)) == []
+    
+    def test_iter_images(self):
+        img = ws.first(ws.iter_images(TEST_IMAGE_NAME))
+        assert isinstance(img, ws.Image)
+        assert img.long_id == TEST_IMAGE_ID
+        
+        res = list(ws.iter_images(TEST_IMAGE_ID, raw=True, fields=['Id']))
+        assert res == [{'Id': TEST_IMAGE_ID}]
+    
+    def test_disk_cache(self):
+        path = tempfile.mkdtemp() + '/metadata.sqlite'
+        cache = ws.enable_disk_cache(path)
+        try:
+            assert ws.disk_cache is cache
+            img = ws.Image(TEST_IMAGE_ID)
+            assert img.inspect() == img.inspect()
+            assert img.history() == img.history()
+            assert cache.hits >= 2
+            
+            ctn = ws.Container(TEST_CONTAINER_ID)
+            hits = cache.hits
+            ctn._check_status()
+            assert cache.hits == hits + 1
+            assert ctn.inspect()['Id'] == TEST_CONTAINER_ID
+            
+            # a new process starts warm
+            cache = ws.enable_disk_cache(path)
+            assert cache.get_image(TEST_IMAGE_ID, 'inspect') is not None
+            # nothing changed, nothing gets dropped
+            assert cache.validate() is 0
+        finally:
+            ws.disable_disk_cache()
+        assert ws.disk_cache is None
+        os.remove(path)
 
     def test_info(self):
         res = ws.info()
         assert 'ExecutionDriver' in res.keys()
 
+    def test_inspect_many(self):
+        res = ws.inspect_many([TEST_CONTAINER_ID, TEST_CONTAINER_NAME])
+        assert list(res.keys()) == [TEST_CONTAINER_ID]
+        assert 'Config' in res[TEST_CONTAINER_ID]
+        
+        res = ws.inspect_many([TEST_CONTAINER_NAME],
+                              fields=['Name', 'State.Running'])
+        assert res[TEST_CONTAINER_ID] == {
+            'Name': '/' + TEST_CONTAINER_NAME,
+            'State': {'Running': False}
+        }
+        
+        with raises(ws.WhalesnakeError):
+            ws.inspect_many([TEST_CONTAINER_ID, 'non_existing_container'])
+        res = ws.inspect_many([TEST_CONTAINER_ID, 'non_existing_container'],
+                              ignore_errors=True)
+        assert len(res) is 1
+
     def test_ps(self):
         res = ws.ps()
         assert isinstance(res, list)
@@ -326,6 +418,41 @@ class Test_general_docker_commands:
         assert res[0]['star_count'] >= 1
         assert res[0]['is_trusted'] is True
 
+    def test_search_cached(self):
+        # local stand-in for the registry
+        queries = []
+        def fake_search(term):
+            queries.append(term)
+            return [
+                {'name': term + str(n), 'star_count': n,
+                 'is_official': False, 'is_trusted': n % 2 == 0}
+                for n in range(10)
+            ]
+        search = ws.dc.search
+        ws.dc.search = fake_search
+        ws.search_cache.clear()
+        try:
+            res = ws.search('whalesnake', top=3, fields=['name'])
+            assert res == [{'name': 'whalesnake9'}, {'name': 'whalesnake8'},
+                           {'name': 'whalesnake7'}]
+            res = ws.search('whalesnake', sort=True, automated=True)
+            assert [r['star_count'] for r in res] == [8, 6, 4, 2, 0]
+            # changing results doesn't change the cached ones
+            res[0]['star_count'] = -1
+            res = ws.search('whalesnake', sort=True, automated=True)
+            assert res[0]['star_count'] == 8
+            assert queries == ['whalesnake']
+            ws.search('whalesnake', cache=False)
+            assert queries == ['whalesnake', 'whalesnake']
+            
+            res = ws.search_many(['a', 'b', 'whalesnake'], top=1)
+            assert res['a'][0]['name'] == 'a9'
+            assert res['b'][0]['name'] == 'b9'
+            assert sorted(queries) == ['a', 'b', 'whalesnake', 'whalesnake']
+        finally:
+            ws.dc.search = search
+            ws.search_cache.clear()
+
     def test_version(self):
         res = ws.version()
         assert 'Arch' in res.keys()
@@ -394,6 +521,40 @@ class Test_Container:
         s = 'Container with name "{0}"'.format('non_existing_container')
         assert str(ctn) == s
     
+    def test_attach(self):
+        ctn = ws.Container('whalesnake_test_ctn12')
+        ctn.run(TEST_IMAGE_ID, 'sh -c "echo out; echo err >&2; sleep 999"')
+        session = ctn.attach(logs=True, timeout=2).wait()
+        assert session.timed_out is True
+        assert session.stdout == b'out\n'
+        assert session.stderr == b'err\n'
+        ctn.stop(timeout=0)
+        
+        with raises(ws.WhalesnakeError):
+            ctn.attach()
+    
+    def test_copy(self):
+        ctn = ws.Container(TEST_CONTAINER_ID)
+        td = tempfile.mkdtemp()
+        res = ctn.copy('/etc', td, include='etc/passwd')
+        assert res == ['etc/passwd']
+        assert os.path.isfile(td + '/etc/passwd')
+        os.remove(td + '/etc/passwd')
+        os.rmdir(td + '/etc')
+        os.rmdir(td)
+        
+        names = [m.name for m, f in ctn.copy('/etc', exclude='etc/passwd')]
+        assert 'etc' in names
+        assert 'etc/passwd' not in names
+        
+        for member, fileobj in ctn.copy('/etc/passwd'):
+            assert member.name == 'passwd'
+            assert fileobj.read().startswith(b'root:')
+        
+        ctn = ws.Container('non_existing_container')
+        with raises(ws.WhalesnakeError):
+            ctn.copy('/etc')
+    
     def test_create(self):
         ctn = ws.Container('whalesnake_test_ctn2')
         res = ctn.create(TEST_IMAGE_ID, 'sleep 999')
@@ -444,6 +605,45 @@ class Test_Container:
         ctn = ws.Container(TEST_CONTAINER_ID)
         assert isinstance(ctn.diff(), list)
     
+    def test_diff_incremental(self):
+        ctn = ws.Container('whalesnake_test_ctn11')
+        ctn.run(TEST_IMAGE_ID, 'sh -c "mkdir -p /var/log && sleep 999"')
+        time.sleep(1)
+        res = ctn.diff(incremental=True)
+        assert {'Path': '/var/log', 'Kind': 0} in res['added'] \
+            or {'Path': '/var/log', 'Kind': 1} in res['added']
+        assert res['removed'] == []
+        # nothing happened since the last call
+        res = ctn.diff(incremental=True)
+        assert res == {'added': [], 'removed': []}
+        
+        tracker = ws.DiffTracker(ctn)
+        tracker.update()
+        assert tracker.changed_under('/var/log')[0]['Path'] == '/var/log'
+        assert tracker.summary()['total'] == len(ctn.diff())
+        ctn.stop(timeout=0)
+    
+    def test_exec_run(self):
+        ctn = ws.Container('whalesnake_test_ctn13')
+        ctn.run(TEST_IMAGE_ID, 'sleep 999')
+        session = ctn.exec_run('sh -c "echo out; echo err >&2; exit 3"')
+        assert session.stdout == b'out\n'
+        assert session.stderr == b'err\n'
+        assert session.exit_code == 3
+        assert session.timed_out is False
+        
+        session = ctn.exec_run(['sleep', '10'], timeout=1)
+        assert session.timed_out is True
+        assert session.exit_code is None
+        
+        res = ws.exec_many([ctn], 'echo ok', timeout=5)
+        assert res[ctn.long_id].stdout == b'ok\n'
+        assert res[ctn.long_id].exit_code == 0
+        ctn.stop(timeout=0)
+        
+        with raises(ws.WhalesnakeError):
+            ctn.exec_run('true')
+    
     def test_export(self):
         ctn = ws.Container(TEST_CONTAINER_ID)
         td = tempfile.gettempdir()
@@ -469,6 +669,34 @@ class Test_Container:
         #assert isinstance(ctn.logs(), basestring)
         assert ctn.logs() == b''
     
+    def test_pause_unpause(self):
+        ctn = ws.Container('whalesnake_test_ctn15')
+        ctn.run(TEST_IMAGE_ID, 'sleep 999')
+        ctn.pause()
+        assert ctn.paused is True
+        with raises(ws.WhalesnakeError):
+            ctn.pause()
+        ctn.unpause()
+        assert ctn.paused is False
+        with raises(ws.WhalesnakeError):
+            ctn.unpause()
+        
+        ctn2 = ws.Container('whalesnake_test_ctn16')
+        ctn2.run(TEST_IMAGE_ID, 'sleep 999')
+        res = ws.pause_many([ctn, ctn2])
+        assert sorted(res.keys()) == sorted([ctn.long_id, ctn2.long_id])
+        assert ctn.paused is True
+        assert ws.Container(ctn2.long_id).paused is True
+        ws.unpause_many([ctn, ctn2])
+        assert ws.Container(ctn2.long_id).paused is False
+        
+        # a failing pause rolls back the others
+        with raises(ws.WhalesnakeError):
+            ws.pause_many([ctn, TEST_CONTAINER_ID])
+        assert ws.Container(ctn.long_id).paused is False
+        ctn.stop(timeout=0)
+        ctn2.stop(timeout=0)
+    
     def test_port(self):
         port_bindings = {
             1111: ('127.0.0.1', '4567'),
@@ -545,6 +773,29 @@ class Test_Container:
         with raises(ws.WhalesnakeError):
             ctn.remove()
     
+    def test_stats(self):
+        ctn = ws.Container('whalesnake_test_ctn10')
+        ctn.run(TEST_IMAGE_ID, 'sleep 999')
+        sample = ctn.stats(stream=False)
+        assert sample['cpu_percent'] >= 0
+        assert sample['mem_usage'] > 0
+        assert 'net_rx_delta' in sample
+        
+        samples = ctn.stats()
+        assert 'blk_write' in next(samples)
+        samples.close()
+        
+        monitor = ws.stats_all([ctn], window=5)
+        time.sleep(4)
+        assert monitor.stop() is True
+        summary = monitor.summary()
+        assert summary[ctn.long_id]['mem_usage']['last'] > 0
+        assert not monitor.errors
+        ctn.stop(timeout=0)
+        
+        with raises(ws.WhalesnakeError):
+            ctn.stats()
+    
     def test_top(self):
         ctn = ws.Container('whalesnake_test_ctn7')
         cmd = 'sleep 999'
@@ -576,6 +827,19 @@ class Test_Container:
         assert ctn.running is True
         ctn.stop(timeout=0)
         
+        # fast path: by reference, state from the responses
+        ctn = ws.Container('whalesnake_test_ctn14')
+        ctn.run(TEST_IMAGE_NAME, 'sleep 999', fast=True)
+        assert ctn.exists is True
+        assert ctn.running is True
+        assert ctn.command == 'sleep 999'
+        assert TEST_IMAGE_NAME in ctn.image.names
+        assert ws.Container('whalesnake_test_ctn14').long_id == ctn.long_id
+        ctn.stop(timeout=0)
+        with raises(ws.WhalesnakeError):
+            ws.Container('whalesnake_test_ctn14').run(TEST_IMAGE_NAME,
+                                                      fast=True)
+        
         # try running with a non-existing image that also can NOT be pulled
         img = 'non_existent_image'
         ctn = ws.Container('whalesnake_test_ctn97')
@@ -584,6 +848,10 @@ class Test_Container:
         assert e.value.args[0].find('Unable to get image') is not -1
         assert ctn.exists is False
         assert ctn.running is False
+        with raises(ws.WhalesnakeError) as e:
+            ctn.run(img, 'sleep 999', fast=True)
+        assert e.value.args[0].find('Unable to get image') is not -1
+        assert ctn.exists is False
 
 
 
@@ -701,6 +969,83 @@ class Test_Image:
         img.remove(force=True)
         assert img.exists is False
     
+    def test_build_many(self):
+        # img6 is based on img5, img7 only on the test image
+        specs = [
+            {'name': 'whalesnake_test_img6',
+             'build_src': self.get_dockerfile('whalesnake_test_img5')[1],
+             'build_type': 'file'},
+            {'name': 'whalesnake_test_img5',
+             'build_src': self.get_dockerfile(TEST_IMAGE_NAME)[1],
+             'build_type': 'file'},
+            {'name': 'whalesnake_test_img7',
+             'build_src': self.get_dockerfile(TEST_IMAGE_NAME)[1],
+             'build_type': 'file'},
+        ]
+        reports = ws.build_many(specs, concurrency=2)
+        try:
+            names = list(reports.keys())
+            assert len(names) is 3
+            assert names.index('whalesnake_test_img5:latest') < \
+                names.index('whalesnake_test_img6:latest')
+            report = reports['whalesnake_test_img6:latest']
+            assert report['error'] is None
+            assert report['base'] == ['whalesnake_test_img5:latest']
+            assert report['image'].exists is True
+            assert report['image'].parent_id is not None
+            assert report['steps'] >= 3
+            assert report['seconds'] > 0
+            
+            # same Dockerfiles again: everything comes from the cache
+            stats = ws.BuildStats()
+            stats.add_many(reports)
+            for spec in specs:
+                spec['build_src'].seek(0)
+            reports = ws.build_many(specs, concurrency=2)
+            for report in reports.values():
+                assert report['cache_hits'] >= 2
+            stats.add_many(reports)
+            assert stats.builds is 6
+            assert stats.hit_rate() >= 0.5
+        finally:
+            for name in ('6', '5', '7'):
+                ws.Image('whalesnake_test_img' + name).remove()
+        
+        # a failing base takes the images based on it along
+        specs = [
+            {'name': 'whalesnake_test_img8', 'from': ['whalesnake_test_img9'],
+             'build_src': self.get_dockerfile('whalesnake_test_img9')[1],
+             'build_type': 'file'},
+            {'name': 'whalesnake_test_img9',
+             'build_src': self.get_dockerfile('***')[1],
+             'build_type': 'file'},
+        ]
+        with raises(ws.WhalesnakeError):
+            ws.build_many(specs)
+        reports = ws.build_many(specs, ignore_errors=True)
+        assert reports['whalesnake_test_img8:latest']['error'] is not None
+        assert reports['whalesnake_test_img8:latest']['image'] is None
+    
+    def test_from_refs(self):
+        df = '# comment\nFROM golang:1.3 AS build\nRUN make\n' + \
+             'from corp/app\nFROM build\nFROM scratch\n'
+        assert ws._from_refs(df) == ['golang:1.3', 'corp/app:latest']
+        # not ours to check
+        df = 'FROM registry:5000/x\nFROM ${BASE}\n' + \
+             'FROM --platform=linux/amd64 busybox AS b\nFROM b\n'
+        assert ws._from_refs(df) == ['busybox:latest']
+    
+    def test_read_dockerfile(self):
+        context = io.BytesIO()
+        tar = tarfile.open(mode='w', fileobj=context)
+        info = tarfile.TarInfo(name='./Dockerfile')
+        info.size = 12
+        tar.addfile(tarinfo=info, fileobj=io.BytesIO(b'FROM busybox'))
+        tar.close()
+        context.seek(0)
+        assert ws._read_dockerfile(context, 'tar') == 'FROM busybox'
+        assert context.tell() == 0
+    
     def test_build(self):
         # test with:
         # url, github-url
@@ -719,6 +1064,10 @@ class Test_Image:
         img = ws.Image('whalesnake_test_img3')
         img.build(f_obj, 'file', quiet=True)
         assert img.exists is True
+        assert [step.number for step in img.build_report] == [0, 1, 2]
+        assert img.build_report[2].instruction.startswith('RUN echo')
+        assert img.build_report[2].layer == img.short_id
+        assert img.build_report[2].size is not None
         d = datetime.datetime.now() - datetime.timedelta(seconds=60)
         assert img.created > d
         assert isinstance(img.build_log, basestring)
@@ -792,6 +1141,24 @@ class Test_Image:
         with raises(ws.WhalesnakeError):
             img.history()
     
+    def test_layers(self):
+        img = ws.Image(TEST_IMAGE_NAME)
+        layers = img.layers()
+        assert layers[0].id == TEST_IMAGE_ID
+        assert isinstance(layers[0].created, datetime.datetime)
+        assert len(layers) == len(img.history())
+        
+        # shared by all instances, no matter how they were created
+        assert (TEST_IMAGE_ID, 'layers') in ws.image_cache
+        assert ws.Image(TEST_IMAGE_ID).layers() == layers
+        ins = img.inspect()
+        ins['modified'] = True
+        assert 'modified' not in ws.Image(TEST_IMAGE_ID).inspect()
+        
+        img = ws.Image('non_existing_image')
+        with raises(ws.WhalesnakeError):
+            img.layers()
+    
     def test_inspect(self):
         img = ws.Image(TEST_IMAGE_NAME)
         ins = img.inspect()
@@ -802,6 +1169,65 @@ class Test_Image:
         with raises(ws.WhalesnakeError):
             img.inspect()
     
+    def test_image_graph(self):
+        f_size, f_obj = self.get_dockerfile(TEST_IMAGE_NAME)
+        img = ws.Image('whalesnake_test_img10')
+        img.build(f_obj, 'file')
+        
+        graph = ws.ImageGraph()
+        assert graph.parent(img.long_id) == img.parent_id
+        assert img.long_id in graph.children(img.parent_id)
+        assert TEST_CONTAINER_ID in graph.containers(TEST_IMAGE_ID)
+        assert 'whalesnake_test_img10:latest' in graph.tags(img.long_id)
+        assert graph.is_garbage(img.long_id) is False
+        assert graph.is_garbage(TEST_IMAGE_ID) is False
+        
+        # untagged, the build result and its own layers become garbage
+        ws.dc.remove_image(img.long_id, noprune=True)
+        graph.refresh()
+        assert graph.reclaimable() >= 0
+        res = ws.image_gc(dry_run=True)
+        assert set(res['removed']) == graph.garbage()
+        res = ws.image_gc()
+        assert not res['failed']
+        assert not ws.ImageGraph().garbage()
+        assert ws.Image(TEST_IMAGE_ID).exists is True
+    
+    def test_retag(self):
+        f_size, f_obj = self.get_dockerfile(TEST_IMAGE_NAME)
+        img = ws.Image('whalesnake_test_img11')
+        img.build(f_obj, 'file')
+        
+        res = ws.retag({
+            'whalesnake_test_rt1': 'whalesnake_test_img11',
+            'whalesnake_test_namespace/rt:2': img.long_id,
+        })
+        assert sorted(res[img.long_id]) == [
+            'whalesnake_test_img11:latest',
+            'whalesnake_test_namespace/rt:2',
+            'whalesnake_test_rt1:latest',
+        ]
+        res = ws.retag({'whalesnake_test_rt3:x': img.long_id},
+                       remove=['whalesnake_test_rt1',
+                               'whalesnake_test_namespace/rt:2'])
+        assert sorted(res[img.long_id]) == [
+            'whalesnake_test_img11:latest',
+            'whalesnake_test_rt3:x',
+        ]
+        
+        # everything is validated before anything is sent
+        with raises(ValueError):
+            ws.retag({'whalesnake_test_rt4': img.long_id,
+                      'whalesnake_test_rt5': 'non_existing_image'})
+        with raises(ws.WhalesnakeError):
+            ws.retag({'whalesnake_test_rt3:x': TEST_IMAGE_ID})
+        with raises(ws.WhalesnakeError):
+            ws.retag({}, remove=['whalesnake_test_img11',
+                                 'whalesnake_test_rt3:x'])
+        assert 'whalesnake_test_rt4:latest' not in ws.Image(img.long_id).names
+        
+        img.remove(force=True)
+    
     def test_tag_untag(self):
         f_size, f_obj = self.get_dockerfile(TEST_IMAGE_NAME)
         
@@ -875,7 +1301,965 @@ class Test_Image:
         img2 = ws.Image('non_existing_image')
         with raises(ws.WhalesnakeError):
             img2.untag()
+
+
+
+class Test_RingBuffer:
+    
+    def test_overwrite(self):
+        buf = ws.RingBuffer(3)
+        assert len(buf) is 0
+        assert buf.last() is None
+        for v in range(5):
+            buf.append(v)
+        assert len(buf) is 3
+        assert list(buf) == [2.0, 3.0, 4.0]
+        assert buf.last() == 4.0
+        assert buf.mean() == 3.0
+        assert buf.max() == 4.0
         
+        with raises(ValueError):
+            ws.RingBuffer(0)
+
+
+
+class Test_pmap:
+    
+    def test_items_and_order(self):
+        def slow_square(x):
+            if x == 3:
+                raise ValueError(x)
+            time.sleep(0.01 * (5 - x))
+            return x * x
+        res = ws._pmap(slow_square, range(6), concurrency=6)
+        # func gets the items, results keep their order
+        assert [item for item, _, _ in res] == list(range(6))
+        assert [r for _, r, _ in res] == [0, 1, 4, None, 16, 25]
+        assert isinstance(res[3][2], ValueError)
+        assert ws._pmap(lambda s: s.upper(), ['x', 'y']) == [
+            ('x', 'X', None), ('y', 'Y', None)
+        ]
+
+
+class Test_PathTrie:
+    
+    def test_add_remove(self):
+        trie = ws.PathTrie()
+        trie.add('/var', 0)
+        trie.add('/var/log/syslog', 1)
+        trie.add('/tmp', 2)
+        assert len(trie) is 3
+        assert '/var/log/syslog' in trie
+        assert '/var/log' not in trie
+        assert trie.get('/tmp') == 2
+        assert list(trie) == ['/tmp', '/var', '/var/log/syslog']
+        assert list(trie.items('/var/log')) == [('/var/log/syslog', 1)]
+        assert trie.count('/var') is 2
+        
+        trie.remove('/var/log/syslog')
+        assert len(trie) is 2
+        assert trie.count('/var/log') is 0
+        with raises(KeyError):
+            trie.remove('/var/log')
+
+
+
+class Test_StreamDemuxer:
+    
+    def frame(self, stream, data):
+        return struct.pack('>BxxxL', stream, len(data)) + data
+    
+    def test_split_frames(self):
+        demux = ws.StreamDemuxer()
+        stream = self.frame(1, b'out') + self.frame(2, b'err') + \
+                 self.frame(1, b'more')
+        # feed byte by byte, frames must be reassembled
+        for i in range(len(stream)):
+            demux.feed(stream[i:i + 1])
+        assert demux.stdout == b'outmore'
+        assert demux.stderr == b'err'
+        
+        demux = ws.StreamDemuxer(tty=True)
+        demux.feed(b'raw')
+        assert demux.stdout == b'raw'
+    
+    def test_run_sessions_high_fds(self):
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < 2048:
+            if hard != resource.RLIM_INFINITY and hard < 2048:
+                skip('Needs to open more than 1024 files')
+            resource.setrlimit(resource.RLIMIT_NOFILE, (2048, hard))
+        # push the session sockets beyond what select() can handle
+        fillers = [socket.socket() for _ in range(1100)]
+        try:
+            pairs = [socket.socketpair() for _ in range(3)]
+            assert pairs[0][0].fileno() >= 1024
+            sessions = [ws.StreamSession(ours, timeout=5)
+                        for ours, theirs in pairs]
+            for i, (ours, theirs) in enumerate(pairs):
+                theirs.sendall(self.frame(1, str(i).encode('ascii')))
+                theirs.close()
+            # a silent one runs into its deadline
+            silent, peer = socket.socketpair()
+            sessions.append(ws.StreamSession(silent, timeout=0.2))
+            ws.run_sessions(sessions)
+            assert [s.stdout for s in sessions] == [b'0', b'1', b'2', b'']
+            assert sessions[-1].timed_out is True
+            peer.close()
+        finally:
+            for sock in fillers:
+                sock.close()
+
 
 
+class Test_Reconciler:
+    
+    def test_reconcile(self):
+        spec = {
+            'whalesnake_test_rec1': {
+                'image': TEST_IMAGE_NAME,
+                'command': 'sleep 999',
+            },
+            'whalesnake_test_rec2': {
+                'image': TEST_IMAGE_NAME,
+                # quoted, the listing shows it without the quotes
+                'command': 'sh -c "sleep 999"',
+                'start_conf': {'links': {'whalesnake_test_rec1': 'rec1'}},
+            },
+            'whalesnake_test_rec3': {
+                'image': TEST_IMAGE_NAME,
+                'running': False,
+            },
+        }
+        plan = ws.reconcile(spec, dry_run=True)
+        assert plan.index(('create', 'whalesnake_test_rec1')) < \
+               plan.index(('create', 'whalesnake_test_rec2'))
+        
+        res = ws.reconcile(spec)
+        assert not res['failed']
+        assert not res['failed_pulls']
+        assert ws.Container('whalesnake_test_rec2').running is True
+        assert ws.Container('whalesnake_test_rec3').exists is True
+        assert ws.Container('whalesnake_test_rec3').running is False
+        # nothing left to do
+        assert ws.reconcile(spec, dry_run=True) == []
+        
+        spec['whalesnake_test_rec1']['command'] = 'sleep 998'
+        del spec['whalesnake_test_rec3']
+        plan = ws.reconcile(spec, prune='whalesnake_test_rec*', dry_run=True)
+        assert ('recreate', 'whalesnake_test_rec1') in plan
+        # its link would point to the old container
+        assert ('recreate', 'whalesnake_test_rec2') in plan
+        assert ('remove', 'whalesnake_test_rec3') in plan
+        ws.reconcile(spec, prune='whalesnake_test_rec*')
+        assert ws.Container('whalesnake_test_rec3').exists is False
+        
+        spec['whalesnake_test_rec1']['depends_on'] = ['whalesnake_test_rec2']
+        with raises(ws.WhalesnakeError):
+            ws.reconcile(spec)
+
 
+
+class Test_ContainerPool:
+    
+    def test_acquire(self):
+        pool = ws.ContainerPool(TEST_IMAGE_NAME, 'sleep 999', size=2,
+                                prefix='whalesnake_test_pool')
+        pool.fill()
+        assert len(pool) is 2
+        ctn = pool.acquire()
+        assert ctn.running is True
+        assert ws.Container(ctn.long_id).running is True
+        pool.release(ctn)
+        assert ws.Container(ctn.name).exists is False
+        
+        ctns = [pool.acquire() for _ in range(3)]
+        metrics = pool.metrics()
+        assert metrics['hits'] >= 2
+        assert metrics['hits'] + metrics['misses'] == 4
+        assert metrics['dispatch_ms']['max'] > 0
+        for ctn in ctns:
+            pool.release(ctn)
+        pool.close()
+        assert ws.containers('whalesnake_test_pool', all=True) == []
+    
+    def test_close_and_failures(self):
+        with connected(FakeDaemon(containers=0, images=1)) as daemon:
+            pool = ws.ContainerPool('fake/app0:latest', 'sleep 999', size=2,
+                                    prefix='whalesnake_test_fpool')
+            pool.fill()
+            
+            def fail(*args, **kwargs):
+                raise docker.errors.APIError('no', requests.Response())
+            start, ws.dc.start = ws.dc.start, fail
+            with raises(docker.errors.APIError):
+                pool.acquire()
+            ws.dc.start = start
+            # the failed one got removed
+            assert len(daemon.containers) is 1
+            
+            ctn = pool.acquire()
+            # refilling while closing: nothing is left behind
+            pool.close()
+            assert [c['Id'] for c in daemon.containers] == [ctn.long_id]
+            assert pool.metrics()['hits'] is 2
+    
+    def test_paused(self):
+        pool = ws.ContainerPool(TEST_IMAGE_NAME, 'sleep 999', size=1,
+                                paused=True, max_idle=1,
+                                prefix='whalesnake_test_ppool')
+        pool.fill()
+        idle = ws.containers('whalesnake_test_ppool', all=True)
+        assert idle[0].paused is True
+        ctn = pool.acquire()
+        assert ws.Container(ctn.long_id).paused is False
+        pool.release(ctn)
+        # the replacement gets evicted after max_idle
+        time.sleep(8)
+        assert pool.evicted >= 1
+        pool.close()
+
+
+
+class Test_LRUCache:
+    
+    def test_eviction(self):
+        cache = ws.LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        # 'b' was used least recently
+        assert 'b' not in cache
+        assert 'a' in cache
+        assert cache.get('b') is None
+        assert cache.hits is 1
+        assert cache.misses is 1
+    
+    def test_maxbytes(self):
+        cache = ws.LRUCache(maxbytes=100)
+        cache.set('a', 1, size=60)
+        cache.set('b', 2, size=30)
+        cache.set('c', 3, size=30)
+        assert 'a' not in cache
+        assert cache.bytes == 60
+        # too large to be cached at all
+        cache.set('d', 4, size=101)
+        assert 'd' not in cache
+        assert cache.bytes == 60
+        # nor is the old value kept
+        cache.set('b', 5, size=101)
+        assert 'b' not in cache
+        assert cache.bytes == 30
+    
+    def test_ttl(self):
+        cache = ws.LRUCache(ttl=0.1)
+        cache.set('a', 1)
+        assert cache.get('a') == 1
+        time.sleep(0.2)
+        assert cache.get('a', 'gone') == 'gone'
+
+
+class Test_layer_tags:
+    
+    def setup_method(self, method):
+        self.daemon = FakeDaemon(containers=0, images=2)
+        self.disconnect = connect(self.daemon)
+    
+    def teardown_method(self, method):
+        self.disconnect()
+    
+    def test_retag(self):
+        img = ws.Image('fake/app0:latest')
+        assert img.layers()[0].tags == ('fake/app0:latest', )
+        # retagged behind the cache's back
+        self.daemon.images[0]['RepoTags'] = ['fake/app0:v2']
+        assert img.layers()[0].tags == ('fake/app0:v2', )
+        # as cached, unless asked for
+        requests = self.daemon.requests
+        assert img.history()[0]['Tags'] == ['fake/app0:latest']
+        assert self.daemon.requests == requests
+        assert img.history(tags=True)[0]['Tags'] == ['fake/app0:v2']
+        assert img.layers(tags=False)[0].tags == ()
+
+
+class Test_iter_containers:
+    
+    def setup_method(self, method):
+        self.daemon = FakeDaemon(containers=3, images=1)
+        self.disconnect = connect(self.daemon)
+    
+    def teardown_method(self, method):
+        self.disconnect()
+    
+    def test_limit(self):
+        # the last created one is stopped
+        self.daemon.handle('POST', '/containers/fake_2/stop')
+        res = list(ws.iter_containers(raw=True, limit=1))
+        assert [row['Names'] for row in res] == [['/fake_0']]
+        res = list(ws.iter_containers(raw=True, all=True, limit=1))
+        assert [row['Names'] for row in res] == [['/fake_2']]
+
+
+
+class Test_iter_json_array:
+    
+    def test_chunks(self):
+        rows = [{'Id': str(i), 'Names': [u'/caf\xe9']} for i in range(100)]
+        data = json.dumps(rows).encode('utf-8')
+        for size in (1, 3, 64, len(data)):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            assert list(ws._iter_json_array(chunks)) == rows
+    
+    def test_empty(self):
+        assert list(ws._iter_json_array([b' [', b' ]'])) == []
+    
+    def test_scalars(self):
+        # a number is only complete, once something follows it
+        chunks = [b'[12', b'3, "a', b'b", tr', b'ue, 4', b'5', b']']
+        assert list(ws._iter_json_array(chunks)) == [123, 'ab', True, 45]
+    
+    def test_incomplete(self):
+        with raises(ValueError):
+            list(ws._iter_json_array([b'[{"Id": "1"}, {"Id"']))
+
+
+class Test_Fleet:
+    
+    def setup_method(self, method):
+        self.daemons = [FakeDaemon(containers=3).start() for _ in range(3)]
+        self.broken = FakeDaemon(fail=True).start()
+        self.slow = FakeDaemon(delay=2).start()
+        self.fleet = ws.Fleet([d.url for d in self.daemons] + [self.broken.url])
+    
+    def teardown_method(self, method):
+        for daemon in self.daemons + [self.broken, self.slow]:
+            daemon.stop()
+    
+    def test_containers(self):
+        rows = self.fleet.containers()
+        assert len(rows) is 9
+        assert set(row['Host'] for row in rows) == \
+            set(d.url for d in self.daemons)
+        assert list(self.fleet.errors.keys()) == [self.broken.url]
+        
+        rows = self.fleet.containers('fake_1', fields=['Id'])
+        assert len(rows) is 3
+        assert sorted(rows[0].keys()) == ['Host', 'Id']
+    
+    def test_images_info_ping(self):
+        assert len(self.fleet.images()) is 15
+        info = self.fleet.info()
+        assert list(info.keys()) == [d.url for d in self.daemons]
+        assert info[self.daemons[0].url]['Containers'] == 3
+        assert len(self.fleet.ping()) is 3
+    
+    def test_deadline(self):
+        fleet = ws.Fleet([self.daemons[0].url, self.slow.url], deadline=0.5)
+        start = time.time()
+        assert list(fleet.ping().keys()) == [self.daemons[0].url]
+        assert time.time() - start < 1.5
+        assert isinstance(fleet.errors[self.slow.url], ws.WhalesnakeError)
+    
+    def test_bulk(self):
+        rows = self.fleet.containers(hosts=[d.url for d in self.daemons])
+        assert self.fleet.stop(rows[:4]) == []
+        assert len(self.fleet.containers()) is 5
+        stopped = [row for row in self.fleet.containers(all=True)
+                   if row['Status'].startswith('Exited')]
+        assert len(stopped) is 4
+        
+        failed = self.fleet.remove(rows[:2] + [
+            {'Host': self.daemons[0].url, 'Id': 'missing'}
+        ])
+        assert len(failed) is 1
+        assert failed[0][0]['Id'] == 'missing'
+        assert len(self.fleet.containers(all=True)) is 7
+
+
+class Test_HealthMonitor:
+    
+    def setup_method(self, method):
+        self.daemon = FakeDaemon().start()
+        self.client = docker.Client(base_url=self.daemon.url, timeout=30)
+        self.monitor = ws.HealthMonitor(
+            self.client, interval=None, min_timeout=0.1, failures=3,
+            retries=2, backoff=0.01
+        )
+        self.monitor.install()
+    
+    def teardown_method(self, method):
+        self.monitor.uninstall()
+        self.daemon.stop()
+    
+    def test_adaptive_timeout(self):
+        assert self.monitor.timeout('/containers/json') == 30
+        for _ in range(10):
+            self.client.containers()
+        assert self.monitor.timeout('/containers/json') < 1
+        assert self.monitor.stats()['/containers/json']['samples'] is 10
+        
+        # slow daemon: the request times out and is retried
+        self.daemon.delay = 1
+        start = time.time()
+        with raises(requests.exceptions.RequestException):
+            self.client.containers()
+        assert time.time() - start < 3
+        assert self.monitor.retried is 2
+        assert not self.monitor.healthy
+    
+    def test_streams_keep_timeout(self):
+        for _ in range(10):
+            self.client.containers()
+        # as quiet as a followed log between two lines
+        self.daemon.delay = 0.5
+        res = self.client._get(self.client._url('/containers/json'),
+                               stream=True)
+        assert res.status_code == 200
+        assert self.monitor.retried is 0
+    
+    def test_circuit_breaker(self):
+        assert self.monitor.ping()
+        self.daemon.stop()
+        with raises(requests.exceptions.ConnectionError):
+            self.client.info()
+        assert self.monitor.consecutive_failures is 3
+        # fails fast now
+        with raises(ws.WhalesnakeError):
+            self.client.info()
+        assert self.monitor.rejected is 1
+        # pings still go through, to notice recovery
+        assert not self.monitor.ping()
+        self.daemon = FakeDaemon().start()
+
+
+class Test_LogStore:
+    
+    def setup_method(self, method):
+        self.store = ws.LogStore(tempfile.mkdtemp(), block_size=1024)
+        self.lines = [
+            (1400000000 * 10 ** 9 + i * 10 ** 7, 1,
+             'request {0} took {1}ms'.format(i, i % 97).encode('utf-8'))
+            for i in range(2000)
+        ]
+        self.lines.append((1400000100 * 10 ** 9, 2, b'ERROR disk full'))
+        self.store.append('ctn', self.lines)
+    
+    def teardown_method(self, method):
+        self.store.close()
+        shutil.rmtree(self.store.path)
+    
+    def test_search(self):
+        res = self.store.search('ctn', 'disk full')
+        assert len(res) is 1
+        assert res[0].stream is 2
+        assert res[0].time == datetime.datetime(2014, 5, 13, 16, 55)
+        assert self.store.search('ctn', 'DISK', ignore_case=True) == res
+        assert self.store.search('ctn', 'DISK') == []
+        
+        res = self.store.search('ctn', r'took 9[0-6]ms$', regex=True)
+        assert len(res) == len([l for l in self.lines
+                                if re.search(br'took 9[0-6]ms$', l[2])])
+        assert len(self.store.search('ctn', r'\x45RROR disk', regex=True)) is 1
+        assert len(self.store.search('ctn', 'took', limit=5)) is 5
+        since = datetime.datetime(2014, 5, 13, 16, 53, 39, 985000)
+        assert len(self.store.search('ctn', 'took', since=since)) is 1
+    
+    def test_persistence(self):
+        assert self.store.last('ctn') == self.lines[-1][0]
+        self.store.append('ctn', [(self.lines[-1][0] + 1, 1, b'bye')])
+        store = ws.LogStore(self.store.path)
+        assert len(store._load('ctn')) > 1
+        assert store.search('ctn', 'bye')[0].text == 'bye'
+        store.drop('ctn')
+        assert store.search('ctn', 'took') == []
+        assert store.last('ctn') is 0
+    
+    def test_non_ascii(self):
+        last = self.lines[-1][0]
+        self.store.append('ctn', [
+            (last + 1, 1, u'Menu: CAFÉ crème'.encode('utf-8')),
+            (last + 2, 1, u'Menu: café CRÈME'.encode('utf-8'))
+        ])
+        assert len(self.store.search('ctn', u'CAFÉ')) is 1
+        assert len(self.store.search('ctn', u'crème')) is 1
+        assert len(self.store.search('ctn', u'CAFÉ CRÈME',
+                                     ignore_case=True)) is 2
+    
+    def test_collect(self):
+        with connected(FakeDaemon(containers=1, images=1)) as daemon:
+            for i in range(3000):
+                daemon.log('fake_0', 'line {0}'.format(i), when=1400000000 + i)
+            ctn = ws.Container('fake_0')
+            assert self.store.collect(ctn) == 3000
+            assert self.store.collect(ctn) == 0
+            daemon.log('fake_0', 'the end')
+            assert self.store.collect(ctn) == 1
+            res = self.store.search(ctn.long_id, 'line 2999')
+            assert [line.text for line in res] == ['line 2999']
+    
+    def test_log_frames(self):
+        frames = b''.join(
+            struct.pack('>BxxxL', stream, len(text)) + text
+            for stream, text in [(1, b'out\n'), (2, b'err\n'), (1, b'x')]
+        )
+        # split anywhere, also within headers
+        chunks = [frames[i:i + 3] for i in range(0, len(frames), 3)]
+        assert list(ws._log_frames(chunks)) == [
+            (1, b'out\n'), (2, b'err\n'), (1, b'x')
+        ]
+        assert list(ws._log_frames([b'a\nb', b'c\nd'], tty=True)) == [
+            (1, b'a\n'), (1, b'bc\n'), (1, b'd')
+        ]
+    
+    def test_regex_literals(self):
+        assert ws._regex_literals('foo.*bar') == ['foo', 'bar']
+        assert ws._regex_literals('colou?r') == ['colo', 'r']
+        assert ws._regex_literals('(a|b)xyz') == []
+        assert ws._regex_literals(r'[)]abc\.d') == ['abc.d']
+        # escapes with an argument end the literal and take it along
+        assert ws._regex_literals(r'\x41BC') == ['BC']
+        assert ws._regex_literals(r'\101BC') == ['BC']
+        assert ws._regex_literals(r'(a)\1BC') == ['BC']
+        assert ws._regex_literals(r'x\u0041yz\N{DASH}w') == ['x', 'yz', 'w']
+
+
+TOP_TITLES = ['USER', 'PID', '%CPU', '%MEM', 'VSZ', 'RSS', 'TTY', 'STAT',
+              'START', 'TIME', 'COMMAND']
+
+def top_row(pid, cpu, rss, command):
+    return ['root', str(pid), str(cpu), '0.5', '2000', str(rss), '?', 'S',
+            '10:00', '0:01', command]
+
+
+class Test_TopSampler:
+    
+    class FakeContainer(ws.Container):
+        # answers top() from a list of process tables, one per sample
+        def __init__(self, long_id, tables):
+            self.long_id = long_id
+            self.name = long_id
+            self.tables = tables
+        
+        def top(self, ps_args=None, parsed=False):
+            raw = {'Titles': TOP_TITLES, 'Processes': self.tables.pop(0)}
+            return ws._parse_top(raw) if parsed else raw
+    
+    def test_parse_top(self):
+        procs = ws._parse_top({
+            'Titles': TOP_TITLES + ['WCHAN'],
+            'Processes': [top_row(42, 12.5, 100, 'redis-server') + ['-']]
+        })
+        assert len(procs) is 1
+        assert procs[0].pid is 42
+        assert procs[0].cpu == 12.5
+        assert procs[0].rss == 100 * 1024
+        assert procs[0].command == 'redis-server'
+        assert procs[0].ppid is None
+        assert procs[0].other['WCHAN'] == '-'
+    
+    def test_sample_and_top(self):
+        a = self.FakeContainer('a', [
+            [top_row(1, 1.0, 100, 'init'), top_row(2, 50.0, 200, 'worker')],
+            [top_row(1, 1.0, 100, 'init'), top_row(2, 90.0, 900, 'worker')],
+        ])
+        b = self.FakeContainer('b', [
+            [top_row(1, 70.0, 300, 'server')],
+            [top_row(1, 10.0, 300, 'server'), top_row(7, 5.0, 50, 'cron')],
+        ])
+        sampler = ws.TopSampler([a, b], window=10)
+        sampler.sample()
+        sampler.sample()
+        assert sampler.samples is 2
+        assert sampler.top(1) == [(90.0, 'a', 2, 'worker')]
+        assert [p[2:] for p in sampler.top(2, mean=True)] == \
+            [(2, 'worker'), (1, 'server')]
+        assert sampler.top(1, field='rss')[0][0] == 900 * 1024
+        assert len(sampler.top(10)) is 4
+        with raises(ValueError):
+            sampler.top(field='threads')
+
+
+class Test_BuildStats:
+    
+    def test_build_steps(self):
+        steps = ws._build_steps([
+            ('Step 0 : FROM busybox\n', 0.0),
+            (' ---> 0123456789ab\n', 0.1),
+            ('Step 1 : RUN apt-get update\n', 0.5),
+            (' ---> Using cache\n', 0.6),
+            (' ---> 1111111111aa\n', 0.7),
+            ('Step 2/3 : ADD . /src\n', 1.0),
+            (' ---> 2222222222bb\n', 2.0),
+            ('Removing intermediate container 01234\nStep 3/3 : RUN make\n',
+             2.5),
+            (' ---> 3333333333cc\n', 4.0),
+            ('Successfully built 3333333333cc\n', 4.5),
+        ])
+        assert [step.number for step in steps] == [0, 1, 2, 3]
+        assert steps[1].cached is True
+        assert steps[1].layer == '1111111111aa'
+        assert steps[2].instruction == 'ADD . /src'
+        assert steps[2].cached is False
+        assert steps[3].seconds == 2.0
+    
+    def test_aggregate(self):
+        def build(*cached):
+            return [ws.BuildStep(0, 'FROM busybox', 0.1, False, None, None)] + [
+                ws.BuildStep(i + 1, 'RUN step{0}'.format(i), 1.0, c, None, None)
+                for i, c in enumerate(cached)
+            ]
+        stats = ws.BuildStats()
+        stats.add(build(True, False, False), 'a')
+        stats.add(build(True, False, False), 'b')
+        stats.add(build(True, True, False), 'a')
+        assert stats.builds is 3
+        assert stats.hit_rate() == 4 / 9.
+        top = stats.steps(top=1)
+        assert top[0]['instruction'] == 'RUN step1'
+        assert top[0]['busted'] is 2
+        assert top[0]['images'] == ['a', 'b']
+        assert stats.steps(sort='uncached_seconds')[0]['instruction'] == \
+            'RUN step2'
+        with raises(ValueError):
+            stats.steps(sort='size')
+
+
+class Test_Snapshot:
+    
+    def setup_method(self, method):
+        self.daemon = FakeDaemon(containers=20, images=5)
+        # point the module at the fake daemon
+        self.disconnect = connect(self.daemon)
+    
+    def teardown_method(self, method):
+        self.disconnect()
+    
+    def test_diff(self):
+        prev = ws.Snapshot.take()
+        assert len(prev.containers) is 20
+        assert len(prev.images) is 5
+        
+        ctns = self.daemon.containers
+        # uptime only, not a change
+        ctns[0]['Status'] = 'Up 6 minutes'
+        ctns[1]['Status'] = 'Exited (0) 1 seconds ago'
+        removed = ctns.pop(2)
+        # not part of the state, but of the row
+        ctns[2]['Labels'] = {'Status': 'Up 2 minutes'}
+        self.daemon.images[0]['RepoTags'].append('fake/app0:v2')
+        
+        curr = ws.Snapshot.take(prev=prev)
+        # unchanged rows are taken over
+        assert curr.containers[ctns[0]['Id']] is prev.containers[ctns[0]['Id']]
+        delta = ws.Snapshot.diff(prev, curr)
+        assert list(delta['containers'].removed.keys()) == [removed['Id']]
+        assert sorted(delta['containers'].changed.keys()) == \
+            sorted([ctns[1]['Id'], ctns[2]['Id']])
+        old, new = delta['containers'].changed[ctns[1]['Id']]
+        assert new['Status'].startswith('Exited')
+        assert delta['containers'].added == {}
+        assert len(delta['images'].changed) is 1
+        
+        # the same, no matter which process took them
+        row = self.daemon.images[1]
+        assert curr._images_hashes[row['Id']] == (
+            zlib.crc32(json.dumps(row).encode('utf-8')) & 0xffffffff,
+            len(json.dumps(row).encode('utf-8')))
+        
+        # only kinds taken in both are compared
+        delta = ws.Snapshot.diff(curr, ws.Snapshot.take(images=False))
+        assert list(delta.keys()) == ['containers']
+    
+    def test_watch(self):
+        def remove_one():
+            time.sleep(0.3)
+            self.daemon.containers.pop()
+        threading.Thread(target=remove_one).start()
+        # the first snapshot is taken right away, before the change
+        delta = next(ws.watch(interval=0.1, images=False))
+        assert list(delta.keys()) == ['containers']
+        assert len(delta['containers'].removed) is 1
+
+
+class Test_PortIndex:
+    
+    def setup_method(self, method):
+        self.daemon = FakeDaemon(containers=4, images=1)
+        ctns = self.daemon.containers
+        ctns[0]['Ports'] = [
+            {'PrivatePort': 80, 'PublicPort': 8080, 'Type': 'tcp',
+             'IP': '0.0.0.0'},
+            {'PrivatePort': 53, 'PublicPort': 5353, 'Type': 'udp',
+             'IP': '127.0.0.1'},
+            {'PrivatePort': 443, 'Type': 'tcp'}
+        ]
+        ctns[1]['Ports'] = [
+            {'PrivatePort': 80, 'PublicPort': 8081, 'Type': 'tcp',
+             'IP': '10.0.0.1'}
+        ]
+        self.disconnect = connect(self.daemon)
+    
+    def teardown_method(self, method):
+        self.disconnect()
+    
+    def test_index(self):
+        index = ws.PortIndex.take()
+        assert len(index) is 3
+        assert 8080 in index
+        owner, = index.owners(8080)
+        assert owner.name == 'fake_0'
+        assert owner.port == ws.Port(80, 8080, 'tcp', '0.0.0.0')
+        assert index.owners(5353) == []
+        assert index.owners(5353, 'udp')[0].port.ip == '127.0.0.1'
+        
+        assert index.host_ports('fake_0', 80) == [('0.0.0.0', 8080)]
+        assert index.host_ports('fake_0', 443) == []
+        assert ws.Port(443, None, 'tcp', None) in index.ports('fake_0')
+        
+        # bound to one interface only
+        assert index.conflicts(8081, ip='10.0.0.2') == []
+        assert len(index.conflicts(8081, ip='10.0.0.1')) is 1
+        assert len(index.conflicts(8081)) is 1
+        assert len(index.conflicts(8080, ip='10.0.0.2')) is 1
+        
+        index.remove('fake_0')
+        assert 8080 not in index
+        assert index.ports('fake_0') is None
+    
+    def test_container_port(self):
+        ctn = ws.Container('fake_0')
+        assert ctn.port_mappings[0] == ws.Port(80, 8080, 'tcp', '0.0.0.0')
+        before = self.daemon.requests
+        assert ctn.port(80) == [{'HostIp': '0.0.0.0', 'HostPort': '8080'}]
+        assert ctn.port('53') == [{'HostIp': '127.0.0.1', 'HostPort': '5353'}]
+        assert ctn.port(443) is None
+        assert ctn.port(22) is None
+        assert self.daemon.requests == before
+
+
+class Test_Placer:
+    
+    GiB = 1 << 30
+    
+    def setup_method(self, method):
+        self.daemons = [
+            FakeDaemon(containers=2, images=1, ncpu=2, mem_total=4 * self.GiB),
+            FakeDaemon(containers=1, images=1, ncpu=8, mem_total=16 * self.GiB)
+        ]
+        for ctn in self.daemons[0].containers:
+            ctn['Memory'] = 1 * self.GiB
+            ctn['CpuShares'] = 512
+        self.daemons[1].containers[0]['Memory'] = 14 * self.GiB
+        for d in self.daemons:
+            d.start()
+        self.urls = [d.url for d in self.daemons]
+        self.fleet = ws.Fleet(self.urls, timeout=5, version='1.16')
+    
+    def teardown_method(self, method):
+        for d in self.daemons:
+            d.stop()
+    
+    def test_place(self):
+        placer = ws.Placer(self.fleet)
+        placer.refresh()
+        host = placer.hosts[self.urls[0]]
+        assert host['used_mem'] == 2 * self.GiB
+        assert host['used_cpu'] == 1.0
+        # half of the first one is free, 1/8 of the second one
+        assert placer.place() == self.urls[0]
+        assert placer.place(cpu_shares=2048) == self.urls[1]
+        assert placer.place(mem_limit=self.GiB // 2) == self.urls[0]
+        
+        packer = ws.Placer(self.fleet, strategy='bin_pack')
+        assert packer.place() == self.urls[1]
+        with raises(ws.WhalesnakeError):
+            packer.place(mem_limit=5 * self.GiB)
+        
+        # no requests in between
+        requests = [d.requests for d in self.daemons]
+        placer.started(self.urls[0], 'new', mem_limit=2 * self.GiB)
+        assert placer.place() == self.urls[1]
+        placer.stopped('new')
+        assert placer.place() == self.urls[0]
+        assert [d.requests for d in self.daemons] == requests
+        
+        # limits are only inspected once
+        placer.refresh()
+        assert self.daemons[0].requests == requests[0] + 2
+    
+    def test_stats(self):
+        long_id = self.daemons[0].containers[0]['Id']
+        usage = {long_id: {'mem_usage': {'mean': 3 * self.GiB},
+                           'cpu_percent': {'mean': 10.0}}}
+        placer = ws.Placer(self.fleet, stats=usage)
+        placer.refresh()
+        assert placer.hosts[self.urls[0]]['used_mem'] == 4 * self.GiB
+        assert placer.place() == self.urls[1]
+    
+    def test_capacity_unknown(self):
+        # info() of older api versions has no MemTotal and NCPU
+        placer = ws.Placer(ws.Fleet(self.urls, timeout=5, version='1.14'))
+        with raises(ws.WhalesnakeError):
+            placer.place()
+        assert sorted(placer.errors) == sorted(self.urls)
+        assert placer.hosts == {}
+    
+    def test_run_start_fails(self):
+        placer = ws.Placer(self.fleet)
+        client = self.fleet.clients[self.urls[0]]
+        def fail(*args, **kwargs):
+            raise docker.errors.APIError('no', requests.Response())
+        client.start = fail
+        with raises(docker.errors.APIError):
+            placer.run('placed', 'fake/app0:latest')
+        assert self.daemons[0]._find('placed') is None
+        assert 'placed' not in placer.hosts[self.urls[0]]['containers']
+    
+    def test_run(self):
+        placer = ws.Placer(self.fleet)
+        url, long_id = placer.run('placed', 'fake/app0:latest', 'sleep 1',
+                                  create_conf={'mem_limit': self.GiB})
+        assert url == self.urls[0]
+        ctn = self.daemons[0]._find('placed')
+        assert ctn['Id'] == long_id
+        assert ctn['Running']
+        assert placer.hosts[url]['containers'][long_id] == (self.GiB, 0)
+        
+        placer.refresh()
+        assert placer.hosts[url]['used_mem'] == 3 * self.GiB
+
+
+class Test_copy_unsafe:
+    
+    def setup_method(self, method):
+        self.daemon = FakeDaemon(containers=1, images=1)
+        self.disconnect = connect(self.daemon)
+        self.dest = tempfile.mkdtemp()
+        self.outside = tempfile.mkdtemp()
+    
+    def teardown_method(self, method):
+        self.disconnect()
+        shutil.rmtree(self.dest)
+        shutil.rmtree(self.outside)
+    
+    def archive(self, *members):
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode='w')
+        for name, link in members:
+            info = tarfile.TarInfo(name)
+            if link is None:
+                info.size = 4
+                tar.addfile(info, io.BytesIO(b'evil'))
+            else:
+                info.type = tarfile.SYMTYPE
+                info.linkname = link
+                tar.addfile(info)
+        tar.close()
+        self.daemon.containers[0]['Archive'] = buf.getvalue()
+    
+    def test_links(self):
+        ctn = ws.Container('fake_0')
+        self.archive(('x', self.outside), ('x/evil', None))
+        with raises(ws.WhalesnakeError):
+            ctn.copy('/x', self.dest)
+        self.archive(('x', '../' + os.path.basename(self.outside)))
+        with raises(ws.WhalesnakeError):
+            ctn.copy('/x', self.dest)
+        assert os.listdir(self.outside) == []
+        
+        # links within dest are fine, also when copying twice
+        self.archive(('d/f', None), ('l', 'd/f'))
+        assert ctn.copy('/d', self.dest) == ['d/f', 'l']
+        assert ctn.copy('/d', self.dest) == ['d/f', 'l']
+        assert os.readlink(os.path.join(self.dest, 'l')) == 'd/f'
+
+
+class Test_container_version:
+    
+    def setup_method(self, method):
+        self.daemon = FakeDaemon(containers=1, images=1)
+        self.disconnect = connect(self.daemon)
+        self.path = tempfile.mkdtemp() + '/metadata.sqlite'
+        self.cache = ws.enable_disk_cache(self.path, validate=False)
+    
+    def teardown_method(self, method):
+        ws.disable_disk_cache()
+        shutil.rmtree(os.path.dirname(self.path))
+        self.disconnect()
+    
+    def test_status(self):
+        row = self.daemon.containers[0]
+        def version(status):
+            return ws._container_version(dict(row, Status=status))
+        assert version('Up 5 minutes') == version('Up About an hour')
+        assert version('Up 5 minutes') != version('Up 5 minutes (Paused)')
+        assert version('Exited (0) 2 seconds ago') != \
+            version('Exited (137) 2 seconds ago')
+        assert ws._status_age('Up Less than a second') == ('StartedAt', 1)
+        assert ws._status_age('Exited (0) About an hour ago') == \
+            ('FinishedAt', 7200)
+        assert ws._status_age('Created') is None
+    
+    def test_cache(self):
+        ctn = ws.Container('fake_0')
+        ctn._check_status()
+        assert self.cache.hits == 1
+        
+        # restarted in place, same version but not the same start
+        self.daemon.containers[0]['StartedAt'] = time.time()
+        self.daemon.containers[0]['Status'] = 'Up 2 seconds'
+        ctn._check_status()
+        assert self.cache.hits == 1
+        
+        # stopped behind its back, inspect() asks the daemon
+        self.daemon.handle('POST', '/containers/fake_0/stop')
+        assert ctn.inspect()['State']['Running'] is False
+        ctn._check_status()
+        assert ctn.running is False
+
+
+
+class Test_DiffTracker:
+    
+    def setup_method(self, method):
+        self.daemon = FakeDaemon(containers=1, images=1)
+        self.disconnect = connect(self.daemon)
+    
+    def teardown_method(self, method):
+        self.disconnect()
+    
+    def test_update(self):
+        changes = self.daemon.containers[0]['Changes']
+        changes.extend([{'Path': '/var', 'Kind': 0},
+                        {'Path': '/var/log', 'Kind': 1},
+                        {'Path': '/var/log/a', 'Kind': 1},
+                        {'Path': '/etc/x', 'Kind': 2}])
+        tracker = ws.DiffTracker('fake_0')
+        assert len(tracker.update()['added']) == 4
+        assert tracker.update() == {'added': [], 'removed': []}
+        
+        changes[2] = {'Path': '/var/log/a', 'Kind': 0}
+        del changes[3]
+        changes.append({'Path': '/var/log/b', 'Kind': 1})
+        res = tracker.update()
+        assert res['added'] == [{'Path': '/var/log/a', 'Kind': 0},
+                                {'Path': '/var/log/b', 'Kind': 1}]
+        assert res['removed'] == [{'Path': '/etc/x', 'Kind': 2},
+                                  {'Path': '/var/log/a', 'Kind': 1}]
+        assert tracker.changed_under('/var/log') == changes[1:]
+        assert len(tracker.snapshot) == 4
+        
+        # no exec in the fake daemon
+        asked = []
+        def sizes(paths):
+            asked.extend(paths)
+            return {'/var/log/a': 10, '/var/log/b': 5}
+        tracker._file_sizes = sizes
+        res = tracker.summary('/var', sizes=True)
+        assert asked == ['/var/log/a', '/var/log/b']
+        assert res['total'] == 4
+        assert (res['modified_size'], res['added_size'],
+                res['total_size']) == (10, 5, 15)
+        assert 'total_size' not in tracker.summary()
@@ -1,15 +1,48 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import copy
+import codecs
+import errno
+import zlib
+import time
+import uuid
+import random
+import heapq
+import array
+import shlex
+import select
+import shutil
+import string
+import socket
+import struct
+import sqlite3
+import fnmatch
+import tarfile
+import calendar
 import datetime
+import threading
+import collections
 
 try:
     import ujson as json
 except ImportError:
     import json
 
+# fastest decoder around, everything the daemon sends goes through it.
+# see _install_decoder()
+try:
+    from orjson import loads as _loads
+except ImportError:
+    _loads = json.loads
+
+# for its incremental raw_decode(), see _iter_json_array()
+import json as _stdjson
+
 import docker
+import requests
 
 # try to avoid using six for now
 try:
@@ -17,9 +50,20 @@ try:
 except NameError:
   basestring = str
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# python 2 has no selectors, see run_sessions()
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
 # missing in docker-py:
 # 'load', 'pause', 'save', 'unpause'
-# (un)pause seems rather easy to implement. see:
+# (un)pause is done with the low level client below (_pause, _unpause). see:
 # https://docs.docker.com/reference/api/docker_remote_api_v1.13/
 
 # also, the following parameters when creating/starting a container:
@@ -55,6 +99,21 @@ def connect(url='unix://var/run/docker.sock', latest=True, **kwargs):
         api_v = dc.version()['ApiVersion']
         #del kwargs['version']
         dc = docker.Client(base_url=url, version=api_v, **kwargs)
+    _install_decoder(dc)
+
+def _install_decoder(client):
+    '''
+    docker-py decodes responses with requests' json(), i.e. the standard
+    library. Have all of them decoded by _loads instead.
+    
+    '''
+    result = client._result
+    def decoded_result(response, json=False, binary=False):
+        if json:
+            client._raise_for_status(response)
+            return _loads(response.content)
+        return result(response, json=json, binary=binary)
+    client._result = decoded_result
 
 def check_docker_id(d_id):
     short_id = None
@@ -131,713 +190,5470 @@ def exists(method):
         return method(*args, **kwargs)
     return wrap
 
+def _pimap(func, items, concurrency=8, timeout=None):
+    '''
+    Calls func(item) for every item on at most 'concurrency' worker threads.
+    docker-py's client opens one connection per request, so every worker
+    talks to the daemon over its own socket.
+    
+    timeout: Stop waiting after this many seconds. Items that are not done
+        by then are not yielded and the ones not yet started are dropped.
+    
+    Yields: (item, result, exception) tuples as soon as they are finished.
+        Either result or exception is None.
+    
+    '''
+    items = list(items)
+    todo = queue.Queue()
+    done = queue.Queue()
+    for item in items:
+        todo.put(item)
+    given_up = threading.Event()
+    
+    def worker():
+        while not given_up.is_set():
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                done.put((item, func(item), None))
+            except Exception as e:
+                done.put((item, None, e))
+    
+    for _ in range(max(1, min(concurrency, len(items)))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+    
+    deadline = None if timeout is None else time.time() + timeout
+    for _ in items:
+        if deadline is None:
+            yield done.get()
+            continue
+        try:
+            yield done.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            given_up.set()
+            return
 
+def _pmap(func, items, concurrency=8):
+    '''
+    Same as _pimap(), but waits for all calls to finish.
+    
+    Returns: list of (item, result, exception) tuples in the order of items
+    
+    '''
+    items = list(items)
+    finished = {}
+    for i, res, err in _pimap(lambda i: func(items[i]), range(len(items)),
+                              concurrency):
+        finished[i] = (items[i], res, err)
+    return [finished[i] for i in range(len(items))]
 
-class WhalesnakeError(Exception):
-    pass
+def _project(data, fields):
+    '''
+    data: A dict as returned by the daemon, e.g. from inspect
+    fields: Keys to keep. Nested keys are separated by dots: 'State.Running'
+    
+    Returns: a new dict, that only contains the requested keys
+    
+    '''
+    if not fields:
+        return data
+    out = {}
+    for field in fields:
+        keys = field.split('.')
+        src, dst = data, out
+        for key in keys[:-1]:
+            src = src.get(key) if isinstance(src, dict) else None
+            if src is None:
+                break
+            dst = dst.setdefault(key, {})
+        else:
+            if isinstance(src, dict) and keys[-1] in src:
+                dst[keys[-1]] = src[keys[-1]]
+    return out
 
+# whitespace and commas between the elements of an array
+_ARRAY_GAP = re.compile(r'[\s,]*')
 
+def _iter_json_array(chunks, with_text=False):
+    '''
+    chunks: Iterable of bytes, that together form a JSON array
+    with_text: Yield (element, its JSON text) tuples instead
+    
+    Yields: the elements of the array, as soon as each one is complete. Only
+        the unparsed rest of the data is kept around. Each element is decoded
+        as a whole, projections (see _project()) happen afterwards.
+    
+    '''
+    decoder = _stdjson.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    started = False
+    ended = False
+    for chunk in chunks:
+        buf += text.decode(chunk)
+        pos = _ARRAY_GAP.match(buf).end()
+        if not started:
+            if pos == len(buf):
+                continue
+            if buf[pos] != '[':
+                raise ValueError('Expected a JSON array.')
+            started = True
+            pos += 1
+        while True:
+            pos = _ARRAY_GAP.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if buf[pos] == ']':
+                ended = True
+                break
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # incomplete, wait for more data
+                break
+            if not isinstance(element, (dict, list)) and \
+                    _ARRAY_GAP.match(buf, end).end() == len(buf):
+                # numbers may go on in the next chunk
+                break
+            yield (element, buf[pos:end]) if with_text else element
+            pos = end
+        buf = buf[pos:]
+        if ended:
+            return
+    if not ended:
+        raise ValueError('JSON array is incomplete.')
 
-def containers(match=None, raw=False, **kwargs):
+def _list_rows(path, params, client=None, with_text=False):
     '''
-    match: Either an container ID or a container name.
-    raw: Whether or not to return dicts instead of Container() instances
+    Yields: the rows of a listing endpoint while it is still being received,
+        see _iter_json_array() for with_text
     
-    Possible docker-py arguments and their defaults:
+    '''
+    client = client or dc
+    res = client._get(client._url(path), params=params, stream=True)
+    client._raise_for_status(res)
+    try:
+        for row in _iter_json_array(res.iter_content(65536), with_text):
+            yield row
+    finally:
+        res.close()
+
+def _container_rows(client=None, quiet=False, all=False, trunc=True,
+                    latest=False, since=None, before=None, limit=-1,
+                    size=False, with_text=False):
+    # same parameters as docker-py's containers()
+    params = {
+        'limit': 1 if latest else limit,
+        'all': 1 if all else 0,
+        'size': 1 if size else 0,
+        'trunc_cmd': 1 if trunc else 0,
+        'since': since,
+        'before': before
+    }
+    for row in _list_rows('/containers/json', params, client, with_text):
+        if with_text:
+            yield row
+        else:
+            yield {'Id': row['Id']} if quiet else row
+
+def _image_rows(client=None, name=None, quiet=False, all=False,
+                with_text=False):
+    # same parameters as docker-py's images()
+    params = {
+        'filter': name,
+        'only_ids': 1 if quiet else 0,
+        'all': 1 if all else 0,
+    }
+    for row in _list_rows('/images/json', params, client, with_text):
+        if with_text:
+            yield row
+        else:
+            yield row['Id'] if quiet else row
+
+def _parse_ports(ports):
+    '''
+    ports: 'Ports' of a container listing row
     
-    quiet=False, all=False, trunc=True, latest=False,
-    since=None, before=None, limit=-1, size=False
+    Returns: tuple of Port()
     
     '''
-    ctns = dc.containers(**kwargs)
-    if match:
-        filtered = []
-        for ctn in ctns:
-            if ctn['Names'][0].find(match) is not -1 \
-              or ctn['Id'].startswith(match):
-                filtered.append(ctn)
-        ctns = filtered
-    if not raw:
-        return [Container(ctn['Id']) for ctn in ctns]
-    return ctns
+    return tuple(
+        Port(p['PrivatePort'], p.get('PublicPort'), p.get('Type', 'tcp'),
+             p.get('IP') or None)
+        for p in ports or ()
+    )
 
-def events(since, until):
-    # returns a stream
-    raise NotImplementedError
+def _match_container(ctn, match):
+    return ctn['Names'][0].find(match) is not -1 \
+        or ctn['Id'].startswith(match)
+
+def _match_image(img, match):
+    if img['Id'].startswith(match):
+        return True
+    for name in img['RepoTags']:
+        if name.find(match) is not -1:
+            return True
+    return False
+
+def _check_quiet(kwargs, match, fields):
+    # quiet listings only have the ids, nothing to match or project
+    if kwargs.get('quiet') and (match or fields):
+        raise ValueError('quiet can not be combined with match or fields.')
+
+def _iter_rows(rows, matches, cls, match, raw, fields, limit):
+    if limit is not None and limit < 1:
+        return
+    found = 0
+    for row in rows:
+        if match and not matches(row, match):
+            continue
+        if not raw:
+            yield cls(row['Id'])
+        elif fields:
+            yield _project(row, fields)
+        else:
+            yield row
+        found += 1
+        if found == limit:
+            return
+
+# ids and names in request paths, so requests to the same kind of endpoint
+# share their latency statistics
+_ENDPOINT_IDS = [
+    (re.compile(r'^/(containers|exec)/(?!json$|create$)[^/]+'), r'/\1/{id}'),
+    (re.compile(r'^/images/(?!json$|create$|search$)'
+                r'.+?(?=/(json|history|push|tag|get)$|$)'), '/images/{id}'),
+]
 
-def images(match=None, raw=False, **kwargs):
+def _endpoint(path_url):
     '''
-    match: Either an container ID or a container name.
-    raw: Whether or not to return dicts instead of Image() instances
+    path_url: e.g. '/v1.14/containers/0123abcd/json?size=1'
     
-    Possible docker-py arguments and their defaults:
+    Returns: the endpoint without api version and query, ids replaced by
+        '{id}': '/containers/{id}/json'
     
-    name=None, quiet=False, all=False, viz=False
+    '''
+    path = re.sub(r'^/v[0-9.]+', '', path_url.split('?')[0])
+    for pattern, repl in _ENDPOINT_IDS:
+        path = pattern.sub(repl, path)
+    return path
+
+def _levels(deps):
+    '''
+    deps: dict of node -> nodes it depends on. Unknown nodes are ignored.
     
-    viz seems to be depracted.
-    docker-py's 'name' argument behaves strangely: name='ubuntu' returns the
-    expected image with [u'ubuntu:14.04', u'ubuntu:latest'], but
-    name='ubuntu:latest' retuns [] ?! Use 'match' for more consistent results.
+    Returns: list of lists of nodes. Every node only depends on nodes of
+        earlier lists, so the nodes of one list can be handled in parallel.
     
     '''
-    # return image instances?
-    imgs = dc.images(**kwargs)
-    if match:
-        filtered = []
-        for img in imgs:
-            if img['Id'].startswith(match):
-                filtered.append(img)
-                continue
-            for name in img['RepoTags']:
-                if name.find(match) is not -1:
-                    filtered.append(img)
-                    break
-        imgs = filtered
-    if not raw:
-        return [Image(img['Id']) for img in imgs]
-    return imgs
+    remaining = dict(
+        (node, set(d for d in deps[node] if d in deps and d != node))
+        for node in deps
+    )
+    levels = []
+    while remaining:
+        level = sorted(n for n, d in remaining.items() if not d)
+        if not level:
+            raise WhalesnakeError(
+                'Circular dependency between: {0}'.format(
+                    ', '.join(sorted(remaining))
+                )
+            )
+        for node in level:
+            del remaining[node]
+        for d in remaining.values():
+            d.difference_update(level)
+        levels.append(level)
+    return levels
 
-def info():
-    return dc.info()
+def _image_index(imgs):
+    '''
+    Returns: dict of every tag and long id -> long id for a raw images listing
+    
+    '''
+    index = {}
+    for img in imgs:
+        index[img['Id']] = img['Id']
+        for tag in img['RepoTags']:
+            index[tag] = img['Id']
+    return index
 
-def login(user, *args, **kwargs):
+def _resolve_image(index, ref):
     '''
-    user: Username used for login.
+    Looks up an image name (assuming :latest), short or long id in the result
+    of _image_index().
     
-    Possible docker-py arguments and their defaults:
+    '''
+    if ref in index:
+        return index[ref]
+    if ':' not in ref.split('/')[-1] and ref + ':latest' in index:
+        return index[ref + ':latest']
+    if len(ref) == 12:
+        for key, long_id in index.items():
+            if key == long_id and long_id.startswith(ref):
+                return long_id
+    return None
+
+def _split_tag(name):
+    '''
+    Returns: (repository, tag) as expected by docker-py's tag(), for
+        '[namespace/]repo[:tag]'
     
-    password=None, email=None, registry=None, reauth=False
+    '''
+    ns, repo, tag = check_image_name(name)
+    if ns:
+        repo = ns + '/' + repo
+    return repo, tag or 'latest'
+
+def _raise_failed(action, results):
+    '''
+    results: Output of _pmap()
+    
+    Raises a WhalesnakeError that lists all failed items, if there are any.
     
     '''
-    raise NotImplementedError
-    dc.login(user, *args, **kwargs)
+    failed = [
+        '{0}: {1}'.format(item, err)
+        for item, _, err in results if err is not None
+    ]
+    if failed:
+        raise WhalesnakeError(
+            'Unable to {0} {1} item(s):\n{2}'.format(
+                action, len(failed), '\n'.join(failed)
+            )
+        )
 
-def ps(*args, **kwargs):
-	# alias for 'containers'
-    return containers(*args, **kwargs)
+# the human readable durations in a container's 'Status', e.g. 'Up 5 minutes'
+# or 'Exited (0) About an hour ago'
+_STATUS_AGE = re.compile(
+    r' ?(Less than a|About an?|\d+) '
+    r'(second|minute|hour|day|week|month|year)s?( ago)?'
+)
+# a 'Status' in the JSON text of a listing row
+_STATUS_FIELD = re.compile(r'("Status"\s*:\s*")((?:[^"\\]|\\.)*)"')
+_AGE_UNITS = {
+    'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400,
+    'week': 7 * 86400, 'month': 30 * 86400, 'year': 365 * 86400
+}
 
-def search(match, official=None, automated=None, stars=False):
+def _layer_tags():
     '''
-    match: Search query for the docker image registry.
-    official: Show only official (True) or unofficial (False) builds.
-      NOTE: Official images seem to always have 'automated' (called 'is_trusted'
-      in the raw json) set to 'False'
-    automated: Show only automated (True) or non-automated (False) builds.
-    stars: Minimum number of stars.
-    
-    TODO: sort? return certain fields only?
+    Returns: dict of image id -> tuple of its current tags, for all images
+        including intermediate ones
     
     '''
-    imgs = dc.search(match)
+    return dict(
+        (img['Id'], tuple(t for t in img.get('RepoTags') or ()
+                          if t != '<none>:<none>'))
+        for img in dc.images(all=True)
+    )
+
+def _status_age(status):
+    '''
+    status: 'Status' of a container listing row
     
-    if official is not None \
-      or automated is not None \
-      or stars is not False:
-      
-        filtered = []
-        for img in imgs:         
-            if official:
-                if not official == img['is_official']:
-                    continue
-            
-            if automated:
-                if not automated == img['is_trusted']:
-                    continue
-            
-            if stars:
-                if not img['star_count'] >= stars:
-                    continue
-            
-            filtered.append(img)
-        return filtered
-    return imgs
+    Returns: ('StartedAt' or 'FinishedAt', at most that many seconds ago) or
+        None if the status tells no duration
+    
+    '''
+    m = _STATUS_AGE.search(status or '')
+    if m is None:
+        return None
+    count, unit, ago = m.groups()
+    # 'About an hour' is anything up to 2 hours
+    count = 0 if count == 'Less than a' else \
+        1 if count.startswith('About') else int(count)
+    return ('FinishedAt' if ago else 'StartedAt',
+            (count + 1) * _AGE_UNITS[unit])
 
-def version():
-    return dc.version()
+def _container_version(ctn):
+    '''
+    ctn: A row of the raw container listing
+    
+    Returns: a string that changes whenever the container changes its state,
+        e.g. gets started, stopped, paused or exits with another code. The
+        durations in 'Status' are left out, they change all the time.
+    
+    '''
+    status = _STATUS_AGE.sub('', ctn.get('Status') or '')
+    return json.dumps([
+        ctn['Created'], ctn['Image'], ctn['Command'], status,
+        sorted(ctn.get('Names') or []),
+        sorted(json.dumps(p, sort_keys=True) for p in ctn.get('Ports') or []),
+    ])
 
-def ping():
-    return dc.ping()
+def _container_text(text):
+    '''
+    text: The JSON text of a row of the raw container listing
+    
+    Returns: the text with the durations in 'Status' left out, see
+        _container_version()
+    
+    '''
+    return _STATUS_FIELD.sub(
+        lambda m: m.group(1) + _STATUS_AGE.sub('', m.group(2)) + '"', text
+    )
 
+def _pause(long_id):
+    # not wrapped by docker-py 0.4.0
+    res = dc._post(dc._url('/containers/{0}/pause'.format(long_id)))
+    dc._raise_for_status(res)
 
+def _unpause(long_id):
+    res = dc._post(dc._url('/containers/{0}/unpause'.format(long_id)))
+    dc._raise_for_status(res)
 
-class Container(object):
+def _bulk(func, ctns, concurrency):
+    '''
+    Calls func(long_id) for every container in parallel and measures how long
+    each call took.
     
-    def __init__(self, name_or_cid):
-        '''
-        name_or_cid: Either the name of a new or existing container or a
-            container ID of an existing container.
-        
-        One name per id
-        One id per name
-        
-        '''
-        self._passed_arg = name_or_cid
-        self._passed_arg_type = None
-        self.name = ''
-        self.short_id, self.long_id = None, None
-        
-        try:
-            # check if a cid was given
-            self.short_id, self.long_id = check_docker_id(name_or_cid)
-            self._passed_arg_type = 'ID'
-        except ValueError:
-            # not a cid, interpret as name, but check if empty
-            if len(name_or_cid) is 0:
-                raise  ValueError(
-                    'Either a valid container id or a name must be given.'
+    Returns: (dict of long id -> latency in ms, list of error messages)
+    
+    '''
+    refs = []
+    for ctn in ctns:
+        if isinstance(ctn, Container):
+            if not ctn.exists:
+                raise WhalesnakeError(
+                    'Container was not yet created: {0}'.format(ctn.name)
                 )
-            
-            check_container_name(name_or_cid)
-            self.name = name_or_cid
-            self._passed_arg_type = 'name'
-        
-        self._check_status()
-        
-        if self.short_id and not self.exists:
-            # cid was given, but does not exist
-            raise ValueError(
-                'No container was found for id: {0}'.format(name_or_cid)
-            )
+            ctn = ctn.long_id
+        refs.append(ctn)
     
-    def __repr__(self):
-        return 'Container(name_or_cid={0!r})'.format(self._passed_arg)
+    def timed(ref):
+        start = time.time()
+        func(ref)
+        return (time.time() - start) * 1000
     
-    def __str__(self):
-        s = 'Container with name "{0}"'.format(self.name)
-        if self.exists:
-            s += ' and ID "{0}"'.format(self.long_id)
-        return s
+    latencies = {}
+    failed = []
+    for ref, ms, err in _pmap(timed, refs, concurrency):
+        if err is None:
+            latencies[ref] = ms
+        else:
+            failed.append('{0}: {1}'.format(ref, err))
+    return latencies, failed
+
+def _set_paused(ctns, long_ids, paused):
+    for ctn in ctns:
+        if isinstance(ctn, Container) and ctn.long_id in long_ids:
+            ctn.paused = paused
+
+def _stats_sample(raw, prev=None):
+    '''
+    Reduce a raw sample of /containers/(id)/stats to the numbers 'docker stats'
+    shows. The deltas are computed against 'prev', the previous raw sample.
     
-    def _check_status(self):
-        '''
-        Check status of the name/id and set the missing pieces
-        
-        '''
-        # defaults
-        self.exists = False
-        self.created = False
-        self.image = None
-        self.ports = None
-        self.command = None
-        
-        self.running = False
-        self.paused = False
-        
-        for ctn in dc.containers(all=True):
-            id_match = self.short_id and ctn['Id'].startswith(self.short_id)
-            name_match = self.name and '/' + self.name in ctn['Names']
-            if id_match or name_match:
-                self.exists = True
-                self.short_id, self.long_id = check_docker_id(ctn['Id'])
-                # seems like there's only ever one name in the list
-                self.name = ctn['Names'][0][1:] # strip leading '/'
-                self.created = datetime.datetime.fromtimestamp(ctn['Created'])
-                self.image = Image(ctn['Image'])
-                self.ports = ctn['Ports']
-                self.command = ctn['Command']
-                
-                # inspect gives a lot more information. write own method for it
-                meta = self.inspect()
-                self.running = meta['State']['Running']
-                self.paused = meta['State']['Paused']
-                break
+    '''
+    def net(s):
+        # API < 1.21 reports a single 'network', later ones 'networks' per nic
+        nics = s.get('networks') or {'eth0': s.get('network') or {}}
+        return (sum(n.get('rx_bytes', 0) for n in nics.values()),
+                sum(n.get('tx_bytes', 0) for n in nics.values()))
     
-    def run(self, image, command=None, create_conf={}, start_conf={}):
-        '''
-        short hand for create() + start() + necessary error handling, see:
-        https://docs.docker.com/reference/api/
-            docker_remote_api_v1.13/#31-inside-docker-run
-        
-        '''
+    def blk(s):
+        read, write = 0, 0
+        io = (s.get('blkio_stats') or {}).get('io_service_bytes_recursive')
+        for entry in io or []:
+            if entry['op'] == 'Read':
+                read += entry['value']
+            elif entry['op'] == 'Write':
+                write += entry['value']
+        return read, write
+    
+    cpu = raw['cpu_stats']
+    precpu = raw.get('precpu_stats') or (prev or {}).get('cpu_stats')
+    cpu_percent = None
+    if precpu and precpu.get('system_cpu_usage'):
+        cpu_delta = cpu['cpu_usage']['total_usage'] - \
+                    precpu['cpu_usage']['total_usage']
+        system_delta = cpu['system_cpu_usage'] - precpu['system_cpu_usage']
+        ncpus = len(cpu['cpu_usage'].get('percpu_usage') or []) or 1
+        cpu_percent = 0.0
+        if system_delta > 0 and cpu_delta > 0:
+            cpu_percent = float(cpu_delta) / system_delta * ncpus * 100
+    
+    mem = raw.get('memory_stats') or {}
+    mem_usage = mem.get('usage', 0)
+    mem_limit = mem.get('limit', 0)
+    
+    sample = {
+        'read': raw.get('read'),
+        'cpu_percent': cpu_percent,
+        'mem_usage': mem_usage,
+        'mem_limit': mem_limit,
+        'mem_percent': float(mem_usage) / mem_limit * 100 if mem_limit else 0.0,
+    }
+    sample['net_rx'], sample['net_tx'] = net(raw)
+    sample['blk_read'], sample['blk_write'] = blk(raw)
+    
+    # no deltas for the first sample
+    prev = prev or raw
+    prev_net, prev_blk = net(prev), blk(prev)
+    sample['net_rx_delta'] = sample['net_rx'] - prev_net[0]
+    sample['net_tx_delta'] = sample['net_tx'] - prev_net[1]
+    sample['blk_read_delta'] = sample['blk_read'] - prev_blk[0]
+    sample['blk_write_delta'] = sample['blk_write'] - prev_blk[1]
+    return sample
+
+def _hijack(path, body=None):
+    '''
+    Sends a POST request for path over a new connection to the daemon and
+    hands over the bare socket once the response headers were read. This is
+    what the daemon expects for attach and exec, and docker-py 0.4.0 keeps
+    parts of the stream in its read buffers.
+    
+    Returns: (socket, bytes already received after the headers)
+    
+    '''
+    url = dc.base_url
+    if url.startswith('http+unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = url.replace('http+unix:/', '')
+    elif url.startswith('http://'):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        host, _, port = url[len('http://'):].rstrip('/').partition(':')
+        address = (host, int(port or 80))
+    else:
+        raise WhalesnakeError(
+            'Raw streams are only supported for unix:// and tcp:// daemons.'
+        )
+    sock.settimeout(dc._timeout)
+    sock.connect(address)
+    
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    head = 'POST /v{0}{1} HTTP/1.1\r\n'.format(dc._version, path) + \
+           'Host: docker\r\n' + \
+           'Content-Type: application/json\r\n' + \
+           'Content-Length: {0}\r\n'.format(len(payload)) + \
+           'Connection: Upgrade\r\n' + \
+           'Upgrade: tcp\r\n\r\n'
+    sock.sendall(head.encode('ascii') + payload)
+    
+    data = b''
+    while not b'\r\n\r\n' in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            sock.close()
+            raise WhalesnakeError('Daemon closed the connection: ' + path)
+        data += chunk
+    head, _, data = data.partition(b'\r\n\r\n')
+    status = head.split(b'\r\n', 1)[0].decode('ascii', 'replace')
+    if status.split(' ')[1] not in ('101', '200'):
+        sock.close()
+        raise WhalesnakeError('Request failed: {0}\n{1}'.format(
+            status, data.decode('utf-8', 'replace')
+        ))
+    return sock, data
+
+# ps column title -> (Process field, conversion)
+_TOP_COLUMNS = {
+    'PID': ('pid', int),
+    'PPID': ('ppid', int),
+    'USER': ('user', str),
+    'UID': ('user', str),
+    '%CPU': ('cpu', float),
+    'C': ('cpu', float),
+    '%MEM': ('mem', float),
+    # KiB
+    'RSS': ('rss', lambda kib: int(kib) * 1024),
+    'VSZ': ('vsz', lambda kib: int(kib) * 1024),
+    'CMD': ('command', str),
+    'COMMAND': ('command', str),
+}
+
+def _parse_top(raw):
+    '''
+    raw: Output of the top endpoint: {'Titles': [...], 'Processes': [[...]]}
+    
+    Returns: list of Process() tuples
+    
+    '''
+    columns = [_TOP_COLUMNS.get(title, (None, None)) for title in raw['Titles']]
+    procs = []
+    for row in raw['Processes'] or []:
+        fields = dict.fromkeys(Process._fields)
+        other = {}
+        for title, (field, convert), value in zip(raw['Titles'], columns, row):
+            if field is None:
+                other[title] = value
+                continue
+            try:
+                fields[field] = convert(value)
+            except ValueError:
+                # e.g. '-' for kernel threads
+                fields[field] = None
+        fields['other'] = other
+        procs.append(Process(**fields))
+    return procs
+
+def _pull(ref, client=None):
+    jsn = (client or dc).pull(ref)
+    msg = json.loads(jsn.split('\r\n')[-2])
+    if 'errorDetail' in msg:
+        raise ValueError(msg['errorDetail']['message'])
+
+def _build_args(name, build_src, build_type, rm):
+    # arguments for docker-py's build(), see Image.build()
+    args = {
+        'tag': name,
+        'rm': rm
+    }
+    
+    if build_type in ['tar', 'tar.gz']:
+        args['fileobj'] = build_src
+        args['custom_context'] = True
+        if build_type == 'tar.gz':
+            args['encoding'] = 'gzip'
+    elif build_type == 'file':
+        args['fileobj'] = build_src
+    elif build_type in ['url', 'path', 'github', 'git']:
+        args['path'] = build_src
+    else:
+        raise ValueError(
+            'Build type "{0}" is not supported.'.format(build_type)
+        )
+    return args
+
+def _build(args):
+    '''
+    args: Arguments for docker-py's build()
+    
+    Returns: (build output, steps, error): steps as parsed by
+        _build_steps(), error is None or a WhalesnakeError() if the build
+        failed
+    
+    '''
+    res = dc.build(**args)
+    
+    # https://github.com/docker/docker-py/issues/255
+    # lines w/ 'stream' as JSON key only contain information about
+    # the build process, not about pulling images from the registry etc.
+    # remember when each line arrived, for the duration of the steps
+    arrived = [(line, time.time()) for line in res]
+    lines = [line for line, _ in arrived]
+    try:
+        parsed_lines = [(json.loads(e).get('stream', ''), t)
+                        for e, t in arrived]
+    except ValueError:
+        # sometimes all the data is sent on a single line ????
+        #
+        # ValueError: Extra data: line 1 column 87 - line 1 column
+        # 33268 (char 86 - 33267)
+        line, t = arrived[0]
+        # This ONLY works because every line is formatted as
+        # {"stream": STRING}
+        parsed_lines = [
+            (json.loads(obj).get('stream', ''), t) for obj in
+            re.findall('{\s*"stream"\s*:\s*"[^"]*"\s*}', line)
+        ]
+    
+    build_log = ''.join(text for text, _ in parsed_lines)
+    steps = _build_steps(parsed_lines)
+    # search for success message
+    search = r'^Successfully built ([0-9a-f]{12})\n$'
+    status = parsed_lines[-1][0]
+    match = re.search(search, status)
+    if match:
+        return build_log, steps, None
+    
+    elif status == '' and len(lines) is 1:
+        err = lines[0]
+        if 'errorDetail' in err:
+            msg = json.loads(err)['errorDetail']['message']
+            return build_log, steps, WhalesnakeError(
+                'Build failed: {0}'.format(msg)
+            )
+    
+    # something else went wrong - dump everything we got back
+    return build_log, steps, WhalesnakeError(
+        'Build failed:\n{0}'.format(res)
+    )
+
+# 'Step 3 : RUN make' (newer daemons: 'Step 3/7 : RUN make')
+_BUILD_STEP = re.compile(r'^Step (\d+)(?:/\d+)? : (.*)$')
+
+def _build_steps(parsed_lines):
+    '''
+    parsed_lines: (text of the build stream, time it arrived) tuples
+    
+    Returns: list of BuildStep() tuples, size is left None. A step lasts
+        until the next one (or the end of the build) starts.
+    
+    '''
+    steps = []
+    current = None
+    for text, t in parsed_lines:
+        for line in text.splitlines():
+            match = _BUILD_STEP.match(line)
+            if match or line.startswith('Successfully built'):
+                if current is not None:
+                    current['seconds'] = t - current.pop('start')
+                    steps.append(BuildStep(**current))
+                    current = None
+            if match:
+                current = {
+                    'number': int(match.group(1)),
+                    'instruction': match.group(2).strip(),
+                    'start': t, 'seconds': None, 'cached': False,
+                    'layer': None, 'size': None,
+                }
+            elif current is not None and line.startswith(' ---> '):
+                out = line[6:].strip()
+                if out == 'Using cache':
+                    current['cached'] = True
+                elif re.match(r'^[0-9a-f]{12}$', out):
+                    current['layer'] = out
+    if current is not None:
+        # the build failed during this step
+        current['seconds'] = parsed_lines[-1][1] - current.pop('start')
+        steps.append(BuildStep(**current))
+    return steps
+
+def _build_sizes(steps, img):
+    '''
+    Fills in the size of the layers created by the steps of a build.
+    
+    img: The Image() that was built
+    
+    '''
+    sizes = dict((layer.id[:12], layer.size)
+                 for layer in img.layers(tags=False))
+    return [step._replace(size=sizes.get(step.layer)) for step in steps]
+
+def _from_refs(dockerfile):
+    '''
+    dockerfile: Contents of a Dockerfile
+    
+    Returns: the images named in its FROM lines, with ':latest' added where
+        no tag is given. Build stages ('FROM x AS name') referenced by later
+        FROM lines are left out, as are names we can't parse, like those
+        with a registry or a build argument in them.
+    
+    '''
+    refs = []
+    stages = set()
+    for line in dockerfile.splitlines():
+        # options like --platform=... come before the image
+        words = [w for w in line.split() if not w.startswith('--')]
+        if len(words) < 2 or words[0].upper() != 'FROM':
+            continue
+        # scratch is no image, but the empty base
+        if words[1].lower() not in stages and words[1] != 'scratch':
+            try:
+                refs.append('{0}:{1}'.format(*_split_tag(words[1])))
+            except ValueError:
+                pass
+        if len(words) >= 4 and words[2].upper() == 'AS':
+            stages.add(words[3].lower())
+    return refs
+
+def _read_dockerfile(build_src, build_type, name='Dockerfile'):
+    '''
+    Returns: the Dockerfile of a build source as given to Image.build(), or
+        None for remote sources. File objects are rewound afterwards.
+    
+    '''
+    if build_type == 'path':
+        if not os.path.isdir(build_src):
+            # an url, handled by the daemon
+            return None
+        with open(os.path.join(build_src, name), 'rb') as f:
+            return f.read().decode('utf-8', 'replace')
+    if build_type not in ('file', 'tar', 'tar.gz'):
+        return None
+    start = build_src.tell()
+    try:
+        if build_type == 'file':
+            data = build_src.read()
+        else:
+            with tarfile.open(fileobj=build_src, mode='r:*') as tar:
+                # members may be named './Dockerfile' as well
+                for member in tar.getmembers():
+                    if (member.isfile() and os.path.normpath(member.name) ==
+                            os.path.normpath(name)):
+                        break
+                else:
+                    raise KeyError('filename {0!r} not found'.format(name))
+                data = tar.extractfile(member).read()
+    finally:
+        build_src.seek(start)
+    if not isinstance(data, bytes):
+        return data
+    return data.decode('utf-8', 'replace')
+
+def _log_time(ts):
+    '''
+    ts: RFC 3339 timestamp as prefixed to log lines by the daemon:
+        '2014-06-10T12:00:00.123456789Z'
+    
+    Returns: nanoseconds since the epoch
+    
+    '''
+    secs, _, frac = ts.rstrip('Z').partition('.')
+    epoch = calendar.timegm(
+        datetime.datetime.strptime(secs, '%Y-%m-%dT%H:%M:%S').timetuple()
+    )
+    return epoch * 10 ** 9 + int((frac + '000000000')[:9])
+
+def _since_ns(since):
+    # datetime (UTC if naive) or seconds since the epoch
+    if since is None:
+        return 0
+    if isinstance(since, datetime.datetime):
+        return calendar.timegm(since.utctimetuple()) * 10 ** 9 \
+            + since.microsecond * 1000
+    return int(since * 10 ** 9)
+
+def _log_frames(chunks, tty=False):
+    '''
+    chunks: Bytes of a logs response as received
+    tty: Containers with a tty send a raw stream, that is all stdout
+    
+    Returns: generator of (stream, bytes) in the order sent, with the same
+        framing as attach, see StreamDemuxer. Raw streams are cut at newlines.
+    
+    '''
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        if tty:
+            cut = pending.rfind(b'\n') + 1
+            if cut:
+                yield StreamDemuxer.STDOUT, bytes(pending[:cut])
+                del pending[:cut]
+            continue
+        view = memoryview(pending)
+        pos = 0
+        end = len(view)
+        while end - pos >= 8:
+            stream, length = struct.unpack_from('>BxxxL', view, pos)
+            if end - pos - 8 < length:
+                break
+            yield stream, view[pos + 8:pos + 8 + length].tobytes()
+            pos += 8 + length
+        # the bytearray can't be resized while a view exports it
+        del view
+        del pending[:pos]
+    if tty and pending:
+        yield StreamDemuxer.STDOUT, bytes(pending)
+
+def _fetch_logs(long_id, since_ns=0, tty=False, chunk_size=65536):
+    '''
+    Gets the log lines of a container written after since_ns.
+    
+    Only daemons with api 1.19+ know 'since', older ones send everything.
+    Lines at or before since_ns are dropped either way, as are lines without
+    a timestamp.
+    
+    Returns: generator of (nanoseconds, stream, line) tuples in the order
+        sent, line as bytes without the timestamp and the newline. The
+        response is read chunk_size Bytes at a time while iterating.
+    
+    '''
+    res = dc._get(dc._url('/containers/{0}/logs'.format(long_id)), params={
+        'stdout': 1, 'stderr': 1, 'timestamps': 1,
+        # whole seconds only, the overlap gets dropped below
+        'since': since_ns // 10 ** 9,
+    }, stream=True)
+    dc._raise_for_status(res)
+    try:
+        for stream, chunk in _log_frames(res.iter_content(chunk_size), tty):
+            for line in chunk.split(b'\n'):
+                ts, _, text = line.partition(b' ')
+                try:
+                    ns = _log_time(ts.decode('ascii'))
+                except (UnicodeDecodeError, ValueError):
+                    continue
+                if ns > since_ns:
+                    yield ns, stream, text
+    finally:
+        res.close()
+
+def _trigram_bits(data, bits):
+    '''
+    data: Lower case bytes
+    bits: Size of the bitmap, a power of two
+    
+    Returns: bitmap as bytearray with one bit set per distinct trigram
+        of data (crc32 of the trigram modulo bits)
+    
+    '''
+    bitmap = bytearray(bits // 8)
+    for gram in set(data[i:i + 3] for i in range(len(data) - 2)):
+        h = zlib.crc32(gram) & (bits - 1)
+        bitmap[h >> 3] |= 1 << (h & 7)
+    return bitmap
+
+def _bits_int(bitmap):
+    return int(codecs.encode(bytes(bitmap), 'hex') or b'0', 16)
+
+def _skip_class(pattern, i):
+    # i: position of the '[' of a character class. Returns: the position
+    # after its ']'. A ']' right at the start belongs to the class.
+    i += 1
+    if pattern[i:i + 1] == '^':
+        i += 1
+    if pattern[i:i + 1] == ']':
+        i += 1
+    while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+    return i + 1
+
+# escapes followed by an argument: its characters and their maximum number
+_ESCAPE_ARGS = {
+    'x': (string.hexdigits, 2),
+    'u': (string.hexdigits, 4),
+    'U': (string.hexdigits, 8),
+}
+
+def _regex_literals(pattern):
+    '''
+    Returns: substrings every match of the regular expression contains.
+        Conservative: alternations give none, groups and character classes
+        are skipped.
+    
+    '''
+    if '|' in pattern:
+        return []
+    runs = []
+    run = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            escaped = pattern[i + 1:i + 2]
+            i += 2
+            if escaped and not escaped.isalnum():
+                run += escaped
+                continue
+            # \d, \w, ... and those with an argument, which is skipped as
+            # well: \x41, \u0041, \N{...}, octal and backreferences
+            runs.append(run)
+            run = ''
+            if escaped == 'N' and pattern[i:i + 1] == '{':
+                i = pattern.find('}', i) + 1
+                if i == 0:
+                    return []
+                continue
+            digits, chars = _ESCAPE_ARGS.get(escaped, ('', 0))
+            if escaped.isdigit():
+                digits, chars = string.digits, 2
+            while chars and pattern[i:i + 1] and pattern[i] in digits:
+                i += 1
+                chars -= 1
+        elif c in '?*{':
+            # the previous character is optional
+            runs.append(run[:-1])
+            run = ''
+            i = pattern.find('}', i) + 1 if c == '{' else i + 1
+            if i == 0:
+                return []
+        elif c in '([':
+            runs.append(run)
+            run = ''
+            depth = 0
+            while i < len(pattern):
+                if pattern[i] == '\\':
+                    i += 2
+                    continue
+                if pattern[i] == '[':
+                    i = _skip_class(pattern, i)
+                    if depth == 0:
+                        break
+                    continue
+                if pattern[i] == '(':
+                    depth += 1
+                elif pattern[i] == ')':
+                    depth -= 1
+                    if depth == 0:
+                        i += 1
+                        break
+                i += 1
+            # whatever follows might make the group optional, it doesn't
+            # matter, as its contents are not used anyway
+        elif c in '.^$+':
+            # with '+' the previous character is there at least once
+            runs.append(run)
+            run = ''
+            i += 1
+        else:
+            run += c
+            i += 1
+    runs.append(run)
+    return [run for run in runs if run]
+
+
+
+class WhalesnakeError(Exception):
+    pass
+
+
+
+class LRUCache(object):
+    
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None):
+        '''
+        Thread safe mapping, that forgets the least recently used entries.
+        
+        maxsize: Maximum number of entries
+        ttl: Seconds after which an entry is considered stale, None for never
+        maxbytes: Maximum total size of the entries, as passed to set()
+        
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict() # key -> (expires, value, size)
+        self._lock = threading.Lock()
+    
+    def __repr__(self):
+        return 'LRUCache(maxsize={0!r}, ttl={1!r}, maxbytes={2!r})'.format(
+            self.maxsize, self.ttl, self.maxbytes
+        )
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+    
+    def _lookup(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] < time.time():
+            self._drop(key)
+            return None
+        return entry
+    
+    def _drop(self, key):
+        self.bytes -= self._data.pop(key)[2]
+    
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            # move to the most recently used end
+            del self._data[key]
+            self._data[key] = entry
+            return entry[1]
+    
+    def set(self, key, value, size=0):
+        '''
+        size: Bytes to account for the entry, e.g. the length of the response
+            it was decoded from
+        
+        '''
+        if self.maxbytes is not None and size > self.maxbytes:
+            # would push out everything else and itself. the old value is
+            # outdated all the same.
+            with self._lock:
+                if key in self._data:
+                    self._drop(key)
+            return
+        with self._lock:
+            expires = time.time() + self.ttl if self.ttl is not None else None
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (expires, value, size)
+            self.bytes += size
+            while len(self._data) > self.maxsize or (
+              self.maxbytes is not None and self.bytes > self.maxbytes):
+                self._drop(next(iter(self._data)))
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            if not key in self._data:
+                return default
+            value = self._data[key][1]
+            self._drop(key)
+            return value
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+
+
+# raw results of search(), per query
+search_cache = LRUCache(maxsize=256, ttl=300)
+
+# see enable_disk_cache()
+disk_cache = None
+
+# see enable_health_monitor()
+health = None
+
+# Image.inspect(), history() and layers() per (long id, kind), shared by all
+# Image() instances. image ids are content addressed, entries never go stale.
+image_cache = LRUCache(maxsize=4096, maxbytes=32 * 1024 * 1024)
+
+Layer = collections.namedtuple(
+    'Layer', ['id', 'created', 'created_by', 'size', 'tags']
+)
+
+# see enable_log_store()
+log_store = None
+
+LogLine = collections.namedtuple('LogLine', ['time', 'stream', 'text'])
+
+# see Snapshot.diff(). dicts of id -> row, for changed: id -> (old, new)
+InventoryDelta = collections.namedtuple(
+    'InventoryDelta', ['added', 'removed', 'changed']
+)
+
+# a step of Image.build_report. seconds: from the start of this step until
+# the next one started, cached: taken from the build cache, layer: short id
+# of the resulting layer, size: its size in Bytes
+BuildStep = collections.namedtuple(
+    'BuildStep', ['number', 'instruction', 'seconds', 'cached', 'layer',
+                  'size']
+)
+
+# a published or exposed port of a container as listed by the daemon.
+# public and ip are None if the port is exposed only
+Port = collections.namedtuple('Port', ['private', 'public', 'proto', 'ip'])
+
+# see PortIndex. id: long id of the container, name: without leading '/'
+PortOwner = collections.namedtuple('PortOwner', ['id', 'name', 'port'])
+
+# a row of Container.top(parsed=True). columns missing from the ps output
+# are None, unknown ones end up in 'other'
+Process = collections.namedtuple(
+    'Process', ['pid', 'ppid', 'user', 'cpu', 'mem', 'rss', 'vsz', 'command',
+                'other']
+)
+
+
+
+def containers(match=None, raw=False, fields=None, **kwargs):
+    '''
+    match: Either an container ID or a container name.
+    raw: Whether or not to return dicts instead of Container() instances
+    fields: Only keep these keys of each dict (raw=True only). The listing
+        is then decoded row by row while it is received, so only the
+        requested parts stay in memory. Each row is still decoded in full
+        before it is cut down.
+    
+    Possible docker-py arguments and their defaults:
+    
+    quiet=False, all=False, trunc=True, latest=False,
+    since=None, before=None, limit=-1, size=False
+    
+    '''
+    _check_quiet(kwargs, match, fields)
+    if fields and raw:
+        # each row is projected right after it is decoded
+        return list(_iter_rows(_container_rows(**kwargs), _match_container,
+                               Container, match, raw, fields, None))
+    ctns = dc.containers(**kwargs)
+    if match:
+        ctns = [ctn for ctn in ctns if _match_container(ctn, match)]
+    if not raw:
+        return [Container(ctn['Id']) for ctn in ctns]
+    return ctns
+
+def build_many(specs, concurrency=4, pull=True, rm=True,
+               ignore_errors=False):
+    '''
+    Builds many images, each as soon as the images it is based on are done.
+    Builds that don't depend on each other run in parallel.
+    
+    specs: list of dicts with 'name', 'build_src' and 'build_type' as for
+        Image.build(). Other keys are passed on to docker-py's build(), e.g.
+        'nocache'. The base images are taken from the FROM lines of the
+        Dockerfiles. Set 'from' (list of image names) for sources whose
+        Dockerfile can't be read locally, like urls.
+    concurrency: Number of builds running at the same time
+    pull: Pull base images that are neither there nor built here, all in
+        parallel, before the first build starts
+    rm: Remove intermediate containers
+    ignore_errors: Report failed builds instead of raising a WhalesnakeError
+        after all others are done. Builds based on a failed one are skipped.
+    
+    Returns: OrderedDict of name -> report, in the order the builds
+        finished. A report is a dict with:
+        'image': Image() instance, None if the build failed
+        'seconds': Wall time of the build
+        'steps': Number of Dockerfile steps
+        'cache_hits': Steps that were taken from the build cache
+        'build_report': The steps as BuildStep() tuples, see Image.build()
+        'base': Base image names
+        'log': Output of the build
+        'error': Exception if the build failed, else None
+    
+    '''
+    by_name = collections.OrderedDict()
+    deps = {}
+    for spec in specs:
+        spec = dict(spec)
+        name = '{0}:{1}'.format(*_split_tag(spec.pop('name')))
+        check_image_name(name)
+        if name in by_name:
+            raise ValueError('Image is built twice: {0}'.format(name))
+        # fail early on unsupported build types
+        _build_args(name, spec['build_src'], spec['build_type'], rm)
+        base = spec.pop('from', None)
+        if base is None:
+            dockerfile = _read_dockerfile(spec['build_src'],
+                                          spec['build_type'])
+            base = _from_refs(dockerfile) if dockerfile else []
+        else:
+            base = ['{0}:{1}'.format(*_split_tag(ref)) for ref in base]
+        by_name[name] = spec
+        deps[name] = base
+    # raises on cycles
+    _levels(deps)
+    
+    if pull:
+        index = _image_index(dc.images())
+        missing = set(
+            ref for refs in deps.values() for ref in refs
+            if ref not in by_name and _resolve_image(index, ref) is None
+        )
+        _raise_failed('pull', _pmap(_pull, sorted(missing), concurrency))
+    
+    def build(name):
+        spec = dict(by_name[name])
+        args = _build_args(name, spec.pop('build_src'),
+                           spec.pop('build_type'), rm)
+        args.update(spec)
+        start = time.time()
+        log, steps, err = _build(args)
+        return {
+            'image': None,
+            'seconds': time.time() - start,
+            'steps': len(steps),
+            'cache_hits': len([step for step in steps if step.cached]),
+            'build_report': steps,
+            'base': deps[name],
+            'log': log,
+            'error': err,
+        }
+    
+    waiting = dict(
+        (name, set(ref for ref in refs if ref in by_name))
+        for name, refs in deps.items()
+    )
+    reports = collections.OrderedDict()
+    done = queue.Queue()
+    running = 0
+    
+    def worker(name):
+        try:
+            done.put((name, build(name)))
+        except Exception as e:
+            done.put((name, {'image': None, 'seconds': None, 'steps': 0,
+                             'cache_hits': 0, 'build_report': [],
+                             'base': deps[name], 'log': '', 'error': e}))
+    
+    while waiting or running:
+        ready = sorted(name for name, refs in waiting.items() if not refs)
+        for name in ready[:max(0, concurrency - running)]:
+            del waiting[name]
+            t = threading.Thread(target=worker, args=(name, ))
+            t.daemon = True
+            t.start()
+            running += 1
+        if not running:
+            break
+        name, report = done.get()
+        running -= 1
+        reports[name] = report
+        for other, refs in list(waiting.items()):
+            if name not in refs:
+                continue
+            if report['error'] is None:
+                refs.discard(name)
+                continue
+            # can't be built without its base
+            del waiting[other]
+            reports[other] = {
+                'image': None, 'seconds': None, 'steps': 0, 'cache_hits': 0,
+                'build_report': [], 'base': deps[other], 'log': '',
+                'error': WhalesnakeError(
+                    'Base image failed to build: {0}'.format(name)
+                ),
+            }
+            # and neither can the ones based on it
+            done.put((other, reports.pop(other)))
+            running += 1
+    
+    # a single listing for all of them
+    imgs = dc.images()
+    for name, report in reports.items():
+        if report['error'] is None:
+            report['image'] = Image(name, _imgs=imgs)
+            report['image'].build_log = report['log']
+            report['image'].build_report = report['build_report'] = \
+                _build_sizes(report['build_report'], report['image'])
+    
+    if not ignore_errors:
+        _raise_failed('build', [(name, None, report['error'])
+                                for name, report in reports.items()])
+    return reports
+
+def disable_disk_cache():
+    global disk_cache
+    if disk_cache is not None:
+        disk_cache.close()
+    disk_cache = None
+
+def disable_health_monitor():
+    global health
+    if health is not None:
+        health.uninstall()
+    health = None
+
+def disable_log_store():
+    global log_store
+    if log_store is not None:
+        log_store.close()
+    log_store = None
+
+def enable_disk_cache(path=None, validate=True):
+    '''
+    Keeps the results of Image.inspect(), Image.history() and the
+    inspects of Container._check_status() in an sqlite database, that is
+    shared by all processes using the same path. Container.inspect() always
+    asks the daemon.
+    
+    path: Location of the database file.
+        Defaults to ~/.cache/whalesnake/metadata.sqlite
+    validate: Drop entries of images and containers, that are gone or have
+        changed, based on one image and one container listing
+    
+    Returns: the MetadataCache() instance, also available as disk_cache
+    
+    '''
+    global disk_cache
+    disable_disk_cache()
+    disk_cache = MetadataCache(path)
+    if validate:
+        disk_cache.validate()
+    return disk_cache
+
+def enable_health_monitor(interval=5, **kwargs):
+    '''
+    Watches the connection to the daemon: pings it every 'interval' seconds,
+    adapts the timeouts of read requests to how fast the daemon answers,
+    retries those with jittered backoff and fails fast while the daemon is
+    unreachable. See HealthMonitor() for the other arguments.
+    
+    Returns: the HealthMonitor() instance, also available as health
+    
+    '''
+    global health
+    disable_health_monitor()
+    health = HealthMonitor(dc, interval=interval, **kwargs)
+    health.install()
+    return health
+
+def enable_log_store(path=None, **kwargs):
+    '''
+    Keeps container logs on disk, indexed for Container.search_logs(). Only
+    what is new gets fetched from the daemon. See LogCollector() to keep
+    the logs of many containers up to date in the background.
+    
+    path: Directory of the store. Defaults to ~/.cache/whalesnake/logs
+    
+    Returns: the LogStore() instance, also available as log_store
+    
+    '''
+    global log_store
+    disable_log_store()
+    log_store = LogStore(path, **kwargs)
+    return log_store
+
+def events(since, until):
+    # returns a stream
+    raise NotImplementedError
+
+def exec_many(ctns, cmd, timeout=10, concurrency=16):
+    '''
+    Runs cmd in many containers at once, e.g. for health checks.
+    
+    ctns: Running Container() instances
+    cmd: Command as string or list
+    timeout: Seconds each command may take. Slower ones get abandoned.
+    concurrency: Number of exec instances to set up in parallel. Reading the
+        output of all of them happens on a single thread.
+    
+    Returns: dict of long id -> finished StreamSession()
+    
+    '''
+    ctns = list(ctns)
+    results = _pmap(lambda ctn: ctn.exec_session(cmd, timeout=timeout),
+                    ctns, concurrency)
+    sessions = dict((ctn.long_id, session)
+                    for ctn, session, err in results if err is None)
+    try:
+        for ctn, _, err in results:
+            if err is not None:
+                raise WhalesnakeError(
+                    'Unable to exec in {0}: {1}'.format(ctn.name, err)
+                )
+        run_sessions(sessions.values())
+    finally:
+        # the ones set up before a failure
+        for session in sessions.values():
+            if not session.done:
+                session.close()
+    _pmap(lambda s: s.fetch_exit_code(),
+          [s for s in sessions.values() if not s.timed_out], concurrency)
+    return sessions
+
+def first(iterable, default=None):
+    '''
+    iterable: e.g. iter_containers() or iter_images()
+    default: Returned if there is nothing
+    
+    Returns: the first element, the rest is never fetched or built.
+    
+    '''
+    it = iter(iterable)
+    try:
+        return next(it, default)
+    finally:
+        # ends the underlying request
+        if hasattr(it, 'close'):
+            it.close()
+
+def images(match=None, raw=False, fields=None, **kwargs):
+    '''
+    match: Either an container ID or a container name.
+    raw: Whether or not to return dicts instead of Image() instances
+    fields: Only keep these keys of each dict (raw=True only), see
+        containers()
+    
+    Possible docker-py arguments and their defaults:
+    
+    name=None, quiet=False, all=False, viz=False
+    
+    viz seems to be depracted.
+    docker-py's 'name' argument behaves strangely: name='ubuntu' returns the
+    expected image with [u'ubuntu:14.04', u'ubuntu:latest'], but
+    name='ubuntu:latest' retuns [] ?! Use 'match' for more consistent results.
+    
+    '''
+    _check_quiet(kwargs, match, fields)
+    if fields and raw and not kwargs.get('viz'):
+        return list(_iter_rows(_image_rows(**kwargs), _match_image, Image,
+                               match, raw, fields, None))
+    imgs = dc.images(**kwargs)
+    if match:
+        imgs = [img for img in imgs if _match_image(img, match)]
+    # return image instances?
+    if not raw:
+        return [Image(img['Id']) for img in imgs]
+    if fields:
+        return [_project(img, fields) for img in imgs]
+    return imgs
+
+def image_gc(dry_run=False, concurrency=8):
+    '''
+    Removes all images, that are neither tagged nor used by a container, nor
+    parents of such an image. See ImageGraph.collect().
+    
+    '''
+    return ImageGraph().collect(dry_run=dry_run, concurrency=concurrency)
+
+def info():
+    return dc.info()
+
+def inspect_many(ids, concurrency=8, fields=None, ignore_errors=False):
+    '''
+    ids: Container IDs, names or Container() instances
+    concurrency: Number of requests to have in flight at the same time
+    fields: Only keep these keys of each result, e.g. ['Name', 'State.Running']
+        Every result is reduced as soon as it arrives, so only the requested
+        parts stay in memory.
+    ignore_errors: Skip containers that could not be inspected instead of
+        raising a WhalesnakeError after all requests are done
+    
+    Returns: dict of long id -> (reduced) output of docker inspect
+    
+    '''
+    refs = []
+    for ref in ids:
+        if isinstance(ref, Container):
+            if not ref.exists:
+                raise WhalesnakeError(
+                    'Container was not yet created: {0}'.format(ref.name)
+                )
+            ref = ref.long_id
+        refs.append(ref)
+    
+    def inspect(ref):
+        meta = dc.inspect_container(ref)
+        return meta['Id'], _project(meta, fields)
+    
+    res = {}
+    failed = []
+    for ref, out, err in _pimap(inspect, refs, concurrency):
+        if err is not None:
+            failed.append('{0}: {1}'.format(ref, err))
+            continue
+        long_id, meta = out
+        res[long_id] = meta
+    
+    if failed and not ignore_errors:
+        raise WhalesnakeError(
+            'Unable to inspect {0} container(s):\n{1}'.format(
+                len(failed), '\n'.join(failed)
+            )
+        )
+    return res
+
+def iter_containers(match=None, raw=False, fields=None, limit=None,
+                    **kwargs):
+    '''
+    Lazy version of containers(): rows are decoded while the listing is
+    received, filtered by match on the fly and turned into Container()
+    instances only when consumed.
+    
+    limit: Stop after this many (matching) containers
+    
+    Other arguments: see containers()
+    
+    '''
+    _check_quiet(kwargs, match, fields)
+    if limit is not None and not match and kwargs.get('all'):
+        # let the daemon stop early too. its limit is about the last
+        # created containers, running or not.
+        kwargs['limit'] = limit
+    return _iter_rows(_container_rows(**kwargs), _match_container, Container,
+                      match, raw, fields, limit)
+
+def iter_images(match=None, raw=False, fields=None, limit=None, **kwargs):
+    '''
+    Lazy version of images(), see iter_containers(). viz is not supported.
+    
+    limit: Stop after this many (matching) images
+    
+    '''
+    _check_quiet(kwargs, match, fields)
+    return _iter_rows(_image_rows(**kwargs), _match_image, Image,
+                      match, raw, fields, limit)
+
+def login(user, *args, **kwargs):
+    '''
+    user: Username used for login.
+    
+    Possible docker-py arguments and their defaults:
+    
+    password=None, email=None, registry=None, reauth=False
+    
+    '''
+    raise NotImplementedError
+    dc.login(user, *args, **kwargs)
+
+def pause_many(ctns, concurrency=16):
+    '''
+    Freezes many containers at once, e.g. right before a host snapshot.
+    Either all of them end up paused or, if any pause fails, the ones that
+    were paused already get unpaused again.
+    
+    ctns: Container() instances or container ids
+    concurrency: Number of requests in flight at the same time
+    
+    Returns: dict of container -> pause latency in ms. Keys are long ids for
+        Container() instances, otherwise the ids as given.
+    
+    '''
+    ctns = list(ctns)
+    latencies, failed = _bulk(_pause, ctns, concurrency)
+    if failed:
+        _, rollback_failed = _bulk(_unpause, list(latencies), concurrency)
+        msg = 'Unable to pause {0} container(s), unpaused the others ' + \
+              'again:\n{1}'
+        if rollback_failed:
+            msg += '\nUnable to unpause:\n' + '\n'.join(rollback_failed)
+        raise WhalesnakeError(msg.format(len(failed), '\n'.join(failed)))
+    _set_paused(ctns, latencies, True)
+    return latencies
+
+def ps(*args, **kwargs):
+	# alias for 'containers'
+    return containers(*args, **kwargs)
+
+def reconcile(spec, prune=None, concurrency=8, dry_run=False):
+    '''
+    Brings the containers on the daemon in line with spec, see Reconciler().
+    
+    dry_run: Only compute the plan
+    
+    Returns: the plan, a list of (action, name) tuples, if dry_run is set.
+        Otherwise the result of Reconciler.apply().
+    
+    '''
+    rec = Reconciler(spec, prune=prune, concurrency=concurrency)
+    if dry_run:
+        return rec.plan()
+    return rec.apply()
+
+def retag(mapping, remove=None, force=False, concurrency=8):
+    '''
+    Tags and untags many images at once.
+    
+    mapping: dict of new tag -> image name or id it should point to, e.g.
+        {'company/app:1.2': 'app_build:42', 'app:stable': 'app_build:42'}
+    remove: List of tags to remove. An image is never left without a tag,
+        use Image.remove() for that.
+    force: Move tags, that point to another image already
+    concurrency: Number of requests in flight at the same time
+    
+    Everything is validated against a single image listing before the first
+    request is sent. New tags are applied before old ones get removed.
+    
+    Returns: dict of long id -> tags, for every image that was touched
+    
+    '''
+    remove = remove or []
+    if isinstance(remove, basestring):
+        remove = [remove, ]
+    index = _image_index(dc.images())
+    
+    tags = {}
+    for new_tag, ref in mapping.items():
+        repo, tag = _split_tag(new_tag)
+        long_id = _resolve_image(index, ref)
+        if long_id is None:
+            raise ValueError('No such image: {0}'.format(ref))
+        if not force and index.get(repo + ':' + tag, long_id) != long_id:
+            raise WhalesnakeError(
+                'Tag "{0}" points to another image. '.format(new_tag) + \
+                'Use force=True to move it anyway.'
+            )
+        tags[repo + ':' + tag] = long_id
+    
+    untags = {}
+    for old_tag in remove:
+        repo, tag = _split_tag(old_tag)
+        long_id = index.get(repo + ':' + tag)
+        if long_id is None:
+            raise ValueError('Tag does not exist: "{0}"'.format(old_tag))
+        untags[repo + ':' + tag] = long_id
+    
+    # removing the last tag of an image would remove the image
+    remaining = {}
+    for tag, long_id in index.items():
+        if tag != long_id:
+            remaining.setdefault(long_id, set()).add(tag)
+    for tag, long_id in tags.items():
+        for other in remaining.values():
+            other.discard(tag)
+        remaining.setdefault(long_id, set()).add(tag)
+    for tag, long_id in untags.items():
+        remaining[long_id].discard(tag)
+        if not remaining[long_id]:
+            raise WhalesnakeError(
+                'Removing "{0}" would leave image {1} without a tag.'.format(
+                    tag, long_id[:12]
+                )
+            )
+    
+    def add(tag):
+        repo, tag_ = tag.rsplit(':', 1)
+        dc.tag(tags[tag], repository=repo, tag=tag_, force=force)
+    
+    _raise_failed('tag', _pmap(add, tags, concurrency))
+    _raise_failed('untag', _pmap(dc.remove_image, untags, concurrency))
+    
+    touched = set(tags.values()) | set(untags.values())
+    return dict(
+        (img['Id'], img['RepoTags'])
+        for img in dc.images() if img['Id'] in touched
+    )
+
+def run_sessions(sessions):
+    '''
+    Reads all StreamSession() instances on the calling thread until each one
+    has ended or hit its deadline.
+    
+    Returns: Nothing
+    
+    '''
+    pending = [s for s in sessions if not s.done]
+    # select.select() fails on fds >= FD_SETSIZE (1024), there may be
+    # hundreds of sessions besides the other fds of the process
+    if selectors is not None:
+        poller = selectors.DefaultSelector()
+        for s in pending:
+            poller.register(s, selectors.EVENT_READ)
+        readable = lambda wait: [key.fileobj for key, _ in poller.select(wait)]
+        
+        def forget(s):
+            # the session may have closed its socket already
+            try:
+                poller.unregister(s)
+            except (KeyError, ValueError, OSError):
+                pass
+    else:
+        poller = select.poll()
+        fds = dict((s, s.fileno()) for s in pending)
+        by_fd = dict((fd, s) for s, fd in fds.items())
+        for fd in by_fd:
+            poller.register(fd, select.POLLIN)
+        readable = lambda wait: [by_fd[fd] for fd, _ in poller.poll(
+            None if wait is None else wait * 1000
+        )]
+        forget = lambda s: poller.unregister(fds[s])
+    
+    def prune(pending):
+        for s in pending:
+            if s.done:
+                forget(s)
+        return [s for s in pending if not s.done]
+    
+    while pending:
+        now = time.time()
+        for session in pending:
+            if session.deadline is not None and now >= session.deadline:
+                session.timed_out = True
+                session.close()
+        pending = prune(pending)
+        if not pending:
+            break
+        deadlines = [s.deadline for s in pending if s.deadline is not None]
+        wait = max(0, min(deadlines) - now) if deadlines else None
+        for session in readable(wait):
+            session.read_some()
+        pending = prune(pending)
+    if selectors is not None:
+        poller.close()
+
+def search(match, official=None, automated=None, stars=False, fields=None,
+           top=None, sort=False, cache=True):
+    '''
+    match: Search query for the docker image registry.
+    official: Show only official (True) or unofficial (False) builds.
+      NOTE: Official images seem to always have 'automated' (called 'is_trusted'
+      in the raw json) set to 'False'
+    automated: Show only automated (True) or non-automated (False) builds.
+    stars: Minimum number of stars.
+    fields: Only return these keys of each result, e.g. ['name', 'star_count']
+    top: Only return the 'top' results with the most stars, best first
+    sort: Sort all results by stars, best first
+    cache: Answer from search_cache if the same query was sent within its
+        ttl (5 minutes by default)
+    
+    '''
+    imgs = search_cache.get(match) if cache else None
+    if imgs is None:
+        imgs = dc.search(match)
+        search_cache.set(match, imgs)
+    
+    if official is not None \
+      or automated is not None \
+      or stars is not False:
+      
+        filtered = []
+        for img in imgs:         
+            if official:
+                if not official == img['is_official']:
+                    continue
+            
+            if automated:
+                if not automated == img['is_trusted']:
+                    continue
+            
+            if stars:
+                if not img['star_count'] >= stars:
+                    continue
+            
+            filtered.append(img)
+        imgs = filtered
+    
+    stars_of = lambda img: img['star_count']
+    if top is not None:
+        # no need to sort everything for the first few
+        imgs = heapq.nlargest(top, imgs, key=stars_of)
+    elif sort:
+        imgs = sorted(imgs, key=stars_of, reverse=True)
+    
+    if fields:
+        return [_project(img, fields) for img in imgs]
+    # never hand out the cached rows themselves. they are flat, a shallow
+    # copy of each will do
+    return [dict(img) for img in imgs]
+
+def search_many(matches, concurrency=8, **kwargs):
+    '''
+    Sends many search queries at once.
+    
+    matches: List of search queries
+    concurrency: Number of queries in flight at the same time
+    **kwargs: Passed on to search()
+    
+    Returns: dict of query -> results
+    
+    '''
+    res = {}
+    for match, imgs, err in _pmap(lambda m: search(m, **kwargs), matches,
+                                  concurrency):
+        if err is not None:
+            raise WhalesnakeError(
+                'Search for "{0}" failed: {1}'.format(match, err)
+            )
+        res[match] = imgs
+    return res
+
+def stats_all(ctns=None, window=60, start=True):
+    '''
+    ctns: Container() instances or ids to monitor. Defaults to all running
+        containers.
+    window: Number of samples (~1 per second) kept per container and metric
+    start: Start following the stats streams right away
+    
+    Returns: a StatsMonitor() instance
+    
+    '''
+    if ctns is None:
+        ctns = containers()
+    monitor = StatsMonitor(ctns, window=window)
+    if start:
+        monitor.start()
+    return monitor
+
+def top_all(ctns=None, interval=5, window=60, ps_args='aux', start=True):
+    '''
+    ctns: Container() instances or ids to sample. Defaults to all running
+        containers.
+    interval: Seconds between samples
+    window: Number of samples kept per process and metric
+    ps_args: Options for ps, see Container.top()
+    start: Start sampling right away
+    
+    Returns: a TopSampler() instance
+    
+    '''
+    if ctns is None:
+        ctns = containers()
+    sampler = TopSampler(ctns, interval=interval, window=window,
+                         ps_args=ps_args)
+    if start:
+        sampler.start()
+    return sampler
+
+def unpause_many(ctns, concurrency=16):
+    '''
+    ctns: Container() instances or container ids
+    concurrency: Number of requests in flight at the same time
+    
+    Returns: dict of container -> unpause latency in ms, see pause_many()
+    
+    '''
+    ctns = list(ctns)
+    latencies, failed = _bulk(_unpause, ctns, concurrency)
+    _set_paused(ctns, latencies, False)
+    if failed:
+        raise WhalesnakeError(
+            'Unable to unpause {0} container(s):\n{1}'.format(
+                len(failed), '\n'.join(failed)
+            )
+        )
+    return latencies
+
+def watch(interval=5, containers=True, images=True, all=True):
+    '''
+    Polls the inventory of the daemon, see Snapshot().
+    
+    interval: Seconds between polls
+    containers, images, all: See Snapshot.take()
+    
+    Yields: dict of 'containers' and/or 'images' -> InventoryDelta(), only
+        the kinds that changed and only when something changed
+    
+    '''
+    prev = Snapshot.take(containers=containers, images=images, all=all)
+    while True:
+        time.sleep(interval)
+        curr = Snapshot.take(prev=prev, containers=containers,
+                             images=images, all=all)
+        changes = dict(
+            (kind, delta) for kind, delta in Snapshot.diff(prev, curr).items()
+            if delta.added or delta.removed or delta.changed
+        )
+        prev = curr
+        if changes:
+            yield changes
+
+def version():
+    return dc.version()
+
+def ping():
+    return dc.ping()
+
+
+
+class Container(object):
+    
+    def __init__(self, name_or_cid):
+        '''
+        name_or_cid: Either the name of a new or existing container or a
+            container ID of an existing container.
+        
+        One name per id
+        One id per name
+        
+        '''
+        self._passed_arg = name_or_cid
+        self._passed_arg_type = None
+        self.name = ''
+        self.short_id, self.long_id = None, None
+        self._diff_tracker = None
+        self._image, self._image_ref = None, None
+        
+        try:
+            # check if a cid was given
+            self.short_id, self.long_id = check_docker_id(name_or_cid)
+            self._passed_arg_type = 'ID'
+        except ValueError:
+            # not a cid, interpret as name, but check if empty
+            if len(name_or_cid) is 0:
+                raise  ValueError(
+                    'Either a valid container id or a name must be given.'
+                )
+            
+            check_container_name(name_or_cid)
+            self.name = name_or_cid
+            self._passed_arg_type = 'name'
+        
+        self._check_status()
+        
+        if self.short_id and not self.exists:
+            # cid was given, but does not exist
+            raise ValueError(
+                'No container was found for id: {0}'.format(name_or_cid)
+            )
+    
+    def __repr__(self):
+        return 'Container(name_or_cid={0!r})'.format(self._passed_arg)
+    
+    def __str__(self):
+        s = 'Container with name "{0}"'.format(self.name)
+        if self.exists:
+            s += ' and ID "{0}"'.format(self.long_id)
+        return s
+    
+    def _check_status(self):
+        '''
+        Check status of the name/id and set the missing pieces
+        
+        '''
+        # defaults
+        self.exists = False
+        self.created = False
+        self.image = None
+        self.ports = None
+        self.port_mappings = None
+        self.command = None
+        
+        self.running = False
+        self.paused = False
+        
+        for ctn in dc.containers(all=True):
+            id_match = self.short_id and ctn['Id'].startswith(self.short_id)
+            name_match = self.name and '/' + self.name in ctn['Names']
+            if id_match or name_match:
+                self.exists = True
+                self.short_id, self.long_id = check_docker_id(ctn['Id'])
+                # seems like there's only ever one name in the list
+                self.name = ctn['Names'][0][1:] # strip leading '/'
+                self.created = datetime.datetime.fromtimestamp(ctn['Created'])
+                self.image = Image(ctn['Image'])
+                self.ports = ctn['Ports']
+                self.port_mappings = _parse_ports(ctn['Ports'])
+                self.command = ctn['Command']
+                
+                # inspect gives a lot more information. write own method for it
+                meta = self._inspect_row(ctn)
+                self.running = meta['State']['Running']
+                self.paused = meta['State']['Paused']
+                break
+    
+    @property
+    def image(self):
+        # run(fast=True) only knows the reference, look it up when needed
+        if self._image is None and self._image_ref is not None:
+            self._image = Image(self._image_ref)
+        return self._image
+    
+    @image.setter
+    def image(self, value):
+        self._image = value
+        self._image_ref = None
+    
+    def run(self, image, command=None, create_conf={}, start_conf={},
+            fast=False):
+        '''
+        short hand for create() + start() + necessary error handling, see:
+        https://docs.docker.com/reference/api/
+            docker_remote_api_v1.13/#31-inside-docker-run
+        
+        fast: Skip the image lookup and the status checks after create and
+            start. The container is created by reference right away and the
+            image only gets pulled if the daemon does not know it. This takes
+            2 requests instead of ~10. The state is filled in from what was
+            sent and received: 'created' is the local time and 'ports' and
+            'port_mappings' stay None. Call _check_status() for the daemons
+            view.
+        
+        '''
+        if fast:
+            return self._run_fast(image, command, create_conf, start_conf)
+        try:
+            self.create(image, command=command, **create_conf)
+        except ValueError as e:
+            if e.args[0].find('No such image') is not -1:
+                try:
+                    i = Image(image)
+                    i.pull()
+                    # give it another shot
+                    self.create(i, command=command, **create_conf)
+                except Exception as ex:
+                    raise WhalesnakeError(
+                      'Unable to get image "{1}": {0}'.format(image, ex.args[0])
+                    )
+            else:
+                raise e
+        
+        self.start(**start_conf)
+    
+    def _run_fast(self, image, command, create_conf, start_conf):
+        self._create_fast(image, command, create_conf)
+        dc.start(self.long_id, **start_conf)
+        self.running = True
+        self.paused = False
+    
+    def _create_fast(self, image, command, create_conf):
+        if self.exists:
+            raise WhalesnakeError(
+                'Container() needs to be instantiated with an unassigned ' + \
+                'name in order to allow for creations.'
+            )
+        ref = image.long_id if isinstance(image, Image) else image
+        try:
+            out = dc.create_container(ref, name=self.name, command=command,
+                                      **create_conf)
+        except docker.errors.APIError as e:
+            if 'No such image' not in str(e):
+                raise
+            try:
+                _pull(ref)
+                out = dc.create_container(ref, name=self.name,
+                                          command=command, **create_conf)
+            except Exception as ex:
+                raise WhalesnakeError(
+                    'Unable to get image "{0}": {1}'.format(ref, ex.args[0])
+                )
+        
+        self.exists = True
+        self.short_id, self.long_id = check_docker_id(out['Id'])
+        self.created = datetime.datetime.now()
+        if isinstance(image, Image):
+            self.image = image
+        else:
+            self._image, self._image_ref = None, image
+        if command is not None and not isinstance(command, basestring):
+            command = ' '.join(command)
+        self.command = command
+        self.ports = None
+        self.port_mappings = None
+        self.running = False
+        self.paused = False
+    
+    #######
+    ## 'official' docker commands below
+    ####
+    
+    def attach(self, stdout=True, stderr=True, logs=False, timeout=None):
+        '''
+        stdout, stderr: Which streams to attach to
+        logs: Also replay what was written before attaching
+        timeout: Seconds after which the session stops reading
+        
+        Returns: a StreamSession(). Use its wait() to collect the output or
+            pass it to run_sessions() along with others.
+        
+        '''
+        if not self.running:
+            raise WhalesnakeError('Container is not running.')
+        params = 'stream=1&stdout={0:d}&stderr={1:d}&logs={2:d}'.format(
+            stdout, stderr, logs
+        )
+        tty = self.inspect()['Config']['Tty']
+        sock, data = _hijack(
+            '/containers/{0}/attach?{1}'.format(self.long_id, params)
+        )
+        return StreamSession(sock, data, timeout=timeout, tty=tty)
+    
+    def commit(self, *args, **kwargs):
+        '''
+        Possible docker-py arguments and their defaults:
+    
+        repository=None, tag=None, message=None, author=None
+        
+        '''
+        raise NotImplementedError
+        res = dc.commit(self.long_id, *args, conf=None, **kwargs)
+        return res # what does the output look like?
+    
+    def copy(self, resource, dest=None, include=None, exclude=None,
+             chunk_size=1048576):
+        '''
+        resource: Path of a file or directory inside the container
+        dest: Directory on the host to extract to. If not given, a generator of
+            (tarfile.TarInfo, file object) tuples is returned instead. The
+            file object is None for anything but regular files and can only
+            be read until the next tuple is requested.
+        include: Glob pattern or list of them. Only matching members are
+            extracted, e.g. 'tmp/*.core'
+        exclude: Glob pattern or list of them. Matching members are skipped.
+        chunk_size: Maximum number of Bytes held in memory per read
+        
+        Returns: list of extracted member names (if dest is given)
+        
+        The archive is read as a stream, skipped members are never buffered.
+        Member names start with the basename of resource, e.g. 'log/syslog'
+        for resource='/var/log'.
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Container was not yet created.')
+        if isinstance(include, basestring):
+            include = [include, ]
+        if isinstance(exclude, basestring):
+            exclude = [exclude, ]
+        members = self._copy_stream(resource, include, exclude, chunk_size)
+        if dest is None:
+            return members
+        
+        dest = os.path.realpath(dest)
+        # dest='/' would otherwise become '//'
+        prefix = dest.rstrip(os.sep) + os.sep
+        
+        def inside(path):
+            return path == dest or path.startswith(prefix)
+        
+        extracted = []
+        for member, fileobj in members:
+            path = os.path.abspath(os.path.join(dest, member.name))
+            # symlinks extracted earlier must not lead out of dest either
+            parent = os.path.realpath(os.path.dirname(path))
+            if not inside(path) or not inside(parent):
+                raise WhalesnakeError(
+                    'Refusing to extract outside of dest: {0}'.format(
+                        member.name
+                    )
+                )
+            if member.issym():
+                target = os.path.realpath(
+                    os.path.join(parent, member.linkname)
+                )
+                if os.path.isabs(member.linkname) or not inside(target):
+                    raise WhalesnakeError(
+                        'Refusing to link outside of dest: {0} -> {1}'.format(
+                            member.name, member.linkname
+                        )
+                    )
+            if member.isdir():
+                if os.path.islink(path):
+                    os.remove(path)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            elif member.isfile() or member.issym():
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                # never write through what is there already, e.g. a link
+                # from an earlier copy
+                if os.path.islink(path) or os.path.isfile(path):
+                    os.remove(path)
+                if member.issym():
+                    os.symlink(member.linkname, path)
+                else:
+                    with open(path, 'wb') as f:
+                        shutil.copyfileobj(fileobj, f, chunk_size)
+                    os.chmod(path, member.mode)
+            else:
+                # devices, fifos, hard links ...
+                continue
+            extracted.append(member.name)
+        return extracted
+    
+    def _copy_stream(self, resource, include, exclude, chunk_size):
+        raw = dc.copy(self.long_id, resource)
+        tar = tarfile.open(fileobj=raw, mode='r|', bufsize=chunk_size)
+        try:
+            for member in tar:
+                if include and not any(
+                  fnmatch.fnmatch(member.name, p) for p in include):
+                    continue
+                if exclude and any(
+                  fnmatch.fnmatch(member.name, p) for p in exclude):
+                    continue
+                fileobj = tar.extractfile(member) if member.isfile() else None
+                yield member, fileobj
+        finally:
+            tar.close()
+            raw.close()
+    
+    def create(self, image, command=None, **kwargs):
+        '''
+        image: Either a valid image id or name as string or an instance
+            of .Image()
+        command: Execute this inside the container
+        
+        Returns: : {u'Id': u'9164222a9d7...long_id_here', u'Warnings': None}
+        
+        Possible docker-py keyword arguments and their defaults:
+    
+        hostname=None, user=None, detach=False, stdin_open=False, tty=False,
+        mem_limit=0, ports=None, environment=None, dns=None, volumes=None,
+        volumes_from=None, network_disabled=False, entrypoint=None,
+        cpu_shares=None, working_dir=None, memswap_limit=0
+        
+        '''
+        if self.exists:
+            raise WhalesnakeError(
+                'Container() needs to be instantiated with an unassigned ' + \
+                'name in order to allow for creations.'
+            )
+        
+        if not isinstance(image, Image):
+            image = Image(image)
+            
+        if not image.exists:
+            raise ValueError(
+                'No such image could be found: {0}\n' + \
+                'Try to pull it first or just let Container.run() ' + \
+                'take care of it.'.format(str(image))
+            )
+        
+        out = dc.create_container(image.long_id, name=self.name,
+                                  command=command, **kwargs)
+        self._check_status()
+        return out
+    
+    def diff(self, incremental=False):
+        '''
+        incremental: Only return what changed since the last incremental call,
+            see DiffTracker.update(). The first call returns everything as
+            'added'.
+        
+        Returns: [{u'Path': u'/tmp', u'Kind': 0}, ...] with Kind being one of
+            0 (modified), 1 (added), 2 (deleted) or, if incremental is set:
+            {'added': [...], 'removed': [...]}
+        
+        '''
+        if not incremental:
+            return dc.diff(self.long_id)
+        if self._diff_tracker is None:
+            self._diff_tracker = DiffTracker(self)
+        return self._diff_tracker.update()
+    
+    def exec_run(self, cmd, timeout=None):
+        '''
+        cmd: Command to run inside the container, as string or list
+        timeout: Seconds to wait for the command to finish
+        
+        Returns: the finished StreamSession() with stdout, stderr, exit_code
+            and timed_out set
+        
+        Needs docker API >= 1.15
+        
+        '''
+        session = self.exec_session(cmd, timeout=timeout)
+        session.wait()
+        if not session.timed_out:
+            session.fetch_exit_code()
+        return session
+    
+    def exec_session(self, cmd, timeout=None):
+        '''
+        Creates and starts an exec instance, but leaves reading its output to
+        the caller, see exec_run() and exec_many().
+        
+        Returns: a StreamSession()
+        
+        '''
+        if not self.running:
+            raise WhalesnakeError('Container is not running.')
+        if isinstance(cmd, basestring):
+            cmd = shlex.split(cmd)
+        res = dc._post_json(
+            dc._url('/containers/{0}/exec'.format(self.long_id)),
+            data={'AttachStdout': True, 'AttachStderr': True, 'Cmd': cmd}
+        )
+        exec_id = dc._result(res, True)['Id']
+        sock, data = _hijack(
+            '/exec/{0}/start'.format(exec_id),
+            body={'Detach': False, 'Tty': False}
+        )
+        return StreamSession(sock, data, timeout=timeout, exec_id=exec_id)
+    
+    def export(self, path):
+        '''
+        path: String containing the filepath where the .tar should go
+        Returns: Nothing
+        
+        TODO: 
+        - path could also be a file object
+        - gzip flag
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Container was not yet created.')
+        tar = dc.export(self.long_id) # returns a 'tar' stream
+        with open(path, 'wb') as f:
+            while True:
+                l = tar.read(52428800) # 50MB
+                if not l:
+                    break
+                f.write(l)
+    
+    def inspect(self):
+        return dc.inspect_container(self.long_id)
+    
+    def _inspect_row(self, ctn):
+        # the disk cache is only used along with a fresh listing row 'ctn',
+        # the state version comes from there
+        if disk_cache is None:
+            return self.inspect()
+        version = _container_version(ctn)
+        age = _status_age(ctn.get('Status'))
+        
+        def valid(meta):
+            # an in-place restart keeps the version, but not the start time
+            if age is None:
+                return True
+            field, seconds = age
+            try:
+                when = _log_time(meta['State'][field]) / 1e9
+            except (KeyError, ValueError):
+                return False
+            return when >= time.time() - seconds - 5
+        
+        meta = disk_cache.get_container(self.long_id, version, valid)
+        if meta is None:
+            meta = self.inspect()
+            disk_cache.set_container(self.long_id, version, meta)
+        return meta
+    
+    def kill(self, signal=None):
+        if not self.running:
+            raise WhalesnakeError('Container is not running.')
+        dc.kill(self.long_id, signal)
+        self._check_status()
+
+    def logs(self, *args, **kwargs):
+        '''
+        Returns: what the container has written to stdout and stderr
+        (by default)
+        
+        Possible docker-py arguments and their defaults:
+    
+        stdout=True, stderr=True, stream=False, timestamps=False
+        
+        '''
+        if 'stream' in kwargs.keys():
+            # take care of stream. just pass it through?
+            raise NotImplementedError
+        return dc.logs(self.long_id, *args, **kwargs)
+    
+    def search_logs(self, pattern, since=None, regex=False,
+                    ignore_case=False, limit=None, collect=True):
+        '''
+        Searches the logs kept by the log store, see enable_log_store().
+        
+        pattern: Substring to look for, or a regular expression
+        since: Only lines written after this datetime (UTC) or unix time
+        regex: Whether pattern is a regular expression
+        ignore_case: Case insensitive search
+        limit: Stop after this many lines
+        collect: First fetch the lines written since the last collection
+        
+        Returns: list of LogLine() tuples: (time (datetime, UTC), stream
+            (1: stdout, 2: stderr), text), oldest first
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Container was not yet created.')
+        if log_store is None:
+            raise WhalesnakeError('No log store, see enable_log_store()')
+        if collect:
+            log_store.collect(self)
+        return log_store.search(
+            self.long_id, pattern, since=since, regex=regex,
+            ignore_case=ignore_case, limit=limit
+        )
+    
+    def pause(self):
+        if not self.running:
+            raise WhalesnakeError('Container is not running.')
+        if self.paused:
+            raise WhalesnakeError('Container is paused already.')
+        _pause(self.long_id)
+        self._check_status()
+    
+    def port(self, private_port):
+        '''
+        Returns the host port and ip for the given 'private_port':
+        [{u'HostPort': u'5000', u'HostIp': u'0.0.0.0'}]
+        
+        Answered from 'port_mappings' as of the last status check, without a
+        request. Only after run(fast=True) the daemon gets asked.
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Container was not yet created.')
+        if self.port_mappings is None:
+            return dc.port(self.long_id, private_port)
+        private_port = int(private_port)
+        # like docker-py: udp wins over tcp, exposed only is None
+        for proto in ('udp', 'tcp'):
+            found = [p for p in self.port_mappings
+                     if p.private == private_port and p.proto == proto]
+            if found:
+                published = [
+                    {'HostIp': p.ip or '0.0.0.0', 'HostPort': str(p.public)}
+                    for p in found if p.public is not None
+                ]
+                return published or None
+        return None
+    
+    def restart(self, timeout=None):
+        if not self.exists:
+            raise WhalesnakeError('Container was not yet created.')
+        if self.running:
+            raise WhalesnakeError('Container is running already.')
+        dc.restart(self.long_id, timeout)
+        self._check_status()
+    
+    def remove(self, force=False, **kwargs):
+        '''
+        force: force removal, e.g. when ctn is running
+        
+        Possible docker-py arguments and their defaults:
+    
+        link=False, volumes=False
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Container was not yet created.')
+        if self.running and not force:
+            raise WhalesnakeError(
+                'Container is running. Use force=True to remove anyway.'
+            )
+        dc.remove_container(self.long_id, force=force, **kwargs)
+        self._check_status()
+    
+    def start(self, *args, **kwargs):
+        '''
+        Returns: nothing
+        
+        Possible docker-py arguments and their defaults:
+    
+        binds=None, port_bindings=None, lxc_conf=None,
+        publish_all_ports=False, links=None, privileged=False,
+        dns=None, dns_search=None, volumes_from=None, network_mode=None
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Container was not yet created.')
+        if self.running:
+            raise WhalesnakeError('Container is running already.')
+        dc.start(self.long_id, *args, **kwargs)
+        self._check_status()
+    
+    def stats(self, stream=True):
+        '''
+        stream: Keep following the stats of the container. Otherwise a single
+            sample is returned.
+        
+        Returns: a generator of dicts (or a single dict) containing:
+            read: timestamp of the sample, as sent by the daemon
+            cpu_percent: usage of the hosts cpus, 100.0 per fully used core.
+                None for the very first sample, if the daemon does not send
+                the previous cpu values along.
+            mem_usage, mem_limit (both in Bytes), mem_percent
+            net_rx, net_tx, blk_read, blk_write: Totals in Bytes
+            net_rx_delta, net_tx_delta, blk_read_delta, blk_write_delta:
+                Bytes since the previous sample
+        
+        Needs docker API >= 1.17
+        
+        '''
+        if not self.running:
+            raise WhalesnakeError('Container is not running.')
+        samples = self._stats_stream()
+        if stream:
+            return samples
+        try:
+            for sample in samples:
+                if sample['cpu_percent'] is not None:
+                    return sample
+        finally:
+            samples.close()
+    
+    def _stats_stream(self):
+        url = dc._url('/containers/{0}/stats'.format(self.long_id))
+        res = dc._get(url, stream=True)
+        dc._raise_for_status(res)
+        prev = None
+        try:
+            for line in res.iter_lines():
+                if not line:
+                    continue
+                raw = json.loads(line)
+                sample = _stats_sample(raw, prev)
+                prev = raw
+                yield sample
+        finally:
+            res.close()
+    
+    def stop(self, **kwargs):
+        if not self.running:
+            raise WhalesnakeError('Container is not running.')
+        dc.stop(self.long_id, **kwargs)
+        self._check_status()
+    
+    def top(self, ps_args=None, parsed=False):
+        '''
+        ps_args: Options for ps, e.g. 'aux' or '-eo pid,rss,comm'
+        parsed: Return a list of Process() tuples with typed columns
+            instead of the raw {'Titles': [...], 'Processes': [[...]]}.
+            ps_args defaults to 'aux' then, which has all of them.
+        
+        '''
+        if not self.running:
+            raise WhalesnakeError('Container is not running.')
+        if parsed and ps_args is None:
+            ps_args = 'aux'
+        if ps_args is None:
+            raw = dc.top(self.long_id)
+        else:
+            # docker-py is lacking support for ps options
+            raw = dc._result(dc._get(
+                dc._url('/containers/{0}/top'.format(self.long_id)),
+                params={'ps_args': ps_args}
+            ), True)
+        return _parse_top(raw) if parsed else raw
+    
+    def unpause(self):
+        if not self.paused:
+            raise WhalesnakeError('Container is not paused.')
+        _unpause(self.long_id)
+        self._check_status()
+    
+    def wait(self):
+        return dc.wait(self.long_id)
+
+
+
+class Image(object):
+
+    def __init__(self, repo_or_iid, _imgs=None):
+        '''
+        Multiple tags per id
+        One id per tag
+        Assumes :latest if no tag was given for repo
+        
+        _imgs: An image listing to use instead of asking the daemon
+        
+        '''
+        self._passed_arg = repo_or_iid
+        self.names = []
+        self.initial_name = ''
+        self.short_id, self.long_id = None, None
+        self.build_log = ''
+        self.build_report = []
+            
+        try:
+            # check if an iid was given
+            self.short_id, self.long_id = check_docker_id(repo_or_iid)
+        except ValueError:
+            # not an iid, interpret as name, but check if empty
+            if len(repo_or_iid) is 0:
+                raise ValueError(
+                    'Either a valid image id or "[namespace/]repo[:tag]" ' + \
+                    'must be given.'
+                )
+            
+            ns, repo, tag = check_image_name(repo_or_iid)
+            
+            if not tag:
+                # assume we want the latest image from 'repo'
+                repo_or_iid += ':latest'
+            self.names.append(repo_or_iid)
+            self.initial_name = repo_or_iid
+        
+        self._check_status(_imgs)
+        
+        if self.short_id and not self.exists:
+            raise ValueError(
+                'No image was found for id: {0}'.format(repo_or_iid)
+            )
+    
+    def __repr__(self):
+        return 'Image(repo_or_iid={0!r})'.format(self._passed_arg)
+    
+    def __str__(self):
+        if self.exists:
+            s = 'Image with names "{0}"'.format(', '.join(self.names))
+            s += ' and ID "{0}"'.format(self.long_id)
+        else:
+            s = 'Image with name "{0}"'.format(self.initial_name)
+        return s
+    
+    def _check_status(self, imgs=None):
+        '''
+        Check status of the tag/id and set the missing pieces
+        
+        imgs: An image listing to use instead of asking the daemon
+        
+        '''
+        # defaults
+        self.exists = False
+        self.created = False
+        self.parent_id = None
+        self.virtual_size = None
+        
+        for img in dc.images() if imgs is None else imgs:
+            id_match = self.short_id and img['Id'].startswith(self.short_id)
+            tag_match = self.initial_name \
+                            and self.initial_name in img['RepoTags']
+            if id_match or tag_match:
+                self.exists = True
+                self.short_id, self.long_id = check_docker_id(img['Id'])
+                self.names = img['RepoTags'] # add all tags
+                self.created = datetime.datetime.fromtimestamp(img['Created'])
+                self.parent_id = img['ParentId']
+                # docker uses base 10 for sizes i.e. 1kB = 1000B
+                self.virtual_size = img['VirtualSize'] # in Bytes
+                # img['Size'] seems to always be 0
+                break
+    
+    #######
+    ## 'official' docker commands below
+    ####
+    
+    def build(self, build_src, build_type, rm=True, **kwargs):
+        '''
+        build_src: Object matching the build_type (open file, file-like obj ...)
+        build_type: The type of build_src. One of:
+            'tar', 'tar.gz', 'file', 'url', 'path', 'github', 'git'
+        rm: Remove intermediate containers. Defaults to True on the command
+            line, but not in docker-py
+            
+        Returns: Nothing. The output of the build is kept in build_log, its
+            steps are in build_report as a list of BuildStep() tuples.
+        
+        Possible docker-py arguments and their defaults:
+        quiet=False, nocache=False, timeout=None
+        
+        '''
+        # add option to 'print' the output received through stream
+        # optional: autodetect type (w/ https://github.com/ahupp/python-magic ?)
+        
+        if self.exists:
+            raise WhalesnakeError(
+                'Image() needs to be instantiated with a name instead of ' + \
+                'an image ID in order to allow for builds.'
+            )
+        
+        args = _build_args(self.initial_name, build_src, build_type, rm)
+        if kwargs:
+            args.update(kwargs)
+        
+        self.build_log, self.build_report, err = _build(args)
+        if err is not None:
+            raise err
+        # update meta data
+        self._check_status()
+        self.build_report = _build_sizes(self.build_report, self)
+    
+    def history(self, tags=False):
+        '''
+        tags: Replace the 'Tags' of the layers, as cached with the history,
+            with their current ones, from one listing of all images
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Image does not yet exist')
+        # callers are free to modify what they get
+        hist = copy.deepcopy(self._parsed_history())
+        if tags:
+            current = _layer_tags()
+            for entry in hist:
+                entry['Tags'] = list(current.get(entry['Id'], ())) or None
+        return hist
+    
+    def _parsed_history(self):
+        # belongs to the image id and never changes, except for the tags
+        key = (self.long_id, 'history')
+        hist = image_cache.get(key)
+        if hist is None:
+            raw = self._cached('history', dc.history)
+            hist = json.loads(raw)
+            image_cache.set(key, hist, size=len(raw))
+        return hist
+    
+    def layers(self, tags=True):
+        '''
+        tags: Look up the current tags of the layers, from one listing of
+            all images. Otherwise their tags are empty.
+        
+        Returns: The history as a list of Layer() tuples, newest first:
+            (id, created (datetime), created_by, size (Bytes), tags)
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Image does not yet exist')
+        key = (self.long_id, 'layers')
+        layers = image_cache.get(key)
+        if layers is None:
+            layers = [
+                Layer(
+                    entry['Id'],
+                    datetime.datetime.fromtimestamp(entry['Created']),
+                    entry.get('CreatedBy', ''),
+                    entry.get('Size', 0),
+                    (),
+                )
+                for entry in self._parsed_history()
+            ]
+            # roughly the size of the history it was made of
+            image_cache.set(key, layers, size=sum(
+                100 + len(l.created_by) for l in layers
+            ))
+        if not tags:
+            return list(layers)
+        current = _layer_tags()
+        return [layer._replace(tags=current.get(layer.id, ()))
+                for layer in layers]
+    
+    def import_(self):
+        raise NotImplementedError
+        self._check_status()
+    
+    def inspect(self):
+        if not self.exists:
+            raise WhalesnakeError('Image does not yet exist')
+        key = (self.long_id, 'inspect')
+        meta = image_cache.get(key)
+        if meta is None:
+            meta = self._cached('inspect', dc.inspect_image)
+            image_cache.set(key, meta, size=len(json.dumps(meta)))
+        # callers are free to modify what they get
+        return copy.deepcopy(meta)
+    
+    def _cached(self, kind, fetch):
+        # image metadata never changes for an id
+        if disk_cache is None:
+            return fetch(self.long_id)
+        data = disk_cache.get_image(self.long_id, kind)
+        if data is None:
+            data = fetch(self.long_id)
+            disk_cache.set_image(self.long_id, kind, data)
+        return data
+    
+    def pull(self, force=False):
+        if not self.exists or force:
+            _pull(self.initial_name)
+            self._check_status()
+        else:
+            raise WhalesnakeError(
+                'Image exists. Use force=True to pull anyway.'
+            )
+    
+    def push(self):
+        # might requrire login?
+        raise NotImplementedError
+        if not self.exists:
+            raise WhalesnakeError('Image does not yet exist')
+    
+    def remove(self, force=False, no_prune=False):
+        '''
+        Removes the image.
+        
+        force: Needed for removal, if the image has multiple tags
+        no_prune: Do not delete untagged parents
+        
+        Returns: Nothing
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Image does not yet exist')
+        
+        if len(self.names) > 1:
+            if force:
+                # why does docker only untag and not delete images even though
+                # the force flag is set?
+                for name in self.names:
+                    dc.remove_image(self.long_id, force, no_prune)
+            else:
+                raise WhalesnakeError(
+                    'Image is tagged in multiple repositories. ' + \
+                    'Use force=True to remove anyway'
+                )
+        else:
+            dc.remove_image(self.long_id, force, no_prune)
+        
+        self._check_status()
+    
+    def tag(self, tags, force=False):
+        '''
+        tags: string or list of strings, that the image should be tagged with
+        force: Enforce the tag
+        
+        Returns: nothing
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Image does not yet exist')
+        if isinstance(tags, basestring):
+            tags = [tags, ]
+        # validate all of them before anything is sent
+        args = [_split_tag(tag) for tag in tags]
+        try:
+            _raise_failed('tag', _pmap(
+                lambda a: dc.tag(self.long_id, repository=a[0], tag=a[1],
+                                 force=force),
+                args
+            ))
+        finally:
+            # some may have been applied anyway
+            self._check_status()
+    
+    def untag(self, tags=None):
+        '''
+        Untags are only possible when instantiated with a name and the total
+        number of tags is greater than 1. Anything else would result in an image
+        removal.
+        
+        tags: A string or a list of strings. They will be removed as tags from
+            the underlying image id .
+        
+        Returns: nothing
+        
+        '''
+        if not self.exists:
+            raise WhalesnakeError('Image does not yet exist')
+            
+        if tags:
+            if isinstance(tags, basestring):
+                tags = [tags, ]
+            if not len(tags) < len(self.names):
+                raise WhalesnakeError(
+                    'Only n-1 untags are possible, where n is the total ' + \
+                    'number of existing tags'
+                )
+            # assume latest if no actual tag is given
+            tags = [tag if ':' in tag else tag + ':latest' for tag in tags]
+            for tag in tags:
+                if not tag in self.names:
+                    raise ValueError(
+                        'Tag does not exist: "{0}"'.format(tag)
+                    )
+            try:
+                _raise_failed('untag', _pmap(dc.remove_image, tags))
+            finally:
+                # some may have been removed anyway
+                self._check_status()
+                
+        elif self.initial_name in self.names and len(self.names) > 1:
+            dc.remove_image(self.initial_name)
+            self._check_status()
+            #self.initial_name = ''
+            
+        else:
+            raise WhalesnakeError(
+                'Either not instantiated with a name or number of ' + \
+                'existing tags is < 2'
+            )
+
+
+
+
+class RingBuffer(object):
+    
+    def __init__(self, size, typecode='d'):
+        '''
+        Fixed size buffer of numbers, that overwrites the oldest values.
+        
+        size: Number of values to keep
+        typecode: array.array type of the values, e.g. 'd' (float), 'l' (int)
+        
+        '''
+        if size < 1:
+            raise ValueError('Size must be at least 1.')
+        self.size = size
+        self._values = array.array(typecode, [0] * size)
+        self._next = 0
+        self._count = 0
+    
+    def __len__(self):
+        return self._count
+    
+    def __iter__(self):
+        # oldest first
+        start = (self._next - self._count) % self.size
+        for i in range(self._count):
+            yield self._values[(start + i) % self.size]
+    
+    def __repr__(self):
+        return 'RingBuffer(size={0!r})'.format(self.size)
+    
+    def append(self, value):
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+    
+    def last(self):
+        if not self._count:
+            return None
+        return self._values[(self._next - 1) % self.size]
+    
+    def mean(self):
+        if not self._count:
+            return None
+        return float(sum(self)) / self._count
+    
+    def max(self):
+        if not self._count:
+            return None
+        return max(self)
+
+
+
+class StatsMonitor(object):
+    
+    FIELDS = ('cpu_percent', 'mem_usage', 'mem_percent', 'net_rx_delta',
+              'net_tx_delta', 'blk_read_delta', 'blk_write_delta')
+    
+    def __init__(self, ctns, window=60):
+        '''
+        Follows the stats streams of many containers at once, one reader
+        thread per stream, and keeps the last 'window' samples of every
+        metric in FIELDS in a RingBuffer().
+        
+        ctns: Container() instances or container ids
+        window: Number of samples to keep per container and metric
+        
+        '''
+        self.window = window
+        self.containers = {}
+        for ctn in ctns:
+            if not isinstance(ctn, Container):
+                ctn = Container(ctn)
+            self.containers[ctn.long_id] = ctn
+        self.windows = {}
+        for long_id in self.containers:
+            self.windows[long_id] = dict(
+                (field, RingBuffer(window)) for field in self.FIELDS
+            )
+        self.errors = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+    
+    def __repr__(self):
+        return 'StatsMonitor(containers={0!r})'.format(len(self.containers))
+    
+    def _follow(self, ctn):
+        try:
+            samples = ctn.stats(stream=True)
+            for sample in samples:
+                if self._stopped.is_set():
+                    samples.close()
+                    break
+                if sample['cpu_percent'] is None:
+                    continue
+                with self._lock:
+                    for field, buf in self.windows[ctn.long_id].items():
+                        buf.append(sample[field])
+        except Exception as e:
+            self.errors[ctn.long_id] = e
+    
+    def start(self):
+        if self._threads:
+            raise WhalesnakeError('StatsMonitor was already started, or its '
+                                  'readers did not stop yet.')
+        self._stopped.clear()
+        for ctn in self.containers.values():
+            t = threading.Thread(target=self._follow, args=(ctn, ))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+    
+    def stop(self, timeout=5):
+        '''
+        Readers finish with the next sample they receive, i.e. within ~1 sec.
+        
+        timeout: Seconds to wait for all of them. Readers still running after
+            that are kept, start() raises until they are gone.
+        
+        Returns: True if all readers finished
+        
+        '''
+        self._stopped.set()
+        deadline = time.time() + timeout
+        for t in self._threads:
+            t.join(max(0, deadline - time.time()))
+        self._threads = [t for t in self._threads if t.is_alive()]
+        return not self._threads
+    
+    def summary(self):
+        '''
+        Returns: dict of long id -> metric -> {'last': x, 'mean': y, 'max': z}
+        
+        '''
+        res = {}
+        with self._lock:
+            for long_id, bufs in self.windows.items():
+                res[long_id] = dict(
+                    (field, {'last': buf.last(), 'mean': buf.mean(),
+                             'max': buf.max()})
+                    for field, buf in bufs.items()
+                )
+        return res
+
+
+
+class TopSampler(object):
+    
+    FIELDS = ('cpu', 'mem', 'rss')
+    
+    def __init__(self, ctns, interval=5, window=60, ps_args='aux',
+                 concurrency=8):
+        '''
+        Polls the process tables of many containers at a fixed rate, see
+        top_all(). The last 'window' values of every metric in FIELDS are
+        kept per process in RingBuffer()s.
+        
+        ctns: Container() instances or container ids
+        interval: Seconds between samples, the time a sample takes included
+        window: Number of samples to keep per process and metric
+        ps_args: Options for ps. Must include the columns of FIELDS.
+        concurrency: Number of top requests in flight at the same time
+        
+        '''
+        self.interval = interval
+        self.window = window
+        self.ps_args = ps_args
+        self.concurrency = concurrency
+        self.containers = {}
+        for ctn in ctns:
+            if not isinstance(ctn, Container):
+                ctn = Container(ctn)
+            self.containers[ctn.long_id] = ctn
+        self.samples = 0
+        self.errors = {}
+        # (long id, pid) -> {'command': ..., 'seen': sample number,
+        # field -> RingBuffer()}
+        self.processes = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+    
+    def __repr__(self):
+        return 'TopSampler(containers={0!r})'.format(len(self.containers))
+    
+    def sample(self):
+        '''
+        Takes one sample of all containers.
+        
+        '''
+        results = _pmap(
+            lambda ctn: ctn.top(ps_args=self.ps_args, parsed=True),
+            list(self.containers.values()), self.concurrency
+        )
+        with self._lock:
+            self.samples += 1
+            for ctn, procs, err in results:
+                if err is not None:
+                    self.errors[ctn.long_id] = err
+                    continue
+                self.errors.pop(ctn.long_id, None)
+                for proc in procs:
+                    key = (ctn.long_id, proc.pid)
+                    entry = self.processes.get(key)
+                    if entry is None or entry['command'] != proc.command:
+                        # new, or the pid got reused
+                        entry = self.processes[key] = dict(
+                            (field, RingBuffer(self.window,
+                                               'l' if field == 'rss' else 'd'))
+                            for field in self.FIELDS
+                        )
+                        entry['command'] = proc.command
+                    entry['seen'] = self.samples
+                    for field in self.FIELDS:
+                        value = getattr(proc, field)
+                        if value is not None:
+                            entry[field].append(value)
+            # forget processes that are gone for a whole window
+            for key in [key for key, entry in self.processes.items()
+                        if self.samples - entry['seen'] >= self.window]:
+                del self.processes[key]
+    
+    def _run(self):
+        next_sample = time.time()
+        while not self._stopped.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                self.errors[None] = e
+            # fixed rate: slow samples don't shift the following ones
+            next_sample += self.interval
+            now = time.time()
+            if next_sample < now:
+                next_sample = now
+            self._stopped.wait(next_sample - now)
+    
+    def start(self):
+        if self._thread is not None:
+            raise WhalesnakeError('TopSampler was already started.')
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def top(self, k=10, field='cpu', mean=False):
+        '''
+        k: Number of processes to return
+        field: One of FIELDS
+        mean: Rank by the mean over the window instead of the last value
+        
+        Returns: list of (value, long id, pid, command) tuples, largest first.
+            Only processes seen in the last sample are considered.
+        
+        '''
+        if field not in self.FIELDS:
+            raise ValueError('field must be one of: ' + ', '.join(self.FIELDS))
+        with self._lock:
+            candidates = [
+                (entry[field].mean() if mean else entry[field].last(),
+                 key[0], key[1], entry['command'])
+                for key, entry in self.processes.items()
+                if entry['seen'] == self.samples and len(entry[field])
+            ]
+        return heapq.nlargest(k, candidates, key=lambda c: c[0])
+
+
+
+class PathTrie(object):
+    
+    # key of a nodes value. can't clash with a path component, as empty
+    # components are dropped
+    _VALUE = ''
+    
+    def __init__(self):
+        '''
+        Maps absolute paths to values. Every path component is stored only
+        once, no matter how many paths share it, and all paths below a
+        prefix can be found without scanning the others.
+        
+        '''
+        self._root = {}
+        self._len = 0
+    
+    def __len__(self):
+        return self._len
+    
+    def __contains__(self, path):
+        node = self._node(path)
+        return node is not None and self._VALUE in node
+    
+    def __iter__(self):
+        for path, _ in self.items():
+            yield path
+    
+    def __repr__(self):
+        return 'PathTrie(paths={0!r})'.format(self._len)
+    
+    @staticmethod
+    def _parts(path):
+        return [part for part in path.split('/') if part]
+    
+    def _node(self, path):
+        node = self._root
+        for part in self._parts(path):
+            node = node.get(part)
+            if node is None:
+                return None
+        return node
+    
+    def add(self, path, value=None):
+        node = self._root
+        for part in self._parts(path):
+            node = node.setdefault(part, {})
+        if not self._VALUE in node:
+            self._len += 1
+        node[self._VALUE] = value
+    
+    def get(self, path, default=None):
+        node = self._node(path)
+        if node is None or not self._VALUE in node:
+            return default
+        return node[self._VALUE]
+    
+    def remove(self, path):
+        parts = self._parts(path)
+        nodes = [self._root]
+        for part in parts:
+            node = nodes[-1].get(part)
+            if node is None:
+                raise KeyError(path)
+            nodes.append(node)
+        if not self._VALUE in nodes[-1]:
+            raise KeyError(path)
+        del nodes[-1][self._VALUE]
+        self._len -= 1
+        # prune nodes, that do not lead to any other path anymore
+        for part, parent, node in reversed(list(zip(parts, nodes, nodes[1:]))):
+            if node:
+                break
+            del parent[part]
+    
+    def items(self, prefix='/'):
+        '''
+        Yields: (path, value) tuples for prefix and every path below it,
+            sorted by path
+        
+        '''
+        parts = self._parts(prefix)
+        node = self._node(prefix)
+        if node is None:
+            return
+        stack = [(parts, node)]
+        while stack:
+            parts, node = stack.pop()
+            if self._VALUE in node:
+                yield '/' + '/'.join(parts), node[self._VALUE]
+            for part in sorted(node, reverse=True):
+                if part != self._VALUE:
+                    stack.append((parts + [part], node[part]))
+    
+    def count(self, prefix='/'):
+        return sum(1 for _ in self.items(prefix))
+
+
+
+class DiffTracker(object):
+    
+    KINDS = {0: 'modified', 1: 'added', 2: 'deleted'}
+    
+    def __init__(self, ctn):
+        '''
+        Keeps the last seen change set of a containers filesystem in a
+        PathTrie() and tells what changed in between two snapshots.
+        
+        ctn: A Container() instance or a container id
+        
+        '''
+        if not isinstance(ctn, Container):
+            ctn = Container(ctn)
+        if not ctn.exists:
+            raise WhalesnakeError('Container was not yet created.')
+        self.container = ctn
+        self.snapshot = PathTrie()
+        # the same change set as a dict, to compare against
+        self._kinds = {}
+    
+    def __repr__(self):
+        return 'DiffTracker(ctn={0!r})'.format(self.container)
+    
+    def update(self):
+        '''
+        Fetches the current change set and replaces the snapshot with it.
+        The daemon always sends the full change set, but only what changed
+        since the last call is touched in the snapshot.
+        
+        Returns: {'added': [...], 'removed': [...]} in the format of
+            Container.diff(). A path whose Kind changed shows up in both.
+        
+        '''
+        current = dict(
+            (c['Path'], c['Kind']) for c in dc.diff(self.container.long_id)
+        )
+        old = set(self._kinds.items())
+        new = set(current.items())
+        removed = [{'Path': path, 'Kind': kind}
+                   for path, kind in sorted(old - new)]
+        added = [{'Path': path, 'Kind': kind}
+                 for path, kind in sorted(new - old)]
+        
+        for change in removed:
+            if change['Path'] not in current:
+                self.snapshot.remove(change['Path'])
+        for change in added:
+            self.snapshot.add(change['Path'], change['Kind'])
+        self._kinds = current
+        
+        return {'added': added, 'removed': removed}
+    
+    def changed_under(self, prefix):
+        '''
+        Returns: the changes of the snapshot at and below prefix, e.g.
+            changed_under('/var/log')
+        
+        '''
+        return [
+            {'Path': path, 'Kind': kind}
+            for path, kind in self.snapshot.items(prefix)
+        ]
+    
+    def _file_sizes(self, paths, batch=500):
+        '''
+        Returns: {path: size in Bytes} of the paths that still exist in the
+            container, using stat inside of it
+        
+        '''
+        sizes = {}
+        for i in range(0, len(paths), batch):
+            session = self.container.exec_run(
+                ['stat', '-c', '%s %n'] + paths[i:i + batch]
+            )
+            # missing paths only show up on stderr
+            for line in session.stdout.decode('utf-8', 'replace').splitlines():
+                size, _, path = line.partition(' ')
+                if size.isdigit():
+                    sizes[path] = int(size)
+        return sizes
+    
+    def summary(self, prefix='/', sizes=False):
+        '''
+        sizes: Also add up the sizes of the added and modified paths, which
+            runs stat in the container, see Container.exec_run()
+        
+        Returns: number of changes per kind at and below prefix, e.g.
+            {'modified': 3, 'added': 12, 'deleted': 0, 'total': 15}
+            and, with sizes set, their Bytes per kind as 'modified_size',
+            'added_size' and 'total_size'. Paths with changes below them,
+            i.e. directories, are not counted in there.
+        
+        '''
+        res = dict((name, 0) for name in self.KINDS.values())
+        changes = list(self.snapshot.items(prefix))
+        for _, kind in changes:
+            res[self.KINDS[kind]] += 1
+        res['total'] = sum(res.values())
+        if sizes:
+            # sorted by path, so whatever is below a path comes right after it
+            leaves = [
+                (path, kind) for (path, kind), (after, _) in
+                zip(changes, changes[1:] + [('', None)])
+                if self.KINDS[kind] != 'deleted' and
+                not after.startswith(path.rstrip('/') + '/')
+            ]
+            found = self._file_sizes([path for path, _ in leaves])
+            res['modified_size'] = res['added_size'] = 0
+            for path, kind in leaves:
+                res[self.KINDS[kind] + '_size'] += found.get(path, 0)
+            res['total_size'] = res['modified_size'] + res['added_size']
+        return res
+
+
+
+class StreamDemuxer(object):
+    
+    # stdin is never sent back
+    STDOUT = 1
+    STDERR = 2
+    
+    def __init__(self, tty=False):
+        '''
+        Splits the multiplexed stream of attach/exec into stdout and stderr.
+        Each frame starts with an 8 Byte header: stream type, 3 padding Bytes
+        and the payload length as big endian uint32.
+        
+        tty: Containers with a tty send a raw stream, that is all stdout
+        
+        '''
+        self.tty = tty
+        self.stdout = bytearray()
+        self.stderr = bytearray()
+        self._pending = bytearray()
+    
+    def feed(self, data):
+        '''
+        data: The next bytes (or bytearray/memoryview) of the stream. Frames
+            may be split across calls.
+        
+        '''
+        if self.tty:
+            self.stdout += data
+            return
+        self._pending += data
+        # headers are read and payloads sliced in place, without copies
+        view = memoryview(self._pending)
+        pos = 0
+        end = len(view)
+        while end - pos >= 8:
+            stream, length = struct.unpack_from('>BxxxL', view, pos)
+            if end - pos - 8 < length:
+                break
+            out = self.stderr if stream == self.STDERR else self.stdout
+            out += view[pos + 8:pos + 8 + length]
+            pos += 8 + length
+        # the bytearray can't be resized while a view exports it
+        del view
+        del self._pending[:pos]
+
+
+
+class StreamSession(object):
+    
+    def __init__(self, sock, data=b'', timeout=None, tty=False, exec_id=None):
+        '''
+        A hijacked connection to the daemon, e.g. from Container.attach() or
+        Container.exec_session().
+        
+        sock: The connected socket, after the HTTP response headers
+        data: Bytes that were already received after the headers
+        timeout: Seconds, after which reading is given up
+        tty: Whether the stream is raw instead of multiplexed
+        exec_id: Id of the exec instance, if any
+        
+        '''
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.exec_id = exec_id
+        self.deadline = time.time() + timeout if timeout is not None else None
+        self.done = False
+        self.timed_out = False
+        self.exit_code = None
+        self._demux = StreamDemuxer(tty=tty)
+        self._chunk = bytearray(65536)
+        if data:
+            self._demux.feed(data)
+    
+    def __repr__(self):
+        return 'StreamSession(exec_id={0!r})'.format(self.exec_id)
+    
+    @property
+    def stdout(self):
+        return bytes(self._demux.stdout)
+    
+    @property
+    def stderr(self):
+        return bytes(self._demux.stderr)
+    
+    def fileno(self):
+        return self.sock.fileno()
+    
+    def read_some(self):
+        '''
+        Reads whatever is available right now without blocking.
+        
+        '''
+        if self.done:
+            return
         try:
-            self.create(image, command=command, **create_conf)
-        except ValueError as e:
-            if e.args[0].find('No such image') is not -1:
-                try:
-                    i = Image(image)
-                    i.pull()
-                    # give it another shot
-                    self.create(i, command=command, **create_conf)
-                except Exception as ex:
-                    raise WhalesnakeError(
-                      'Unable to get image "{1}": {0}'.format(image, ex.args[0])
-                    )
+            n = self.sock.recv_into(self._chunk)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not n:
+            self.close()
+            return
+        self._demux.feed(memoryview(self._chunk)[:n])
+    
+    def wait(self):
+        '''
+        Reads until the stream ends or the deadline is reached.
+        
+        Returns: self
+        
+        '''
+        run_sessions([self])
+        return self
+    
+    def close(self):
+        self.done = True
+        self.sock.close()
+    
+    def fetch_exit_code(self):
+        if self.exec_id is None:
+            raise WhalesnakeError('Not an exec session.')
+        res = dc._get(dc._url('/exec/{0}/json'.format(self.exec_id)))
+        self.exit_code = dc._result(res, True)['ExitCode']
+        return self.exit_code
+
+
+
+class Reconciler(object):
+    
+    def __init__(self, spec, prune=None, concurrency=8):
+        '''
+        spec: dict of container name -> image name or a dict with the keys:
+            image: required
+            command: string or list
+            create_conf: keyword arguments for Container.create()
+            start_conf: keyword arguments for Container.start()
+            running: Whether the container should run, defaults to True
+            depends_on: names of containers that have to be up first. Names
+                from start_conf['links'] are added automatically.
+        prune: Glob pattern. Containers with a matching name, that are not
+            part of spec, get removed. Nothing is removed by default.
+        concurrency: Number of daemon requests in flight at the same time
+        
+        The actual state is read once, from a single container and image
+        listing. Existing containers are recreated if they are based on a
+        different image id than spec asks for, if their command differs or
+        if a container they link to gets recreated.
+        
+        '''
+        self.spec = {}
+        for name, conf in spec.items():
+            check_container_name(name)
+            if isinstance(conf, basestring):
+                conf = {'image': conf}
+            conf = dict(conf)
+            if not conf.get('image'):
+                raise ValueError('No image given for: {0}'.format(name))
+            conf.setdefault('command', None)
+            conf.setdefault('create_conf', {})
+            conf.setdefault('start_conf', {})
+            conf.setdefault('running', True)
+            depends_on = set(conf.get('depends_on', []))
+            links = conf['start_conf'].get('links') or {}
+            if isinstance(links, dict):
+                links = links.items()
+            conf['links'] = set(name for name, alias in links)
+            depends_on.update(conf['links'])
+            conf['depends_on'] = depends_on
+            self.spec[name] = conf
+        self.prune = prune
+        self.concurrency = concurrency
+        self.actual = None
+        self.images = None
+    
+    def __repr__(self):
+        return 'Reconciler(containers={0!r})'.format(len(self.spec))
+    
+    def snapshot(self):
+        '''
+        Reads the actual state of the daemon: one container and one image
+        listing.
+        
+        '''
+        self.actual = {}
+        # untruncated, commands get compared
+        for ctn in dc.containers(all=True, trunc=False):
+            for name in ctn['Names']:
+                # names of links look like /other_ctn/alias
+                if name.count('/') == 1:
+                    self.actual[name[1:]] = ctn
+        self.images = _image_index(dc.images())
+    
+    def _differs(self, name, ctn):
+        conf = self.spec[name]
+        want = _resolve_image(self.images, conf['image'])
+        have = _resolve_image(self.images, ctn['Image'])
+        if want is None or want != have:
+            return True
+        cmd = conf['command']
+        if cmd is not None:
+            # docker-py splits strings like a shell, the listing shows the
+            # arguments joined by spaces, quotes gone
+            if isinstance(cmd, basestring):
+                cmd = shlex.split(cmd)
+            cmd = ' '.join(cmd)
+            # the listing shows entrypoint and command joined together
+            if not ctn['Command'].endswith(cmd):
+                return True
+        return False
+    
+    def plan(self):
+        '''
+        Takes a snapshot and computes the necessary steps.
+        
+        Returns: list of (action, name) tuples. Actions are 'pull' (name is
+            an image then), 'remove', 'stop', 'recreate', 'create' and
+            'start'. The list is in the order apply() executes them.
+        
+        '''
+        self.snapshot()
+        steps = []
+        for image in sorted(set(c['image'] for c in self.spec.values())):
+            if _resolve_image(self.images, image) is None:
+                steps.append(('pull', image))
+        
+        if self.prune:
+            for name in sorted(self.actual):
+                if fnmatch.fnmatch(name, self.prune) \
+                  and not name in self.spec:
+                    steps.append(('remove', name))
+        
+        levels = _levels(dict(
+            (name, conf['depends_on']) for name, conf in self.spec.items()
+        ))
+        # dependents go down first, then everything comes up in order
+        for level in reversed(levels):
+            for name in level:
+                ctn = self.actual.get(name)
+                if ctn and ctn['Status'].startswith('Up') \
+                  and not self.spec[name]['running'] \
+                  and not self._differs(name, ctn):
+                    steps.append(('stop', name))
+        # links point to container ids, which change with a recreate
+        recreated = set()
+        for level in levels:
+            for name in level:
+                ctn = self.actual.get(name)
+                if ctn is None:
+                    steps.append(('create', name))
+                elif self._differs(name, ctn) \
+                  or self.spec[name]['links'] & recreated:
+                    steps.append(('recreate', name))
+                    recreated.add(name)
+                elif self.spec[name]['running'] \
+                  and not ctn['Status'].startswith('Up'):
+                    steps.append(('start', name))
+        return steps
+    
+    def _execute(self, action, name):
+        if action == 'pull':
+            _pull(name)
+            return
+        if action in ('remove', 'recreate'):
+            dc.remove_container(self.actual[name]['Id'], force=True)
+        if action == 'stop':
+            dc.stop(self.actual[name]['Id'])
+            return
+        if action == 'remove':
+            return
+        conf = self.spec[name]
+        if action in ('create', 'recreate'):
+            res = dc.create_container(conf['image'], name=name,
+                                      command=conf['command'],
+                                      **conf['create_conf'])
+            long_id = res['Id']
+        else:
+            long_id = self.actual[name]['Id']
+        if conf['running']:
+            dc.start(long_id, **conf['start_conf'])
+    
+    def apply(self, plan=None):
+        '''
+        plan: Result of plan(). A fresh one is computed if not given.
+        
+        Steps without dependencies between each other run in parallel.
+        Containers whose dependencies failed are skipped.
+        
+        Returns: {'done': [(action, name), ...],
+                  'failed': {container name: exception, ...},
+                  'failed_pulls': {image name: exception, ...},
+                  'skipped': [(action, name), ...]}
+        
+        '''
+        if plan is None:
+            plan = self.plan()
+        res = {'done': [], 'failed': {}, 'failed_pulls': {}, 'skipped': []}
+        
+        def run(steps):
+            for (action, name), _, err in _pmap(
+              lambda step: self._execute(*step), steps, self.concurrency):
+                if err is None:
+                    res['done'].append((action, name))
+                elif action == 'pull':
+                    res['failed_pulls'][name] = err
+                else:
+                    res['failed'][name] = err
+        
+        run([step for step in plan if step[0] == 'pull'])
+        run([step for step in plan if step[0] == 'remove'])
+        
+        levels = _levels(dict(
+            (name, conf['depends_on']) for name, conf in self.spec.items()
+        ))
+        for phase, level_order in (('down', reversed(levels)), ('up', levels)):
+            for level in level_order:
+                steps = []
+                for step in plan:
+                    action, name = step
+                    if not name in level:
+                        continue
+                    if (action == 'stop') != (phase == 'down'):
+                        continue
+                    failed = [d for d in self.spec[name]['depends_on']
+                              if d in res['failed']]
+                    if self.spec[name]['image'] in res['failed_pulls']:
+                        failed.append(self.spec[name]['image'])
+                    if failed and phase == 'up':
+                        res['skipped'].append(step)
+                        res['failed'][name] = WhalesnakeError(
+                            'Dependency failed: {0}'.format(', '.join(failed))
+                        )
+                        continue
+                    steps.append(step)
+                run(steps)
+        return res
+
+
+
+class ContainerPool(object):
+    
+    def __init__(self, image, command=None, create_conf={}, start_conf={},
+                 size=4, paused=False, max_idle=600, prefix=None):
+        '''
+        Keeps up to 'size' containers ready to be handed out by acquire(), so
+        jobs don't have to wait for a create.
+        
+        image, command, create_conf, start_conf: As for Container.run()
+        size: Number of idle containers to keep around
+        paused: Start the containers and pause them right away. Dispatching
+            then only needs an unpause. Meant for long running commands that
+            get their work through exec_run(), as the command already runs
+            before the container is handed out. Otherwise containers are
+            created, but not started.
+        max_idle: Seconds after which an idle container is removed. The pool
+            only grows back to 'size' once containers get acquired again.
+        prefix: Names of the containers, followed by a counter. Defaults to
+            a random 'whalesnake_pool_...' prefix.
+        
+        Call fill() to create the initial containers and close() when done.
+        
+        '''
+        self.image = image
+        self.command = command
+        self.create_conf = create_conf
+        self.start_conf = start_conf
+        self.size = size
+        self.paused = paused
+        self.max_idle = max_idle
+        self.prefix = prefix or 'whalesnake_pool_' + uuid.uuid4().hex[:8]
+        check_container_name(self.prefix)
+        
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.dispatch_ms = RingBuffer(1000)
+        self.errors = []
+        
+        self._counter = 0
+        self._idle = collections.deque() # (Container(), time it got ready)
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._closed = threading.Event()
+        self._thread = None
+    
+    def __repr__(self):
+        return 'ContainerPool(image={0!r}, size={1!r})'.format(
+            self.image, self.size
+        )
+    
+    def __len__(self):
+        return len(self._idle)
+    
+    def _new(self, ready=True):
+        with self._lock:
+            self._counter += 1
+            name = '{0}_{1}'.format(self.prefix, self._counter)
+        ctn = Container(name)
+        ctn._create_fast(self.image, self.command, self.create_conf)
+        if ready and self.paused:
+            dc.start(ctn.long_id, **self.start_conf)
+            _pause(ctn.long_id)
+            ctn.running, ctn.paused = True, True
+        return ctn
+    
+    def fill(self, concurrency=8):
+        '''
+        Creates idle containers until there are 'size' of them and starts the
+        background thread that replenishes and evicts.
+        
+        '''
+        missing = self.size - len(self._idle)
+        for _, ctn, err in _pmap(lambda _: self._new(), range(missing),
+                                 concurrency):
+            if err is not None:
+                self.errors.append(err)
+                continue
+            self._idle.append((ctn, time.time()))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._maintain)
+            self._thread.daemon = True
+            self._thread.start()
+    
+    def _maintain(self):
+        while not self._closed.is_set():
+            self._refill.wait(min(self.max_idle, 5))
+            if self._closed.is_set():
+                break
+            self._evict()
+            if self._refill.is_set():
+                self._refill.clear()
+                while len(self._idle) < self.size \
+                  and not self._closed.is_set():
+                    try:
+                        ctn = self._new()
+                    except Exception as e:
+                        self.errors.append(e)
+                        break
+                    with self._lock:
+                        closed = self._closed.is_set()
+                        if not closed:
+                            self._idle.append((ctn, time.time()))
+                    if closed:
+                        # close() is draining already
+                        self._discard(ctn)
+    
+    def _evict(self):
+        deadline = time.time() - self.max_idle
+        stale = []
+        with self._lock:
+            # the oldest ones are on the left
+            while self._idle and self._idle[0][1] < deadline:
+                stale.append(self._idle.popleft()[0])
+        for ctn in stale:
+            self._discard(ctn)
+            self.evicted += 1
+    
+    def _discard(self, ctn):
+        try:
+            dc.remove_container(ctn.long_id, force=True)
+        except Exception as e:
+            self.errors.append(e)
+    
+    def acquire(self):
+        '''
+        Returns: a running Container(). Either a prepared one (a hit) or, if
+            the pool ran dry, a freshly created one (a miss).
+        
+        '''
+        if self._closed.is_set():
+            raise WhalesnakeError('Pool is closed.')
+        start = time.time()
+        ctn = None
+        with self._lock:
+            if self._idle:
+                ctn = self._idle.pop()[0]
+                self.hits += 1
             else:
-                raise e
+                self.misses += 1
+        if ctn is None:
+            ctn = self._new(ready=False)
+        try:
+            if ctn.paused:
+                _unpause(ctn.long_id)
+                ctn.paused = False
+            else:
+                dc.start(ctn.long_id, **self.start_conf)
+                ctn.running = True
+        except Exception:
+            # neither handed out nor idle anymore
+            self._discard(ctn)
+            raise
+        self.dispatch_ms.append((time.time() - start) * 1000)
+        self._refill.set()
+        return ctn
+    
+    def release(self, ctn):
+        '''
+        Removes a container handed out by acquire(), once the job is done.
+        
+        '''
+        self._discard(ctn)
+    
+    def metrics(self):
+        total = self.hits + self.misses
+        return {
+            'idle': len(self._idle),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else None,
+            'evicted': self.evicted,
+            'dispatch_ms': {
+                'last': self.dispatch_ms.last(),
+                'mean': self.dispatch_ms.mean(),
+                'max': self.dispatch_ms.max(),
+            },
+        }
+    
+    def close(self):
+        '''
+        Stops replenishing and removes all idle containers.
+        
+        '''
+        self._closed.set()
+        self._refill.set()
+        if self._thread is not None:
+            # a container being created right now is discarded by the thread
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            idle = [ctn for ctn, _ in self._idle]
+            self._idle.clear()
+        _pmap(self._discard, idle)
+
+
+
+class ImageGraph(object):
+    
+    def __init__(self):
+        '''
+        The layer tree of all images, including intermediate ones, as of one
+        image and one container listing. Call refresh() to read it again.
+        
+        '''
+        self.refresh()
+    
+    def __repr__(self):
+        return 'ImageGraph(images={0!r})'.format(len(self.images))
+    
+    def __len__(self):
+        return len(self.images)
+    
+    def refresh(self):
+        self.images = dict((img['Id'], img) for img in dc.images(all=True))
+        self._children = dict((long_id, []) for long_id in self.images)
+        for long_id, img in self.images.items():
+            if img['ParentId'] in self._children:
+                self._children[img['ParentId']].append(long_id)
+        
+        index = _image_index(self.images.values())
+        self._containers = dict((long_id, []) for long_id in self.images)
+        for ctn in dc.containers(all=True):
+            long_id = _resolve_image(index, ctn['Image'])
+            if long_id is not None:
+                self._containers[long_id].append(ctn['Id'])
+        
+        # leaves first, every image comes after all of its children
+        self._order = [
+            long_id
+            for level in _levels(self._children)
+            for long_id in level
+        ]
+        self._garbage = set()
+        self._reclaimable = {}
+        for long_id in self._order:
+            below = sum(
+                self._reclaimable[child] for child in self._children[long_id]
+            )
+            if self._is_garbage(long_id):
+                below += self.size(long_id)
+            self._reclaimable[long_id] = below
+    
+    def _is_garbage(self, long_id):
+        img = self.images[long_id]
+        tags = [t for t in img['RepoTags'] or [] if t != '<none>:<none>']
+        if tags or self._containers[long_id]:
+            return False
+        if not all(c in self._garbage for c in self._children[long_id]):
+            return False
+        self._garbage.add(long_id)
+        return True
+    
+    def parent(self, long_id):
+        parent = self.images[long_id]['ParentId']
+        return parent if parent in self.images else None
+    
+    def children(self, long_id):
+        return list(self._children[long_id])
+    
+    def tags(self, long_id):
+        return [t for t in self.images[long_id]['RepoTags'] or []
+                if t != '<none>:<none>']
+    
+    def containers(self, long_id):
+        '''
+        Returns: ids of the containers created from exactly this image
+        
+        '''
+        return list(self._containers[long_id])
+    
+    def size(self, long_id):
+        '''
+        Returns: Bytes of the images own layer, i.e. without its parents
+        
+        '''
+        parent = self.parent(long_id)
+        size = self.images[long_id]['VirtualSize']
+        if parent is not None:
+            size -= self.images[parent]['VirtualSize']
+        return max(size, 0)
+    
+    def is_garbage(self, long_id):
+        '''
+        Returns: True if neither the image nor any image below it is tagged
+            or used by a container
+        
+        '''
+        return long_id in self._garbage
+    
+    def garbage(self):
+        return set(self._garbage)
+    
+    def reclaimable(self, long_id=None):
+        '''
+        Returns: Bytes freed by removing the garbage in the subtree below and
+            including long_id, or in all images if long_id is not given
+        
+        '''
+        if long_id is not None:
+            return self._reclaimable[long_id]
+        return sum(self.size(i) for i in self._garbage)
+    
+    def collect(self, dry_run=False, concurrency=8):
+        '''
+        Removes all garbage images, leaves first. Images whose children are
+        gone are removed in parallel. An image is skipped if removing one of
+        its children failed.
+        
+        dry_run: Only report what would be removed
+        
+        Returns: {'removed': [long ids], 'failed': {long id: exception},
+                  'skipped': [long ids], 'bytes': freed Bytes}
+        
+        '''
+        res = {'removed': [], 'failed': {}, 'skipped': [], 'bytes': 0}
+        deps = dict(
+            (long_id, [c for c in self._children[long_id]
+                       if c in self._garbage])
+            for long_id in self._garbage
+        )
+        levels = _levels(deps)
+        if dry_run:
+            res['removed'] = [i for level in levels for i in level]
+            res['bytes'] = self.reclaimable()
+            return res
+        
+        def remove(long_id):
+            # no pruning, parents are handled here in the right order
+            dc.remove_image(long_id, noprune=True)
+        
+        blocked = set()
+        for level in levels:
+            todo = []
+            for long_id in level:
+                if any(c in blocked for c in deps[long_id]):
+                    blocked.add(long_id)
+                    res['skipped'].append(long_id)
+                else:
+                    todo.append(long_id)
+            for long_id, _, err in _pmap(remove, todo, concurrency):
+                if err is None:
+                    res['removed'].append(long_id)
+                    res['bytes'] += self.size(long_id)
+                else:
+                    blocked.add(long_id)
+                    res['failed'][long_id] = err
+        if res['removed']:
+            self.refresh()
+        return res
+
+
+
+class MetadataCache(object):
+    
+    def __init__(self, path=None):
+        '''
+        On-disk cache for daemon metadata, see enable_disk_cache().
+        
+        Image entries are keyed by image id, as those never change. Container
+        entries are keyed by container id and a state version derived from
+        the container listing, see _container_version().
+        
+        path: Location of the sqlite database file
+        
+        '''
+        if path is None:
+            path = os.path.join(
+                os.path.expanduser('~'), '.cache', 'whalesnake',
+                'metadata.sqlite'
+            )
+        if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # shared by the threads of _pmap(), hence the lock
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock:
+            # readers don't block writers of other processes
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                'id TEXT, kind TEXT, data TEXT, PRIMARY KEY (id, kind))'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS containers ('
+                'id TEXT PRIMARY KEY, version TEXT, data TEXT)'
+            )
+            self._db.commit()
+    
+    def __repr__(self):
+        return 'MetadataCache(path={0!r})'.format(self.path)
+    
+    def _fetch(self, query, args, valid=None):
+        with self._lock:
+            row = self._db.execute(query, args).fetchone()
+        data = None if row is None else json.loads(row[0])
+        if data is None or valid is not None and not valid(data):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+    
+    def _store(self, query, args):
+        with self._lock:
+            self._db.execute(query, args)
+            self._db.commit()
+    
+    def get_image(self, long_id, kind):
+        return self._fetch(
+            'SELECT data FROM images WHERE id = ? AND kind = ?',
+            (long_id, kind)
+        )
+    
+    def set_image(self, long_id, kind, data):
+        self._store(
+            'INSERT OR REPLACE INTO images VALUES (?, ?, ?)',
+            (long_id, kind, json.dumps(data))
+        )
+    
+    def get_container(self, long_id, version, valid=None):
+        '''
+        valid: Called with a cached entry, returns False if it is stale anyway
+        
+        '''
+        return self._fetch(
+            'SELECT data FROM containers WHERE id = ? AND version = ?',
+            (long_id, version), valid
+        )
+    
+    def set_container(self, long_id, version, data):
+        self._store(
+            'INSERT OR REPLACE INTO containers VALUES (?, ?, ?)',
+            (long_id, version, json.dumps(data))
+        )
+    
+    def validate(self, ctns=None, imgs=None):
+        '''
+        Drops entries of images and containers, that don't exist anymore, and
+        of containers whose state changed.
+        
+        ctns, imgs: Raw listings to validate against. Fetched (with all=True)
+            if not given.
+        
+        Returns: number of dropped entries
+        
+        '''
+        if ctns is None:
+            ctns = dc.containers(all=True)
+        if imgs is None:
+            imgs = dc.images(all=True)
+        versions = dict((c['Id'], _container_version(c)) for c in ctns)
+        image_ids = set(img['Id'] for img in imgs)
+        
+        with self._lock:
+            stale_images = [
+                (long_id, ) for long_id, in
+                self._db.execute('SELECT DISTINCT id FROM images')
+                if long_id not in image_ids
+            ]
+            stale_containers = [
+                (long_id, ) for long_id, version in
+                self._db.execute('SELECT id, version FROM containers')
+                if versions.get(long_id) != version
+            ]
+            self._db.executemany('DELETE FROM images WHERE id = ?',
+                                 stale_images)
+            self._db.executemany('DELETE FROM containers WHERE id = ?',
+                                 stale_containers)
+            self._db.commit()
+        return len(stale_images) + len(stale_containers)
+    
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM images')
+            self._db.execute('DELETE FROM containers')
+            self._db.commit()
+    
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+
+class Fleet(object):
+    
+    def __init__(self, urls, timeout=10, concurrency=64, deadline=None,
+                 health=False, **kwargs):
+        '''
+        Talks to many daemons at once. Results are plain dicts like with
+        raw=True, tagged with the url of their daemon under 'Host'.
+        
+        urls: Where the daemons listen, e.g. 'unix://var/run/docker.sock' or
+            'tcp://10.0.0.1:2375'
+        timeout: Seconds each request to a daemon may take
+        concurrency: Number of daemons to talk to at the same time
+        deadline: Seconds after which a whole call gives up on the daemons
+            that did not answer yet. None waits for the request timeouts.
+        health: Watch every daemon with a HealthMonitor() (without pinging
+            in the background), so daemons that keep failing get skipped
+            right away and slow ones get adapted timeouts. Available as
+            'monitors', url -> HealthMonitor().
+        
+        Possible docker-py arguments and their defaults (in 0.4.0):
+        version='1.12', tls=False
+        
+        Daemons that failed during the last call are listed in 'errors'
+        (url -> exception), the results of the others are returned anyway.
+        
+        '''
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.errors = {}
+        self.clients = collections.OrderedDict()
+        self.monitors = {}
+        for url in urls:
+            client = docker.Client(base_url=url, timeout=timeout, **kwargs)
+            _install_decoder(client)
+            self.clients[url] = client
+            if health:
+                self.monitors[url] = HealthMonitor(client, interval=None)
+                self.monitors[url].install()
+    
+    def __repr__(self):
+        return 'Fleet({0} hosts)'.format(len(self.clients))
+    
+    def __len__(self):
+        return len(self.clients)
+    
+    def call(self, func, hosts=None):
+        '''
+        func: Gets called with the docker-py client of every host
+        hosts: Urls to limit the call to, defaults to all of them
+        
+        Returns: OrderedDict of url -> result for the hosts that succeeded
+        
+        '''
+        return self._call(lambda url: func(self.clients[url]), hosts)
+    
+    def _call(self, func, hosts=None):
+        # like call(), but func gets the url
+        hosts = list(self.clients if hosts is None else hosts)
+        results, errors = {}, {}
+        for url, res, err in _pimap(func, hosts, self.concurrency,
+                                    self.deadline):
+            if err is not None:
+                errors[url] = err
+            else:
+                results[url] = res
+        for url in hosts:
+            if url not in results and url not in errors:
+                errors[url] = WhalesnakeError(
+                    'No answer within {0}s'.format(self.deadline)
+                )
+        self.errors = errors
+        return collections.OrderedDict(
+            (url, results[url]) for url in hosts if url in results
+        )
+    
+    def _merge(self, per_host):
+        merged = []
+        for url, rows in per_host.items():
+            for row in rows:
+                row['Host'] = url
+                merged.append(row)
+        return merged
+    
+    def containers(self, match=None, fields=None, hosts=None, **kwargs):
+        '''
+        Containers of all daemons, see containers() for the arguments.
         
-        self.start(**start_conf)
+        Returns: list of dicts with an additional 'Host' key
+        
+        '''
+        return self._merge(self.call(
+            lambda client: list(_iter_rows(_container_rows(client, **kwargs),
+                _match_container, None, match, True, fields, None)),
+            hosts
+        ))
     
-    #######
-    ## 'official' docker commands below
-    ####
+    def images(self, match=None, fields=None, hosts=None, **kwargs):
+        '''
+        Images of all daemons, see images() for the arguments.
+        
+        Returns: list of dicts with an additional 'Host' key
+        
+        '''
+        return self._merge(self.call(
+            lambda client: list(_iter_rows(_image_rows(client, **kwargs),
+                _match_image, None, match, True, fields, None)),
+            hosts
+        ))
     
-    def attach(self):
-        raise NotImplementedError
-        if not self.running:
-            raise WhalesnakeError('Container is not running.')
+    def info(self, hosts=None):
+        '''
+        Returns: OrderedDict of url -> output of docker info
+        
+        '''
+        return self.call(lambda client: client.info(), hosts)
     
-    def commit(self, *args, **kwargs):
+    def ping(self, hosts=None):
         '''
-        Possible docker-py arguments and their defaults:
+        Returns: OrderedDict of url -> round trip time in ms
+        
+        '''
+        def ping(client):
+            start = time.time()
+            client.ping()
+            return (time.time() - start) * 1000
+        return self.call(ping, hosts)
     
-        repository=None, tag=None, message=None, author=None
+    def each(self, method, rows, concurrency=4, **kwargs):
+        '''
+        Runs a docker-py method for every container, e.g. to stop all
+        containers from containers() that match some filter.
+        
+        method: Name of the docker-py method, e.g. 'stop' or 'remove_container'
+        rows: Dicts with 'Host' and 'Id', as returned by containers()
+        concurrency: Requests in flight per host
+        kwargs: Passed on to the method
+        
+        Returns: list of (row, exception) tuples for the containers that
+            failed. Hosts that could not be reached at all are in 'errors'.
         
         '''
-        raise NotImplementedError
-        res = dc.commit(self.long_id, *args, conf=None, **kwargs)
-        return res # what does the output look like?
+        by_host = collections.OrderedDict()
+        for row in rows:
+            by_host.setdefault(row['Host'], []).append(row)
+        
+        def run(url):
+            func = getattr(self.clients[url], method)
+            return [(row, err) for row, _, err in _pmap(
+                lambda row: func(row['Id'], **kwargs), by_host[url],
+                concurrency
+            ) if err is not None]
+        
+        failed = []
+        for res in self._call(run, list(by_host)).values():
+            failed.extend(res)
+        return failed
     
-    def copy(self):
-        raise NotImplementedError
-        self._check_status()
+    def start(self, rows, **kwargs):
+        return self.each('start', rows, **kwargs)
     
-    def create(self, image, command=None, **kwargs):
+    def stop(self, rows, **kwargs):
+        return self.each('stop', rows, **kwargs)
+    
+    def kill(self, rows, **kwargs):
+        return self.each('kill', rows, **kwargs)
+    
+    def remove(self, rows, **kwargs):
+        return self.each('remove_container', rows, **kwargs)
+
+
+
+class Placer(object):
+    
+    STRATEGIES = ('least_loaded', 'bin_pack')
+    
+    def __init__(self, fleet, strategy='least_loaded', stats=None,
+                 default_mem=0, default_cpu=0, overcommit=1.0, concurrency=8):
         '''
-        image: Either a valid image id or name as string or an instance
-            of .Image()
-        command: Execute this inside the container
+        Picks the daemon of a Fleet() a new container should run on. What a
+        daemon has comes from info() (MemTotal, NCPU), what its running
+        containers take from their mem_limit and cpu_shares. refresh() asks
+        the daemons for that, place() chooses and started() / stopped() keep
+        the numbers current in between without any requests.
         
-        Returns: : {u'Id': u'9164222a9d7...long_id_here', u'Warnings': None}
+        fleet: A Fleet()
+        strategy: 'least_loaded' picks the host with the most capacity left,
+            spreading containers out. 'bin_pack' picks the host they fit on
+            most tightly, keeping the others free for big ones.
+        stats: A StatsMonitor() or the output of its summary(). Containers
+            count with their mean usage where that is above their limits.
+        default_mem: Bytes to count for containers without a mem_limit
+        default_cpu: CPUs to count for containers without cpu_shares
+        overcommit: Factor on the memory and CPUs of every host
+        concurrency: Inspects in flight per host during refresh()
         
-        Possible docker-py keyword arguments and their defaults:
+        A container takes mem_limit Bytes and cpu_shares / 1024 CPUs. The
+        limits are inspected once per container and cached. Daemons only
+        report their capacity to clients with api version 1.16 or later, so
+        create the Fleet() with e.g. version='1.16'.
+        
+        '''
+        if strategy not in self.STRATEGIES:
+            raise ValueError(
+                'Strategy "{0}" is not supported.'.format(strategy)
+            )
+        self.fleet = fleet
+        self.strategy = strategy
+        self.stats = stats
+        self.default_mem = default_mem
+        self.default_cpu = default_cpu
+        self.overcommit = overcommit
+        self.concurrency = concurrency
+        # url -> {'mem', 'cpu', 'used_mem', 'used_cpu', 'containers'}
+        self.hosts = collections.OrderedDict()
+        self.errors = {}
+        # long id -> (mem, cpu) as configured
+        self._limits = {}
+        self._usage = {}
     
-        hostname=None, user=None, detach=False, stdin_open=False, tty=False,
-        mem_limit=0, ports=None, environment=None, dns=None, volumes=None,
-        volumes_from=None, network_disabled=False, entrypoint=None,
-        cpu_shares=None, working_dir=None, memswap_limit=0
+    def __repr__(self):
+        return 'Placer({0} hosts, strategy={1!r})'.format(
+            len(self.hosts), self.strategy
+        )
+    
+    def refresh(self, hosts=None):
+        '''
+        hosts: Urls to refresh, defaults to all of the fleet
+        
+        Hosts that could not be reached or don't report their capacity are
+        dropped until the next refresh and listed in 'errors'.
         
         '''
-        if self.exists:
+        hosts = list(self.fleet.clients if hosts is None else hosts)
+        infos = self.fleet.info(hosts)
+        errors = dict(self.fleet.errors)
+        for url, info in list(infos.items()):
+            if not info.get('MemTotal') or not info.get('NCPU'):
+                # only part of info() from api version 1.16 on
+                errors[url] = WhalesnakeError(
+                    'Docker daemon at {0} reports no MemTotal or NCPU, this '
+                    'needs a client with api version 1.16 or '
+                    'later.'.format(url)
+                )
+                del infos[url]
+        stats = self.stats
+        if isinstance(stats, StatsMonitor):
+            stats = stats.summary()
+        self._usage = stats or {}
+        
+        def running(client):
+            ids = [row['Id'] for row in _container_rows(client)
+                   if row.get('Status', '').startswith('Up')]
+            missing = [long_id for long_id in ids
+                       if long_id not in self._limits]
+            for long_id, conf, err in _pmap(
+                lambda long_id: client.inspect_container(long_id)['Config'],
+                missing, self.concurrency
+            ):
+                if err is None:
+                    self._limits[long_id] = (conf.get('Memory') or 0,
+                                             (conf.get('CpuShares') or 0) /
+                                             1024.)
+            return ids
+        
+        per_host = self.fleet.call(running, list(infos))
+        errors.update(self.fleet.errors)
+        self.errors = errors
+        for url in hosts:
+            self.hosts.pop(url, None)
+        for url, ids in per_host.items():
+            info = infos[url]
+            self.hosts[url] = host = {
+                'mem': info['MemTotal'] * self.overcommit,
+                'cpu': info['NCPU'] * self.overcommit,
+                'used_mem': 0, 'used_cpu': 0, 'containers': {}
+            }
+            for long_id in ids:
+                mem, cpu = self._limits.get(long_id, (0, 0))
+                self._take(host, long_id, mem, cpu)
+    
+    def _take(self, host, long_id, mem, cpu):
+        mem, cpu = mem or self.default_mem, cpu or self.default_cpu
+        usage = self._usage.get(long_id)
+        if usage:
+            mem = max(mem, usage['mem_usage']['mean'] or 0)
+            cpu = max(cpu, (usage['cpu_percent']['mean'] or 0) / 100.)
+        self._release(host, long_id)
+        host['containers'][long_id] = (mem, cpu)
+        host['used_mem'] += mem
+        host['used_cpu'] += cpu
+    
+    def _release(self, host, long_id):
+        mem, cpu = host['containers'].pop(long_id, (0, 0))
+        host['used_mem'] -= mem
+        host['used_cpu'] -= cpu
+    
+    def free(self, url, mem=0, cpu=0):
+        '''
+        mem, cpu: What a new container would take
+        
+        Returns: the smaller of the free memory and free CPU share of the
+            host after placing it, negative if it does not fit
+        
+        '''
+        host = self.hosts[url]
+        return min(
+            (host[cap] - host['used_' + cap] - need) / float(host[cap])
+            for cap, need in (('mem', mem), ('cpu', cpu))
+        )
+    
+    def place(self, mem_limit=0, cpu_shares=0, hosts=None):
+        '''
+        mem_limit, cpu_shares: Like for create(), 0 for the defaults
+        hosts: Urls to choose from, defaults to all that were refreshed
+        
+        Returns: the url of the chosen host. Nothing is reserved, call
+            started() once the container runs.
+        
+        '''
+        if not self.hosts:
+            self.refresh()
+        if not self.hosts:
+            raise WhalesnakeError('No usable hosts:\n{0}'.format('\n'.join(
+                '{0}: {1}'.format(url, err) for url, err in self.errors.items()
+            )))
+        mem = mem_limit or self.default_mem
+        cpu = cpu_shares / 1024. or self.default_cpu
+        best, best_key = None, None
+        for url in (self.hosts if hosts is None else hosts):
+            if url not in self.hosts:
+                continue
+            left = self.free(url, mem, cpu)
+            if left < 0:
+                continue
+            # ties go to the host running fewer containers
+            n = len(self.hosts[url]['containers'])
+            if self.strategy == 'bin_pack':
+                key = (left, n)
+            else:
+                key = (-left, n)
+            if best_key is None or key < best_key:
+                best, best_key = url, key
+        if best is None:
             raise WhalesnakeError(
-                'Container() needs to be instantiated with an unassigned ' + \
-                'name in order to allow for creations.'
+                'No host has {0} Bytes and {1} CPUs left.'.format(mem, cpu)
             )
+        return best
+    
+    def started(self, url, long_id, mem_limit=0, cpu_shares=0):
+        '''
+        Counts a container that now runs on host 'url'.
         
-        if not isinstance(image, Image):
-            image = Image(image)
-            
-        if not image.exists:
-            raise ValueError(
-                'No such image could be found: {0}\n' + \
-                'Try to pull it first or just let Container.run() ' + \
-                'take care of it.'.format(str(image))
-            )
+        '''
+        self._limits[long_id] = (mem_limit, cpu_shares / 1024.)
+        self._take(self.hosts[url], long_id, mem_limit, cpu_shares / 1024.)
+    
+    def stopped(self, long_id, url=None):
+        '''
+        Stops counting a container, on every host if 'url' is not given.
         
-        out = dc.create_container(image.long_id, name=self.name,
-                                  command=command, **kwargs)
-        self._check_status()
-        return out
+        '''
+        for host_url, host in self.hosts.items():
+            if url is None or host_url == url:
+                self._release(host, long_id)
     
-    def diff(self):
-        return dc.diff(self.long_id)
+    def run(self, name, image, command=None, create_conf={}, start_conf={},
+            hosts=None):
+        '''
+        Places, creates and starts a container, pulling the image if the
+        chosen daemon does not have it. See Container.run() for the
+        arguments.
+        
+        Returns: (url, long id)
+        
+        '''
+        mem_limit = create_conf.get('mem_limit') or 0
+        cpu_shares = create_conf.get('cpu_shares') or 0
+        url = self.place(mem_limit, cpu_shares, hosts)
+        client = self.fleet.clients[url]
+        ref = image
+        if isinstance(image, Image):
+            # ids can't be pulled, the chosen daemon may not have it yet
+            ref = image.names[0] if image.names else image.long_id
+        try:
+            out = client.create_container(ref, name=name, command=command,
+                                          **create_conf)
+        except docker.errors.APIError as e:
+            if 'No such image' not in str(e):
+                raise
+            try:
+                _pull(ref, client)
+                out = client.create_container(ref, name=name,
+                                              command=command, **create_conf)
+            except Exception as ex:
+                raise WhalesnakeError(
+                    'Unable to get image "{0}": {1}'.format(ref, ex.args[0])
+                )
+        try:
+            client.start(out['Id'], **start_conf)
+        except Exception:
+            client.remove_container(out['Id'], force=True)
+            raise
+        self.started(url, out['Id'], mem_limit, cpu_shares)
+        return url, out['Id']
+
+
+
+class HealthMonitor(object):
     
-    def export(self, path):
+    def __init__(self, client, interval=5, min_timeout=1, max_timeout=None,
+                 factor=4, min_samples=5, failures=3, cooldown=10,
+                 retries=2, backoff=0.1, max_backoff=2):
         '''
-        path: String containing the filepath where the .tar should go
-        Returns: Nothing
+        Keeps track of how a daemon is doing, see enable_health_monitor().
+        Works on the requests sent by a docker-py client, so everything
+        using that client benefits.
         
-        TODO: 
-        - path could also be a file object
-        - gzip flag
+        client: docker-py client of the daemon
+        interval: Seconds between pings in the background, None to not ping
+        min_timeout, max_timeout: Bounds of the adapted timeouts.
+            max_timeout defaults to the timeout of the client.
+        factor: Adapted timeouts are this many times the usual latency of an
+            endpoint (its EWMA plus four times the mean deviation, like TCP)
+        min_samples: Requests to an endpoint before its timeout is adapted
+        failures: Consecutive connection errors or timeouts after which the
+            daemon counts as unhealthy. Requests then fail right away with a
+            WhalesnakeError, except for the pings.
+        cooldown: Seconds before requests are let through again to try out
+            if the daemon recovered. A successful one or a successful ping
+            makes it healthy again.
+        retries: How often GET requests get repeated after connection errors
+            or timeouts
+        backoff, max_backoff: The n-th retry waits for a random time between
+            0 and min(backoff * 2 ** n, max_backoff) seconds
+        
+        Only GET requests, which are all idempotent, with the client's
+        default timeout get adapted timeouts and retries. Streamed requests
+        (stats, followed logs, listings decoded while received) and requests
+        with their own timeout, e.g. stop(), are left alone.
         
         '''
-        if not self.exists:
-            raise WhalesnakeError('Container was not yet created.')
-        tar = dc.export(self.long_id) # returns a 'tar' stream
-        with open(path, 'wb') as f:
-            while True:
-                l = tar.read(52428800) # 50MB
-                if not l:
-                    break
-                f.write(l)
+        self.client = client
+        self.interval = interval
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout or client._timeout
+        self.factor = factor
+        self.min_samples = min_samples
+        self.failures = failures
+        self.cooldown = cooldown
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.retried = 0
+        self.rejected = 0
+        # endpoint -> [samples, ewma, mean deviation] in seconds
+        self._latency = {}
+        self._lock = threading.Lock()
+        self._send = None
+        self._stop = threading.Event()
+        self._thread = None
     
-    def inspect(self):
-        return dc.inspect_container(self.long_id)
+    def __repr__(self):
+        return 'HealthMonitor(client={0!r}, healthy={1!r})'.format(
+            self.client.base_url, self.healthy
+        )
     
-    def kill(self, signal=None):
-        if not self.running:
-            raise WhalesnakeError('Container is not running.')
-        dc.kill(self.long_id, signal)
-        self._check_status()
-
-    def logs(self, *args, **kwargs):
+    @property
+    def healthy(self):
+        return self.consecutive_failures < self.failures
+    
+    def install(self):
         '''
-        Returns: what the container has written to stdout and stderr
-        (by default)
+        Hooks into the client and starts pinging in the background.
         
-        Possible docker-py arguments and their defaults:
+        '''
+        if self._send is not None:
+            return
+        self._send = self.client.send
+        self.client.send = self.send
+        if self.interval:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
     
-        stdout=True, stderr=True, stream=False, timestamps=False
+    def uninstall(self):
+        if self._send is None:
+            return
+        self._stop.set()
+        self.client.send = self._send
+        self._send = None
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.ping()
+    
+    def ping(self):
+        '''
+        Returns: whether or not the daemon answered
         
         '''
-        if 'stream' in kwargs.keys():
-            # take care of stream. just pass it through?
-            raise NotImplementedError
-        return dc.logs(self.long_id, *args, **kwargs)
+        try:
+            self.client.ping()
+            return True
+        except Exception:
+            return False
     
-    def port(self, private_port):
+    def latency(self, endpoint):
         '''
-        Returns the host port and ip for the given 'private_port':
-        [{u'HostPort': u'5000', u'HostIp': u'0.0.0.0'}]
+        Returns: usual latency of an endpoint in seconds (EWMA), or None
         
         '''
-        if not self.exists:
-            raise WhalesnakeError('Container was not yet created.')
-        return dc.port(self.long_id, private_port)
+        stats = self._latency.get(endpoint)
+        return stats[1] if stats else None
     
-    def restart(self, timeout=None):
-        if not self.exists:
-            raise WhalesnakeError('Container was not yet created.')
-        if self.running:
-            raise WhalesnakeError('Container is running already.')
-        dc.restart(self.long_id, timeout)
-        self._check_status()
+    def timeout(self, endpoint):
+        '''
+        Returns: timeout in seconds for the next request to an endpoint
+        
+        '''
+        stats = self._latency.get(endpoint)
+        if stats is None or stats[0] < self.min_samples:
+            return self.max_timeout
+        return max(self.min_timeout, min(
+            self.max_timeout, self.factor * (stats[1] + 4 * stats[2])
+        ))
     
-    def remove(self, force=False, **kwargs):
+    def stats(self):
         '''
-        force: force removal, e.g. when ctn is running
+        Returns: dict of endpoint -> dict with 'samples', 'latency',
+            'deviation' and 'timeout', all in seconds
         
-        Possible docker-py arguments and their defaults:
+        '''
+        with self._lock:
+            latency = dict((k, list(v)) for k, v in self._latency.items())
+        return dict(
+            (endpoint, {'samples': samples, 'latency': ewma,
+                        'deviation': dev, 'timeout': self.timeout(endpoint)})
+            for endpoint, (samples, ewma, dev) in latency.items()
+        )
     
-        link=False, volumes=False
+    def _success(self, endpoint, took):
+        with self._lock:
+            self.consecutive_failures = 0
+            stats = self._latency.get(endpoint)
+            if stats is None:
+                self._latency[endpoint] = [1, took, took / 2]
+                return
+            # same weights as TCP's retransmission timer
+            stats[0] += 1
+            stats[2] += (abs(took - stats[1]) - stats[2]) / 4.
+            stats[1] += (took - stats[1]) / 8.
+    
+    def _failure(self, endpoint, timed_out):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.failures:
+                self.open_until = time.time() + self.cooldown
+            stats = self._latency.get(endpoint)
+            if timed_out and stats is not None:
+                # give the next request more time
+                stats[1] = min(stats[1] * 2, self.max_timeout)
+    
+    def send(self, request, **kwargs):
+        '''
+        Replaces send() of the client, see install().
         
         '''
-        if not self.exists:
-            raise WhalesnakeError('Container was not yet created.')
-        if self.running and not force:
+        endpoint = _endpoint(request.path_url)
+        if not self.healthy and time.time() < self.open_until \
+          and endpoint != '/_ping':
+            self.rejected += 1
             raise WhalesnakeError(
-                'Container is running. Use force=True to remove anyway.'
+                'Docker daemon at {0} is unhealthy, {1} failures in a '
+                'row'.format(self.client.base_url, self.consecutive_failures)
             )
-        dc.remove_container(self.long_id, force=force, **kwargs)
-        self._check_status()
+        attempts = 1
+        # streams (stats, followed logs, ...) may be quiet for a long time
+        if request.method == 'GET' and not kwargs.get('stream') \
+          and kwargs.get('timeout') == self.client._timeout:
+            kwargs['timeout'] = self.timeout(endpoint)
+            attempts += self.retries
+        
+        for attempt in range(attempts):
+            start = time.time()
+            try:
+                res = self._send(request, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout, socket.error) as e:
+                self._failure(
+                    endpoint, isinstance(e, requests.exceptions.Timeout)
+                )
+                if attempt == attempts - 1 or not self.healthy:
+                    raise
+                self.retried += 1
+                time.sleep(random.uniform(
+                    0, min(self.backoff * 2 ** attempt, self.max_backoff)
+                ))
+                continue
+            self._success(endpoint, time.time() - start)
+            return res
+
+
+
+class LogStore(object):
     
-    def start(self, *args, **kwargs):
+    def __init__(self, path=None, block_size=16384, segment_size=64 << 20,
+                 bits=16384):
         '''
-        Returns: nothing
+        Container logs on disk, see enable_log_store().
         
-        Possible docker-py arguments and their defaults:
+        The lines of each container are appended to segment files. These are
+        split into blocks of about block_size Bytes. Each block gets a bitmap
+        of the trigrams it contains (lower cased), kept in an sqlite index
+        and in memory. A search only reads the blocks whose bitmap contains
+        all trigrams of the pattern, and that are not older than since.
+        
+        path: Directory of the store
+        block_size: Bytes per indexed block
+        segment_size: Bytes per segment file before a new one is started
+        bits: Size of the trigram bitmap of each block
+        
+        '''
+        if path is None:
+            path = os.path.join(
+                os.path.expanduser('~'), '.cache', 'whalesnake', 'logs'
+            )
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.block_size = block_size
+        self.segment_size = segment_size
+        self.bits = bits
+        self._lock = threading.Lock()
+        # long id -> list of [segment, offset, length, first ns, last ns,
+        # bitmap as int], loaded on first use
+        self._blocks = {}
+        self._db = sqlite3.connect(
+            os.path.join(path, 'index.sqlite'), timeout=30,
+            check_same_thread=False
+        )
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS blocks ('
+                'id TEXT, segment INTEGER, offset INTEGER, length INTEGER, '
+                'first INTEGER, last INTEGER, grams BLOB, '
+                'PRIMARY KEY (id, segment, offset))'
+            )
+            self._db.commit()
     
-        binds=None, port_bindings=None, lxc_conf=None,
-        publish_all_ports=False, links=None, privileged=False,
-        dns=None, dns_search=None, volumes_from=None, network_mode=None
+    def __repr__(self):
+        return 'LogStore(path={0!r})'.format(self.path)
+    
+    def _segment(self, long_id, segment):
+        return os.path.join(
+            self.path, long_id, '{0:06d}.log'.format(segment)
+        )
+    
+    def _load(self, long_id):
+        # with self._lock held
+        if long_id not in self._blocks:
+            self._blocks[long_id] = [
+                [segment, offset, length, first, last, _bits_int(grams)]
+                for segment, offset, length, first, last, grams in
+                self._db.execute(
+                    'SELECT segment, offset, length, first, last, grams '
+                    'FROM blocks WHERE id = ? ORDER BY segment, offset',
+                    (long_id,)
+                )
+            ]
+        return self._blocks[long_id]
+    
+    def last(self, long_id):
+        '''
+        Returns: time of the newest stored line in ns since the epoch, or 0
         
         '''
-        if not self.exists:
-            raise WhalesnakeError('Container was not yet created.')
-        if self.running:
-            raise WhalesnakeError('Container is running already.')
-        dc.start(self.long_id, *args, **kwargs)
-        self._check_status()
+        with self._lock:
+            blocks = self._load(long_id)
+            return blocks[-1][4] if blocks else 0
     
-    def stop(self, **kwargs):
-        if not self.running:
-            raise WhalesnakeError('Container is not running.')
-        dc.stop(self.long_id, **kwargs)
-        self._check_status()
+    def append(self, long_id, lines):
+        '''
+        lines: (ns since the epoch, stream, bytes) tuples, oldest first and
+            newer than last()
+        
+        '''
+        if not lines:
+            return
+        directory = os.path.join(self.path, long_id)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._lock:
+            blocks = self._load(long_id)
+            pending = []
+            size = 0
+            for line in lines:
+                pending.append(line)
+                # as written by _write()
+                size += len(line[2]) + len(str(line[0])) + 4
+                if size >= self.block_size:
+                    self._write(long_id, blocks, pending)
+                    pending = []
+                    size = 0
+            self._write(long_id, blocks, pending)
+            self._db.commit()
     
-    def top(self):
-        # docker-py is lacking support for ps options
-        if not self.running:
-            raise WhalesnakeError('Container is not running.')
-        return dc.top(self.long_id)
+    def _write(self, long_id, blocks, lines):
+        if not lines:
+            return
+        data = b''.join(
+            '{0} {1} '.format(ns, stream).encode('ascii') + text + b'\n'
+            for ns, stream, text in lines
+        )
+        bitmap = _trigram_bits(data.lower(), self.bits)
+        tail = blocks[-1] if blocks else None
+        if tail is not None and tail[2] < self.block_size:
+            # extend the last block, its bitmap becomes the union
+            segment, offset = tail[0], tail[1]
+            with open(self._segment(long_id, segment), 'ab') as f:
+                f.write(data)
+            grams = self._db.execute(
+                'SELECT grams FROM blocks WHERE id = ? AND segment = ? '
+                'AND offset = ?', (long_id, segment, offset)
+            ).fetchone()[0]
+            merged = bytearray(bytes(grams))
+            for i, b in enumerate(bitmap):
+                merged[i] |= b
+            tail[2] += len(data)
+            tail[4] = lines[-1][0]
+            tail[5] = _bits_int(merged)
+            self._db.execute(
+                'UPDATE blocks SET length = ?, last = ?, grams = ? '
+                'WHERE id = ? AND segment = ? AND offset = ?',
+                (tail[2], tail[4], sqlite3.Binary(bytes(merged)),
+                 long_id, segment, offset)
+            )
+            return
+        
+        segment, offset = 0, 0
+        if tail is not None:
+            segment, offset = tail[0], tail[1] + tail[2]
+            if offset >= self.segment_size:
+                segment, offset = segment + 1, 0
+        with open(self._segment(long_id, segment), 'ab') as f:
+            f.write(data)
+        blocks.append([segment, offset, len(data), lines[0][0], lines[-1][0],
+                       _bits_int(bitmap)])
+        self._db.execute(
+            'INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (long_id, segment, offset, len(data), lines[0][0], lines[-1][0],
+             sqlite3.Binary(bytes(bitmap)))
+        )
+    
+    def collect(self, ctn):
+        '''
+        Fetches and stores what the container logged since the last time.
+        
+        ctn: Container() instance
+        
+        Returns: number of new lines
+        
+        '''
+        tty = ctn.inspect()['Config'].get('Tty', False)
+        count = 0
+        batch, size = [], 0
+        # appended in batches while received, never all at once
+        for line in _fetch_logs(ctn.long_id, self.last(ctn.long_id), tty):
+            batch.append(line)
+            size += len(line[2])
+            if size >= self.block_size * 8:
+                self.append(ctn.long_id, batch)
+                count += len(batch)
+                batch, size = [], 0
+        self.append(ctn.long_id, batch)
+        return count + len(batch)
+    
+    def search(self, long_id, pattern, since=None, regex=False,
+               ignore_case=False, limit=None):
+        '''
+        See Container.search_logs()
+        
+        '''
+        if regex:
+            literals = _regex_literals(pattern)
+            expr = re.compile(pattern, re.I if ignore_case else 0)
+            match = expr.search
+        else:
+            literals = [pattern]
+            if ignore_case:
+                lowered = pattern.lower()
+                match = lambda text: lowered in text.lower()
+            else:
+                match = lambda text: pattern in text
+        if ignore_case:
+            # blocks are lower cased as bytes, ASCII only. other letters
+            # may come in any case, only the ASCII runs around them count.
+            literals = [part for literal in literals
+                        for part in re.split(r'[^\x00-\x7f]+', literal)]
+        mask = 0
+        for literal in literals:
+            data = literal.encode('utf-8').lower()
+            if len(data) >= 3:
+                mask |= _bits_int(_trigram_bits(data, self.bits))
+        since_ns = _since_ns(since)
+        
+        with self._lock:
+            candidates = [
+                block[:3] for block in self._load(long_id)
+                if block[4] > since_ns and block[5] & mask == mask
+            ]
+        
+        found = []
+        for segment, offset, length in candidates:
+            with open(self._segment(long_id, segment), 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+            for line in data.decode('utf-8', 'replace').split('\n'):
+                if not line:
+                    continue
+                ns, stream, text = line.split(' ', 2)
+                ns = int(ns)
+                if ns <= since_ns or not match(text):
+                    continue
+                found.append(LogLine(
+                    datetime.datetime.utcfromtimestamp(ns // 10 ** 9)
+                    + datetime.timedelta(microseconds=ns % 10 ** 9 // 1000),
+                    int(stream), text
+                ))
+                if limit is not None and len(found) >= limit:
+                    return found
+        return found
+    
+    def drop(self, long_id):
+        '''
+        Forgets the logs of a container, e.g. after it got removed.
+        
+        '''
+        with self._lock:
+            self._blocks.pop(long_id, None)
+            self._db.execute('DELETE FROM blocks WHERE id = ?', (long_id,))
+            self._db.commit()
+        shutil.rmtree(os.path.join(self.path, long_id), ignore_errors=True)
     
-    def wait(self):
-        return dc.wait(self.long_id)
-
+    def close(self):
+        with self._lock:
+            self._db.close()
 
 
-class Image(object):
 
-    def __init__(self, repo_or_iid):
-        '''
-        Multiple tags per id
-        One id per tag
-        Assumes :latest if no tag was given for repo
-        
+class LogCollector(object):
+    
+    def __init__(self, store=None, ctns=None, interval=5, concurrency=8):
         '''
-        self._passed_arg = repo_or_iid
-        self.names = []
-        self.initial_name = ''
-        self.short_id, self.long_id = None, None
-        self.build_log = ''
-            
-        try:
-            # check if an iid was given
-            self.short_id, self.long_id = check_docker_id(repo_or_iid)
-        except ValueError:
-            # not an iid, interpret as name, but check if empty
-            if len(repo_or_iid) is 0:
-                raise ValueError(
-                    'Either a valid image id or "[namespace/]repo[:tag]" ' + \
-                    'must be given.'
-                )
-            
-            ns, repo, tag = check_image_name(repo_or_iid)
-            
-            if not tag:
-                # assume we want the latest image from 'repo'
-                repo_or_iid += ':latest'
-            self.names.append(repo_or_iid)
-            self.initial_name = repo_or_iid
+        Keeps the log store up to date with what containers log.
         
-        self._check_status()
+        store: LogStore() instance, defaults to log_store
+        ctns: Container() instances to follow. Defaults to all running
+            containers, looked up on every collection.
+        interval: Seconds between collections in the background
+        concurrency: Containers to fetch logs of at the same time
         
-        if self.short_id and not self.exists:
-            raise ValueError(
-                'No image was found for id: {0}'.format(repo_or_iid)
-            )
+        '''
+        self.store = store or log_store
+        if self.store is None:
+            raise WhalesnakeError('No log store, see enable_log_store()')
+        self.ctns = ctns
+        self.interval = interval
+        self.concurrency = concurrency
+        self.errors = {}
+        self._stop = threading.Event()
+        self._thread = None
     
     def __repr__(self):
-        return 'Image(repo_or_iid={0!r})'.format(self._passed_arg)
-    
-    def __str__(self):
-        if self.exists:
-            s = 'Image with names "{0}"'.format(', '.join(self.names))
-            s += ' and ID "{0}"'.format(self.long_id)
-        else:
-            s = 'Image with name "{0}"'.format(self.initial_name)
-        return s
+        return 'LogCollector(store={0!r})'.format(self.store)
     
-    def _check_status(self):
+    def collect(self):
         '''
-        Check status of the tag/id and set the missing pieces
+        Returns: dict of long id -> number of new lines. Containers that
+            failed are in 'errors' (long id -> exception) instead.
         
         '''
-        # defaults
-        self.exists = False
-        self.created = False
-        self.parent_id = None
-        self.virtual_size = None
+        ctns = self.ctns
+        if ctns is None:
+            ctns = [Container(ctn['Id']) for ctn in dc.containers()]
+        new, errors = {}, {}
+        for ctn, count, err in _pmap(self.store.collect, ctns,
+                                     self.concurrency):
+            if err is not None:
+                errors[ctn.long_id] = err
+            else:
+                new[ctn.long_id] = count
+        self.errors = errors
+        return new
+    
+    def _run(self):
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                # e.g. the daemon is gone for a moment, try again later
+                self.errors = {None: e}
+            if self._stop.wait(self.interval):
+                return
+    
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+
+class BuildStats(object):
+    
+    def __init__(self):
+        '''
+        Aggregates the steps of many builds, to find the Dockerfile steps
+        that keep missing the build cache and those that take the longest.
         
-        for img in dc.images():
-            id_match = self.short_id and img['Id'].startswith(self.short_id)
-            tag_match = self.initial_name \
-                            and self.initial_name in img['RepoTags']
-            if id_match or tag_match:
-                self.exists = True
-                self.short_id, self.long_id = check_docker_id(img['Id'])
-                self.names = img['RepoTags'] # add all tags
-                self.created = datetime.datetime.fromtimestamp(img['Created'])
-                self.parent_id = img['ParentId']
-                # docker uses base 10 for sizes i.e. 1kB = 1000B
-                self.virtual_size = img['VirtualSize'] # in Bytes
-                # img['Size'] seems to always be 0
-                break
+        Once a step misses the cache, all following steps of that build miss
+        it as well. So only the first miss of each build counts as 'busted',
+        the step that invalidated the cache. FROM steps never come from the
+        cache and are left out.
+        
+        '''
+        self.builds = 0
+        # instruction -> dict, see steps()
+        self._steps = {}
     
-    #######
-    ## 'official' docker commands below
-    ####
+    def __repr__(self):
+        return 'BuildStats(builds={0!r})'.format(self.builds)
     
-    def build(self, build_src, build_type, rm=True, **kwargs):
+    def add(self, report, image=None):
         '''
-        build_src: Object matching the build_type (open file, file-like obj ...)
-        build_type: The type of build_src. One of:
-            'tar', 'tar.gz', 'file', 'url', 'path', 'github', 'git'
-        rm: Remove intermediate containers. Defaults to True on the command
-            line, but not in docker-py
-            
-        Returns: Nothing
+        report: list of BuildStep() tuples, e.g. Image.build_report or the
+            'build_report' of build_many()
+        image: Name of the image, to know where an instruction is used
         
-        Possible docker-py arguments and their defaults:
-        quiet=False, nocache=False, timeout=None
+        '''
+        self.builds += 1
+        busted = False
+        for step in report:
+            if step.instruction.upper().startswith('FROM '):
+                continue
+            entry = self._steps.get(step.instruction)
+            if entry is None:
+                entry = self._steps[step.instruction] = {
+                    'instruction': step.instruction, 'runs': 0,
+                    'cache_hits': 0, 'busted': 0, 'seconds': 0.0,
+                    'uncached_seconds': 0.0, 'images': set(),
+                }
+            entry['runs'] += 1
+            entry['seconds'] += step.seconds or 0
+            if image is not None:
+                entry['images'].add(image)
+            if step.cached:
+                entry['cache_hits'] += 1
+                continue
+            entry['uncached_seconds'] += step.seconds or 0
+            if not busted:
+                entry['busted'] += 1
+                busted = True
+    
+    def add_many(self, reports):
+        '''
+        reports: Output of build_many()
         
         '''
-        # add option to 'print' the output received through stream
-        # optional: autodetect type (w/ https://github.com/ahupp/python-magic ?)
+        for name, report in reports.items():
+            if report['build_report']:
+                self.add(report['build_report'], name)
+    
+    def hit_rate(self):
+        '''
+        Returns: fraction of all steps that came from the cache, or None
         
-        if self.exists:
-            raise WhalesnakeError(
-                'Image() needs to be instantiated with a name instead of ' + \
-                'an image ID in order to allow for builds.'
-            )
+        '''
+        runs = sum(entry['runs'] for entry in self._steps.values())
+        if not runs:
+            return None
+        hits = sum(entry['cache_hits'] for entry in self._steps.values())
+        return float(hits) / runs
+    
+    def steps(self, top=None, sort='busted'):
+        '''
+        top: Only return this many steps
+        sort: Key to rank the steps by, largest first: 'busted', 'runs',
+            'cache_hits', 'seconds' or 'uncached_seconds'
         
-        args = {
-            'tag': self.initial_name,
-            'rm': rm
-        }
+        Returns: list of dicts with 'instruction', 'runs', 'cache_hits',
+            'hit_rate', 'busted' (number of builds whose cache it
+            invalidated), 'seconds' (in total), 'uncached_seconds' and
+            'images' (sorted names)
         
-        if build_type in ['tar', 'tar.gz']:
-            args['fileobj'] = build_src
-            args['custom_context'] = True
-            if build_type == 'tar.gz':
-                args['encoding'] = 'gzip'
-        elif build_type == 'file':
-            args['fileobj'] = build_src
-        elif build_type in ['url', 'path', 'github', 'git']:
-            args['path'] = build_src
+        '''
+        if sort not in ('busted', 'runs', 'cache_hits', 'seconds',
+                        'uncached_seconds'):
+            raise ValueError('Unknown sort key: {0}'.format(sort))
+        entries = self._steps.values()
+        if top is None:
+            entries = sorted(entries, key=lambda e: e[sort], reverse=True)
         else:
-            raise ValueError(
-                'Build type "{0}" is not supported.'.format(build_type)
-            )
-            
-        if kwargs:
-            args.update(kwargs)
-            
-        res = dc.build(**args)
+            entries = heapq.nlargest(top, entries, key=lambda e: e[sort])
+        res = []
+        for entry in entries:
+            entry = dict(entry)
+            entry['images'] = sorted(entry['images'])
+            entry['hit_rate'] = float(entry['cache_hits']) / entry['runs']
+            res.append(entry)
+        return res
+
+
+
+class Snapshot(object):
+    
+    KINDS = ('containers', 'images')
+    
+    def __init__(self):
+        '''
+        The container and image listings at one point in time, see take().
         
-        # https://github.com/docker/docker-py/issues/255
-        # lines w/ 'stream' as JSON key only contain information about
-        # the build process, not about pulling images from the registry etc.
-        lines = [line for line in res]
-        try:
-            parsed_lines = [json.loads(e).get('stream', '') for e in lines]
-        except ValueError:
-            # sometimes all the data is sent on a single line ????
-            #
-            # ValueError: Extra data: line 1 column 87 - line 1 column
-            # 33268 (char 86 - 33267)
-            line = lines[0]
-            # This ONLY works because every line is formatted as
-            # {"stream": STRING}
-            parsed_lines = [
-                json.loads(obj).get('stream', '') for obj in
-                re.findall('{\s*"stream"\s*:\s*"[^"]*"\s*}', line)
-            ]
+        For every kind in KINDS there are two dicts: '<kind>' (id -> raw row)
+        and '_<kind>_hashes' (id -> (crc32, length) of the rows JSON text).
+        Kinds that were not taken stay None.
         
-        self.build_log = ''.join(parsed_lines)
-        # search for success message
-        search = r'^Successfully built ([0-9a-f]{12})\n$'
-        status = parsed_lines[-1]
-        match = re.search(search, status)
-        if match:
-            # update meta data
-            self._check_status()
-            return
+        '''
+        self.taken = None
+        for kind in self.KINDS:
+            setattr(self, kind, None)
+            setattr(self, '_{0}_hashes'.format(kind), None)
+    
+    def __repr__(self):
+        return 'Snapshot({0})'.format(', '.join(
+            '{0}={1}'.format(kind, len(getattr(self, kind)))
+            for kind in self.KINDS if getattr(self, kind) is not None
+        ))
+    
+    @classmethod
+    def take(cls, prev=None, containers=True, images=True, all=True):
+        '''
+        prev: An earlier Snapshot(). Rows that did not change are taken over
+            from it instead of keeping the newly decoded ones.
+        containers, images: Which listings to take
+        all: Include stopped containers and intermediate images
         
-        elif status == '' and len(lines) is 1:
-            err = lines[0]
-            if 'errorDetail' in err:
-                msg = json.loads(err)['errorDetail']['message']
-                raise WhalesnakeError(
-                    'Build failed: {0}'.format(msg)
-                )
+        Rows are hashed on their JSON text as sent by the daemon. For
+        containers the durations in 'Status' are left out of it, so the
+        uptime doesn't count as a change.
         
-        # something else went wrong - dump everything we got back
-        raise WhalesnakeError('Build failed:\n{0}'.format(res))
+        '''
+        snap = cls()
+        snap.taken = time.time()
+        if containers:
+            snap._fill('containers', prev, (
+                (row, _container_text(text))
+                for row, text in _container_rows(all=all, with_text=True)
+            ))
+        if images:
+            snap._fill('images', prev, _image_rows(all=all, with_text=True))
+        return snap
     
-    def history(self):
-        if not self.exists:
-            raise WhalesnakeError('Image does not yet exist')
-        hist = dc.history(self.long_id)
-        return json.loads(hist)
+    def _fill(self, kind, prev, rows):
+        old_rows = getattr(prev, kind, None) or {}
+        old_hashes = getattr(prev, '_{0}_hashes'.format(kind), None) or {}
+        current, hashes = {}, {}
+        for row, text in rows:
+            long_id = row['Id']
+            # the same in every process, unlike hash()
+            data = text.encode('utf-8')
+            h = (zlib.crc32(data) & 0xffffffff, len(data))
+            hashes[long_id] = h
+            if old_hashes.get(long_id) == h:
+                # unchanged, keep the old row
+                current[long_id] = old_rows[long_id]
+            else:
+                current[long_id] = row
+        setattr(self, kind, current)
+        setattr(self, '_{0}_hashes'.format(kind), hashes)
     
-    def import_(self):
-        raise NotImplementedError
-        self._check_status()
+    @staticmethod
+    def diff(prev, curr):
+        '''
+        Returns: dict of kind -> InventoryDelta() of the added, removed and
+            changed rows, for the kinds taken in both snapshots. Only the
+            hashes are compared.
+        
+        '''
+        res = {}
+        for kind in Snapshot.KINDS:
+            old = getattr(prev, '_{0}_hashes'.format(kind))
+            new = getattr(curr, '_{0}_hashes'.format(kind))
+            if old is None or new is None:
+                continue
+            old_rows, new_rows = getattr(prev, kind), getattr(curr, kind)
+            added, removed, changed = {}, {}, {}
+            for long_id, h in new.items():
+                before = old.get(long_id)
+                if before is None:
+                    added[long_id] = new_rows[long_id]
+                elif before != h:
+                    changed[long_id] = (old_rows[long_id], new_rows[long_id])
+            for long_id in old:
+                if long_id not in new:
+                    removed[long_id] = old_rows[long_id]
+            res[kind] = InventoryDelta(added, removed, changed)
+        return res
+
+
+
+class PortIndex(object):
     
-    def inspect(self):
-        if not self.exists:
-            raise WhalesnakeError('Image does not yet exist')
-        return dc.inspect_image(self.long_id)
+    WILDCARD = (None, '', '0.0.0.0')
     
-    def pull(self, force=False):
-        if not self.exists or force:
-            jsn = dc.pull(self.initial_name)
-            msg = json.loads(jsn.split('\r\n')[-2])
-            if 'errorDetail' in msg:
-                raise ValueError(msg['errorDetail']['message'])
-            self._check_status()
-        else:
-            raise WhalesnakeError(
-                'Image exists. Use force=True to pull anyway.'
-            )
+    def __init__(self, rows=()):
+        '''
+        rows: Container listing rows, e.g. the values of Snapshot.containers.
+            See take() for getting them from the daemon.
+        
+        Maps the published host ports to the containers holding them, so
+        lookups and conflict checks need no further requests.
+        
+        '''
+        # (public, proto) -> [PortOwner()]
+        self._hosts = {}
+        # long id -> (name, (Port(), ...))
+        self._ctns = {}
+        self._names = {}
+        for row in rows:
+            self.add(row)
     
-    def push(self):
-        # might requrire login?
-        raise NotImplementedError
-        if not self.exists:
-            raise WhalesnakeError('Image does not yet exist')
+    def __repr__(self):
+        return 'PortIndex(containers={0}, host_ports={1})'.format(
+            len(self._ctns), len(self._hosts)
+        )
     
-    def remove(self, force=False, no_prune=False):
+    def __len__(self):
+        return len(self._hosts)
+    
+    def __contains__(self, public):
+        return self.owners(public) != []
+    
+    @classmethod
+    def take(cls, client=None, all=False):
         '''
-        Removes the image.
+        client: docker-py Client() to ask, defaults to the connected one
+        all: Include stopped containers. These don't publish ports, but their
+            exposed ones are kept for ports().
         
-        force: Needed for removal, if the image has multiple tags
-        no_prune: Do not delete untagged parents
+        Returns: a PortIndex() of one container listing
         
-        Returns: Nothing
+        '''
+        return cls(_container_rows(client, all=all))
+    
+    def add(self, row):
+        '''
+        row: A container listing row. Replaces what was known about it.
         
         '''
-        if not self.exists:
-            raise WhalesnakeError('Image does not yet exist')
+        long_id = row['Id']
+        if long_id in self._ctns:
+            self.remove(long_id)
+        name = row['Names'][0][1:] if row.get('Names') else ''
+        ports = _parse_ports(row.get('Ports'))
+        self._ctns[long_id] = (name, ports)
+        if name:
+            self._names[name] = long_id
+        for port in ports:
+            if port.public is None:
+                continue
+            owner = PortOwner(long_id, name, port)
+            self._hosts.setdefault((port.public, port.proto), []).append(owner)
+    
+    def remove(self, ref):
+        '''
+        ref: Name, short or long id of a container to forget
         
-        if len(self.names) > 1:
-            if force:
-                # why does docker only untag and not delete images even though
-                # the force flag is set?
-                for name in self.names:
-                    dc.remove_image(self.long_id, force, no_prune)
+        '''
+        long_id = self._resolve(ref)
+        if long_id is None:
+            return
+        name, ports = self._ctns.pop(long_id)
+        self._names.pop(name, None)
+        for port in ports:
+            key = (port.public, port.proto)
+            owners = [o for o in self._hosts.get(key, ()) if o.id != long_id]
+            if owners:
+                self._hosts[key] = owners
             else:
-                raise WhalesnakeError(
-                    'Image is tagged in multiple repositories. ' + \
-                    'Use force=True to remove anyway'
-                )
-        else:
-            dc.remove_image(self.long_id, force, no_prune)
+                self._hosts.pop(key, None)
+    
+    def _resolve(self, ref):
+        if ref in self._ctns:
+            return ref
+        if ref in self._names:
+            return self._names[ref]
+        ref = ref.lstrip('/')
+        if ref in self._names:
+            return self._names[ref]
+        for long_id in self._ctns:
+            if long_id.startswith(ref):
+                return long_id
+        return None
+    
+    def owners(self, public, proto='tcp'):
+        '''
+        Returns: list of PortOwner() that published host port 'public'
         
-        self._check_status()
+        '''
+        return list(self._hosts.get((int(public), proto), ()))
     
-    def tag(self, tags, force=False):
+    def conflicts(self, public, proto='tcp', ip=None):
         '''
-        tags: string or list of strings, that the image should be tagged with
-        force: Enforce the tag
+        ip: Host ip to bind to, None for all interfaces
         
-        Returns: nothing
+        Returns: list of PortOwner() a new binding would collide with
         
         '''
-        if not self.exists:
-            raise WhalesnakeError('Image does not yet exist')
-        if isinstance(tags, basestring):
-            tags = [tags, ]
-        for tag in tags:
-            ns, repo, tag = check_image_name(tag)
-            if ns:
-                repo = ns + '/' + repo
-            dc.tag(self.long_id, repository=repo, tag=tag, force=force)
-        self._check_status()
+        return [o for o in self._hosts.get((int(public), proto), ())
+                if ip in self.WILDCARD or o.port.ip in self.WILDCARD
+                or o.port.ip == ip]
     
-    def untag(self, tags=None):
+    def ports(self, ref):
         '''
-        Untags are only possible when instantiated with a name and the total
-        number of tags is greater than 1. Anything else would result in an image
-        removal.
+        ref: Name, short or long id of a container
         
-        tags: A string or a list of strings. They will be removed as tags from
-            the underlying image id .
+        Returns: tuple of Port(), None for unknown containers
         
-        Returns: nothing
+        '''
+        long_id = self._resolve(ref)
+        return None if long_id is None else self._ctns[long_id][1]
+    
+    def host_ports(self, ref, private_port, proto='tcp'):
+        '''
+        Returns: list of (ip, public) for where 'private_port' of container
+            'ref' is published
         
         '''
-        if not self.exists:
-            raise WhalesnakeError('Image does not yet exist')
-            
-        if tags:
-            if isinstance(tags, basestring):
-                tags = [tags, ]
-            if not len(tags) < len(self.names):
-                raise WhalesnakeError(
-                    'Only n-1 untags are possible, where n is the total ' + \
-                    'number of existing tags'
-                )
-            for tag in tags:
-                # assume latest if no actual tag is given
-                if not ':' in tag:
-                    tag += ':latest'
-                if not tag in self.names:
-                    raise ValueError(
-                        'Tag does not exist: "{0}"'.format(tag)
-                    )
-                dc.remove_image(tag)
-                self._check_status()
-                
-        elif self.initial_name in self.names and len(self.names) > 1:
-            dc.remove_image(self.initial_name)
-            self._check_status()
-            #self.initial_name = ''
-            
-        else:
-            raise WhalesnakeError(
-                'Either not instantiated with a name or number of ' + \
-                'existing tags is < 2'
-            )
-
+        private_port = int(private_port)
+        return [(p.ip or '0.0.0.0', p.public) for p in self.ports(ref) or ()
+                if p.private == private_port and p.proto == proto
+                and p.public is not None]